@@ -1,6 +1,12 @@
+import base64
+import hashlib
+import json
 import logging
 import os
+import re
+import zlib
 
+import click
 from dotenv import load_dotenv
 from flask import Flask
 from flask import abort
@@ -8,9 +14,16 @@ from flask import g
 from flask import jsonify
 from flask import request
 from flask import render_template
+from flask import Response
+from flask import stream_with_context
 from flask import url_for
 from flask_cors import CORS
 from flask_migrate import Migrate
+from sqlalchemy import bindparam
+from sqlalchemy import exists
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import tuple_
 from werkzeug.exceptions import HTTPException
 
 from error import setup_error_handlers
@@ -26,24 +39,57 @@ from error import err_unprocessable
 from error import err_server_error
 
 from models import setup_db
+from models import field_options
 from models import Recipe
 from models import Ingredient
 from models import Menu
+from models import menu_recipe_table
+from models import get_generation
+from models import bump_generation
+
+from cache import create_cache
+from replica import read_session
+from replica import setup_replicas
+from pantry import IngredientIndex
+from search import search_recipes
+from seed import clear_database
+from seed import seed_database
+from jsonprovider import setup_json_provider
+from metrics import setup_metrics
+from querylog import query_budget
+from timing import setup_timing
 
 from auth import requires_auth
 from auth import has_permission
 from auth import AUTH0_DOMAIN
 from auth import API_AUDIENCE
+from auth import token_cache
 
 load_dotenv()
 
 PAGE_SIZE = 10
+MAX_LIMIT = 100
+BULK_CHUNK_SIZE = 500
+RESPONSE_CACHE_URL = os.environ.get("RESPONSE_CACHE_URL", "memory://")
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024))
+)
+EXPORT_CHUNK_SIZE = 500
+MATCH_LIMIT = 10
+INGREDIENT_INDEX = "ingredient-index"
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/jsonlines")
 
 app = Flask(__name__)
+setup_json_provider(app)
 db = setup_db(app)
+response_cache = create_cache(RESPONSE_CACHE_URL, RESPONSE_CACHE_MAX_BYTES)
+setup_replicas(app, response_cache)
 setup_error_handlers(app)
 CORS(app)
 Migrate(app, db)
+setup_timing(app)
+setup_metrics(app, db, {"response": response_cache, "token": token_cache})
+ingredient_index = IngredientIndex()
 
 
 def get_page():
@@ -67,6 +113,8 @@ def check_page(start, total_items):
     """
     Check whether the requested page is out of bounds.
     """
+    if start < 0:
+        err_bad_request("Page must be at least 1")
     if total_items == 0:
         if start > 0:
             err_bad_request("Page set beyond end of list")
@@ -75,6 +123,457 @@ def check_page(start, total_items):
             err_bad_request("Page set beyond end of list")
 
 
+def is_cursor_mode():
+    """
+    Returns whether the client requested cursor based paging.
+    """
+    return "after" in request.args or "limit" in request.args
+
+
+def get_limit():
+    """
+    Returns the requested number of items for cursor based paging.
+    """
+    limit = request.args.get("limit", PAGE_SIZE, type=int)
+    if limit < 1 or limit > MAX_LIMIT:
+        err_bad_request(f"Limit must be between 1 and {MAX_LIMIT}")
+    return limit
+
+
+def encode_cursor(*values):
+    """
+    Returns the opaque cursor for the given sort key values
+    of the last item of a page.
+    """
+    data = json.dumps(values).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor, *types):
+    """
+    Returns the tuple of sort key values encoded in the cursor,
+    which must match the given types.
+    """
+    try:
+        values = tuple(json.loads(base64.urlsafe_b64decode(cursor)))
+        if len(values) != len(types) or not all(
+            isinstance(value, value_type)
+            for value, value_type
+            in zip(values, types)
+        ):
+            raise ValueError(cursor)
+        return values
+    except (ValueError, TypeError):
+        err_bad_request("Invalid cursor")
+
+
+def get_cursor_page(model, query):
+    """
+    Returns the items after the cursor given in the 'after' request
+    parameter and the cursor for the next page (None on the last page).
+
+    The query seeks on (name, id) in SQL, so the cost does not
+    depend on how far into the list the page is.
+    """
+    limit = get_limit()
+    after = request.args.get("after")
+    if after:
+        query = query.filter(
+            tuple_(model.name, model.id)
+            > tuple_(*decode_cursor(after, str, int))
+        )
+    items = query.order_by(model.name, model.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].name, items[-1].id)
+    return items, next_cursor
+
+
+def get_offset_page(model, query):
+    """
+    Returns the items of the page given in the 'page' request
+    parameter and the total number of pages.
+
+    Only the rows of the requested page are loaded, the total
+    is determined by a separate COUNT query.
+    """
+    page, start, end = get_page()
+    total_items = query.with_entities(func.count(model.id)).scalar()
+    check_page(start, total_items)
+    items = (
+        query
+        .order_by(model.name, model.id)
+        .offset(start)
+        .limit(PAGE_SIZE)
+        .all()
+    )
+    return page, items, get_total_pages(total_items)
+
+
+def get_fields(allowed):
+    """
+    Returns the fields requested by the comma separated 'fields'
+    request parameter in the order of allowed, always including
+    the id, or None if all allowed fields are requested.
+    """
+    value = request.args.get("fields")
+    if value is None:
+        return None
+    requested = {field.strip() for field in value.split(",") if field.strip()}
+    unknown = requested - set(allowed)
+    if unknown:
+        err_bad_request(f"Unknown fields: {', '.join(sorted(unknown))}")
+    fields = tuple(
+        field
+        for field
+        in allowed
+        if field in requested or field == "id"
+    )
+    return None if fields == tuple(allowed) else fields
+
+
+def get_sparse_item(model, item_id, fields):
+    """
+    Returns the response with the given fields of an item, loading
+    only what they need. These responses are not cached.
+    """
+    name = model.__name__
+    suffix = "-" + ".".join(fields)
+    if request.if_none_match:
+        version = get_version(model, item_id, name)
+        response = not_modified(f"{name.lower()}-{item_id}-{version}{suffix}")
+        if response:
+            return response
+    item = read_session().get(
+        model,
+        item_id,
+        options=field_options(model, fields, ("version",)),
+    )
+    if not item:
+        err_not_found(f"{name} {item_id} not found")
+    response = jsonify({"success": True, name.lower(): item.json(fields)})
+    response.set_etag(item.etag() + suffix)
+    return response
+
+
+def not_modified(etag):
+    """
+    Returns a 304 response if the client already has the
+    resource version identified by etag (If-None-Match),
+    None otherwise.
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def list_etag(kind, items, *extra):
+    """
+    Returns the etag of a list page, derived from the ids and
+    versions of its items and the paging information in extra.
+    """
+    versions = [item.list_version() for item in items]
+    data = repr((kind, versions, extra)).encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+def cached_response(key):
+    """
+    Returns the response for a cached entity (304 if the client
+    already has it), or None if the entity is not cached.
+    """
+    cached = response_cache.get(key)
+    if cached is None:
+        return None
+    body, etag = cached
+    response = not_modified(etag) or Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
+def cache_response(key, payload, etag, generation):
+    """
+    Encodes the payload, stores it in the response cache
+    and returns the response.
+
+    The generation of the cache key must have been read before
+    the payload was loaded from the database.
+    """
+    body = app.json.dumps_bytes(payload)
+    response_cache.set(key, body, etag, generation)
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
+def get_version(model, item_id, name):
+    """
+    Returns the version of an item without loading it,
+    or raises a 404 error if it does not exist.
+    """
+    version = read_session().execute(
+        select(model.version).where(model.id == item_id)
+    ).scalar()
+    if version is None:
+        err_not_found(f"{name} {item_id} not found")
+    return version
+
+
+def validate_string(value, field, column, where=""):
+    """
+    Checks that the value of a field is a string that fits into
+    the given column. where is appended to the error message.
+    """
+    if not isinstance(value, str):
+        err_bad_request(f"Field '{field}' is not a string{where}")
+    length = column.type.length
+    if length is not None and len(value) > length:
+        err_bad_request(f"Field '{field}' is longer than {length} characters{where}")
+
+
+def validate_preparation(value):
+    if value is not None:
+        validate_string(value, "preparation", Recipe.__table__.c.preparation)
+
+
+def validate_recipe(data):
+    """
+    Checks the fields of a new recipe and returns the recipe
+    fields and the list of its ingredients.
+    """
+    if not isinstance(data, dict):
+        err_bad_request("Recipe must be a JSON object")
+    if "name" not in data:
+        err_bad_request("Field 'name' is missing")
+    validate_string(data["name"], "name", Recipe.__table__.c.name)
+    if "servings" not in data:
+        err_bad_request("Field 'servings' is missing")
+    if not isinstance(data["servings"], int):
+        err_bad_request("Field 'servings' is not an integer")
+    if "ingredients" not in data:
+        err_bad_request("Field 'ingredients' is missing")
+    validate_preparation(data.get("preparation"))
+    fields = {
+        "name": data["name"],
+        "servings": data["servings"],
+        "preparation": data.get("preparation", ""),
+    }
+    return fields, validate_ingredients(data["ingredients"])
+
+
+def validate_ingredients(ingredients):
+    """
+    Checks the ingredients of a recipe and returns them
+    as a list of dicts with name and amount.
+    """
+    if not isinstance(ingredients, list):
+        err_bad_request("Field 'ingredients' is not a list")
+    result = []
+    for idx, ingredient in enumerate(ingredients):
+        if not isinstance(ingredient, dict):
+            err_bad_request(f"Ingredient {idx} is not a JSON object")
+        if "amount" not in ingredient:
+            err_bad_request(f"Field 'amount' is missing in ingredient {idx}")
+        if "name" not in ingredient:
+            err_bad_request(f"Field 'name' is missing in ingredient {idx}")
+        if (
+            not isinstance(ingredient["amount"], int)
+            and not isinstance(ingredient["amount"], float)
+        ):
+            err_bad_request(f"Field 'amount' is not numerical in ingredient {idx}")
+        validate_string(
+            ingredient["name"],
+            "name",
+            Ingredient.__table__.c.name,
+            f" in ingredient {idx}",
+        )
+        result.append({
+            "name": ingredient["name"],
+            "amount": ingredient["amount"],
+        })
+    return result
+
+
+def update_ingredients(recipe_id, ingredients):
+    """
+    Replaces the ingredients of a recipe.
+
+    The new ingredients are matched by position against the stored
+    ones, and only the necessary UPDATE, INSERT and DELETE statements
+    are issued (batched using executemany).
+    """
+    table = Ingredient.__table__
+    existing = db.session.execute(
+        select(table.c.id, table.c.name, table.c.amount)
+        .where(table.c.recipe_id == recipe_id)
+        .order_by(table.c.id)
+    ).all()
+    updates = [
+        {"_id": row.id, "_name": new["name"], "_amount": new["amount"]}
+        for row, new
+        in zip(existing, ingredients)
+        if (row.name, row.amount) != (new["name"], new["amount"])
+    ]
+    inserts = [
+        {"recipe_id": recipe_id, **new}
+        for new
+        in ingredients[len(existing):]
+    ]
+    deletes = [row.id for row in existing[len(ingredients):]]
+    if updates:
+        db.session.execute(
+            table.update()
+            .where(table.c.id == bindparam("_id"))
+            .values(name=bindparam("_name"), amount=bindparam("_amount")),
+            updates,
+        )
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    if deletes:
+        db.session.execute(table.delete().where(table.c.id.in_(deletes)))
+
+
+def get_recipe_menu_ids(recipe_id):
+    """
+    Returns the ids of all menus containing the recipe.
+    """
+    return db.session.execute(
+        select(menu_recipe_table.c.menu_id)
+        .where(menu_recipe_table.c.recipe_id == recipe_id)
+    ).scalars().all()
+
+
+def bump_menu_versions(menu_ids):
+    """
+    Increments the version of the given menus.
+    """
+    if not menu_ids:
+        return
+    menu_table = Menu.__table__
+    db.session.execute(
+        menu_table.update()
+        .where(menu_table.c.id.in_(menu_ids))
+        .values(version=menu_table.c.version + 1)
+    )
+
+
+def is_recipe_used(recipe_id):
+    """
+    Returns whether a menu contains the recipe, using
+    the index on the recipe_id of the dishes.
+    """
+    return db.session.execute(
+        select(
+            exists().where(menu_recipe_table.c.recipe_id == recipe_id)
+        )
+    ).scalar()
+
+
+def change_menu_counts(recipe_ids, delta):
+    """
+    Adds delta to the menu count of the given recipes.
+
+    The count is changed in SQL (not read and written back),
+    so that concurrent menu changes do not get lost.
+    """
+    if not recipe_ids:
+        return
+    recipe_table = Recipe.__table__
+    db.session.execute(
+        recipe_table.update()
+        .where(recipe_table.c.id.in_(recipe_ids))
+        .values(menu_count=recipe_table.c.menu_count + delta)
+    )
+
+
+def get_dish_recipes(dishes):
+    """
+    Returns the recipes referenced by the dishes of a menu.
+
+    All recipes are loaded with a single IN query. Every missing
+    recipe is reported in one error, duplicate dishes are ignored.
+    """
+    if not isinstance(dishes, list):
+        err_bad_request("Field 'dishes' is not a list")
+    recipe_ids = []
+    for idx, dish in enumerate(dishes):
+        if not isinstance(dish, dict):
+            err_bad_request(f"Dish {idx} is not a JSON object")
+        if "recipe_id" not in dish:
+            err_bad_request(f"Field 'recipe_id' is missing in dish {idx}")
+        if not isinstance(dish["recipe_id"], int):
+            err_bad_request(f"Field 'recipe_id' is not an integer in dish {idx}")
+        if dish["recipe_id"] not in recipe_ids:
+            recipe_ids.append(dish["recipe_id"])
+    if not recipe_ids:
+        return []
+    recipes = {
+        recipe.id: recipe
+        for recipe
+        in Recipe.query.filter(Recipe.id.in_(recipe_ids))
+    }
+    missing = [
+        str(recipe_id)
+        for recipe_id
+        in recipe_ids
+        if recipe_id not in recipes
+    ]
+    if missing:
+        err_bad_request(f"Recipes not found: {', '.join(missing)}")
+    return [recipes[recipe_id] for recipe_id in recipe_ids]
+
+
+def get_ingredient_index():
+    """
+    Returns the ingredient index, which is (re)built from the database
+    if it was not loaded yet or if another process changed recipes.
+    """
+    generation = get_generation(db.session, INGREDIENT_INDEX)
+    if not ingredient_index.loaded or ingredient_index.generation != generation:
+        table = Ingredient.__table__
+        ingredient_index.load(
+            db.session.execute(
+                select(table.c.recipe_id, table.c.name)
+                .where(table.c.recipe_id.is_not(None))
+            ),
+            generation,
+        )
+    return ingredient_index
+
+
+def bump_ingredient_index():
+    """
+    Announces a change of the ingredients to the other processes,
+    within the transaction of the change. Returns the generation
+    to pass to update_ingredient_index after the commit.
+    """
+    return bump_generation(db.session, INGREDIENT_INDEX)
+
+
+def update_ingredient_index(changes, generation):
+    """
+    Applies committed recipe changes, a dict from recipe id to the
+    ingredient names (None for deleted recipes), to the ingredient
+    index of this process. generation is the one returned by
+    bump_ingredient_index in the transaction of the changes.
+    """
+    expected = ingredient_index.generation
+    if not ingredient_index.loaded:
+        return
+    for recipe_id, names in changes.items():
+        if names is None:
+            ingredient_index.remove_recipe(recipe_id)
+        else:
+            ingredient_index.set_recipe(recipe_id, names)
+    # if another process changed recipes in the meantime, the
+    # generation differs and the index is rebuilt on next use
+    if generation == expected + 1:
+        ingredient_index.generation = generation
+
+
 @app.route("/")
 def get_index_infos():
     """
@@ -86,6 +585,7 @@ def get_index_infos():
 
 
 @app.route("/recipe")
+@query_budget(2)
 def get_recipe_list():
     """
     Returns the paged list of recipes.
@@ -93,19 +593,36 @@ def get_recipe_list():
     This endpoint is public, thus does not require authentication.
     """
     try:
-        page, start, end = get_page()
-        recipes = Recipe.query.order_by(Recipe.name).all()
-        check_page(start, len(recipes))
-        return jsonify({
+        fields = get_fields(Recipe.LIST_FIELDS) or Recipe.LIST_FIELDS
+        query = read_session().query(Recipe).options(*Recipe.list_options(fields))
+        if is_cursor_mode():
+            recipes, next_cursor = get_cursor_page(Recipe, query)
+            etag = list_etag("recipes", recipes, next_cursor, fields)
+            response = not_modified(etag) or jsonify({
+                "success": True,
+                "next_cursor": next_cursor,
+                "recipes": [
+                    recipe.json_list(fields)
+                    for recipe
+                    in recipes
+                ],
+            })
+            response.set_etag(etag)
+            return response
+        page, recipes, total_pages = get_offset_page(Recipe, query)
+        etag = list_etag("recipes", recipes, page, total_pages, fields)
+        response = not_modified(etag) or jsonify({
             "success": True,
             "page": page,
-            "total_pages": get_total_pages(len(recipes)),
+            "total_pages": total_pages,
             "recipes": [
-                recipe.json_short()
+                recipe.json_list(fields)
                 for recipe
-                in recipes[start:end]
+                in recipes
             ],
         })
+        response.set_etag(etag)
+        return response
     except HTTPException:
         raise
     except:
@@ -114,7 +631,202 @@ def get_recipe_list():
         err_server_error(msg)
 
 
+@app.route("/recipe/search")
+@query_budget(1)
+def search_recipe_list():
+    """
+    Returns the recipes matching all words of the 'q' request
+    parameter in their name, ingredients or preparation, best
+    matches first. Paging works with 'limit' and 'after' as in
+    the cursor mode of get_recipe_list.
+
+    This endpoint is public, thus does not require authentication.
+    """
+    try:
+        q = request.args.get("q", "")
+        if not re.search(r"\w", q):
+            err_bad_request("Parameter 'q' is missing")
+        limit = get_limit()
+        after = request.args.get("after")
+        if after:
+            after = decode_cursor(after, (int, float), int)
+        rows = search_recipes(db.session, q, limit + 1, after)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].score, rows[-1].id)
+        return jsonify({
+            "success": True,
+            "next_cursor": next_cursor,
+            "recipes": [
+                {
+                    "id": row.id,
+                    "name": row.name,
+                    "username": row.username,
+                }
+                for row
+                in rows
+            ],
+        })
+    except HTTPException:
+        raise
+    except:
+        msg = "Cannot search recipes"
+        logging.exception(msg)
+        err_server_error(msg)
+
+
+@app.route("/recipe/match", methods=("POST",))
+@query_budget(3)
+def match_recipe_list():
+    """
+    Returns the recipes using the most of the ingredients given in the
+    'ingredients' field, ranked by the number of matched ingredients and
+    then by the fraction of the recipe's ingredients that is matched.
+    The optional 'limit' field gives the number of recipes returned.
+
+    This endpoint is public, thus does not require authentication.
+    """
+    data = request.get_json()
+    try:
+        if not isinstance(data, dict) or "ingredients" not in data:
+            err_bad_request("Field 'ingredients' is missing")
+        names = data["ingredients"]
+        if not isinstance(names, list) or not all(
+            isinstance(name, str)
+            for name
+            in names
+        ):
+            err_bad_request("Field 'ingredients' is not a list of names")
+        limit = data.get("limit", MATCH_LIMIT)
+        if not isinstance(limit, int) or limit < 1 or limit > MAX_LIMIT:
+            err_bad_request(f"Limit must be between 1 and {MAX_LIMIT}")
+        matches = get_ingredient_index().match(names, limit)
+        recipe_table = Recipe.__table__
+        recipes = {
+            row.id: row
+            for row
+            in db.session.execute(
+                select(
+                    recipe_table.c.id,
+                    recipe_table.c.name,
+                    recipe_table.c.username,
+                )
+                .where(recipe_table.c.id.in_([match[0] for match in matches]))
+            )
+        }
+        return jsonify({
+            "success": True,
+            "recipes": [
+                {
+                    "id": recipe_id,
+                    "name": recipes[recipe_id].name,
+                    "username": recipes[recipe_id].username,
+                    "matched_ingredients": matched,
+                    "number_of_ingredients": total,
+                }
+                for recipe_id, matched, total
+                in matches
+                if recipe_id in recipes
+            ],
+        })
+    except HTTPException:
+        raise
+    except:
+        msg = "Cannot match recipes"
+        logging.exception(msg)
+        err_server_error(msg)
+
+
+def export_recipes(since):
+    """
+    Yields all recipes with an id greater than since, including
+    their ingredients, as NDJSON (one chunk of lines at a time).
+
+    The recipes are read through a server-side cursor in partitions
+    of EXPORT_CHUNK_SIZE rows, and the ingredients of each partition
+    are loaded with one IN query, so memory usage does not depend on
+    the size of the catalogue. No ORM objects are created.
+    """
+    recipe_table = Recipe.__table__
+    ingredient_table = Ingredient.__table__
+    result = db.session.execute(
+        select(recipe_table)
+        .where(recipe_table.c.id > since)
+        .order_by(recipe_table.c.id)
+        .execution_options(stream_results=True)
+    )
+    for rows in result.partitions(EXPORT_CHUNK_SIZE):
+        ingredients = {row.id: [] for row in rows}
+        for ingredient in db.session.execute(
+            select(
+                ingredient_table.c.recipe_id,
+                ingredient_table.c.name,
+                ingredient_table.c.amount,
+            )
+            .where(ingredient_table.c.recipe_id.in_(list(ingredients)))
+            .order_by(ingredient_table.c.id)
+        ):
+            ingredients[ingredient.recipe_id].append({
+                "name": ingredient.name,
+                "amount": ingredient.amount,
+            })
+        yield b"".join(
+            app.json.dumps_bytes({
+                "id": row.id,
+                "name": row.name,
+                "username": row.username,
+                "servings": row.servings,
+                "ingredients": ingredients[row.id],
+                "preparation": row.preparation,
+            }) + b"\n"
+            for row
+            in rows
+        )
+
+
+def gzip_stream(chunks):
+    """
+    Compresses a stream of byte chunks into gzip format.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.route("/recipe/export")
+def export_recipe_list():
+    """
+    Streams all recipes including their ingredients as NDJSON.
+
+    With the 'since' request parameter, only recipes with a higher
+    recipe_id are returned, so an interrupted export can continue
+    after the last recipe it received. 'since' is a resume offset,
+    not a change feed: recipes updated or deleted after they were
+    exported are not returned again, so a mirror must run a full
+    export to pick up such changes. The response is gzip compressed
+    if the client accepts it.
+
+    This endpoint is public, thus does not require authentication.
+    """
+    since = request.args.get("since", 0, type=int)
+    chunks = export_recipes(since)
+    headers = {"Vary": "Accept-Encoding"}
+    if "gzip" in request.accept_encodings:
+        chunks = gzip_stream(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(
+        stream_with_context(chunks),
+        mimetype="application/x-ndjson",
+        headers=headers,
+    )
+
+
 @app.route("/recipe/<int:recipe_id>")
+@query_budget(3)
 def get_recipe(recipe_id):
     """
     Returns a specific recipe given by its recipe_id.
@@ -122,13 +834,33 @@ def get_recipe(recipe_id):
     This endpoint is public, thus does not require authentication.
     """
     try:
-        recipe = db.session.get(Recipe, recipe_id)
+        fields = get_fields(Recipe.DETAIL_FIELDS)
+        if fields:
+            return get_sparse_item(Recipe, recipe_id, fields)
+        response = cached_response(f"recipe:{recipe_id}")
+        if response:
+            return response
+        generation = response_cache.generation(f"recipe:{recipe_id}")
+        if request.if_none_match:
+            version = get_version(Recipe, recipe_id, "Recipe")
+            response = not_modified(f"recipe-{recipe_id}-{version}")
+            if response:
+                return response
+        # cache misses are loaded from the primary, so that a lagging
+        # replica can never put an outdated recipe into the cache
+        recipe = db.session.get(
+            Recipe,
+            recipe_id,
+            options=Recipe.detail_options(),
+        )
         if not recipe:
             err_not_found(f"Recipe {recipe_id} not found")
-        return jsonify({
-            "success": True,
-            "recipe": recipe.json(),
-        })
+        return cache_response(
+            f"recipe:{recipe_id}",
+            {"success": True, "recipe": recipe.json()},
+            recipe.etag(),
+            generation,
+        )
     except HTTPException:
         raise
     except:
@@ -138,6 +870,7 @@ def get_recipe(recipe_id):
 
 
 @app.route("/recipe", methods=("POST",))
+@query_budget(4)
 @requires_auth("add:recipe")
 def add_recipe():
     """
@@ -145,39 +878,23 @@ def add_recipe():
     """
     data = request.get_json()
     try:
-        if "name" not in data:
-            err_bad_request("Field 'name' is missing")
-        if "servings" not in data:
-            err_bad_request("Field 'servings' is missing")
-        if not isinstance(data["servings"], int):
-            err_bad_request("Field 'servings' is not an integer")
-        if "ingredients" not in data:
-            err_bad_request("Field 'ingredients' is missing")
-        recipe = Recipe(
-            name=data["name"],
-            username=g.username,
-            servings=data["servings"],
-            preparation=data.get("preparation", "")
-        )
-        for idx, ingredient in enumerate(data["ingredients"]):
-            if "amount" not in ingredient:
-                err_bad_request(f"Field 'amount' is missing in ingredient {idx}")
-            if "name" not in ingredient:
-                err_bad_request(f"Field 'name' is missing in ingredient {idx}")
-            if (
-                not isinstance(ingredient["amount"], int)
-                and not isinstance(ingredient["amount"], float)
-            ):
-                err_bad_request(f"Field 'amount' is not numerical in ingredient {idx}")
-            new_ingredient = Ingredient(
-                name=ingredient["name"],
-                amount=ingredient["amount"],
-            )
-            recipe.ingredients.append(new_ingredient)            
+        fields, ingredients = validate_recipe(data)
+        recipe = Recipe(username=g.username, **fields)
         db.session.add(recipe)
         db.session.flush()
         recipe_id = recipe.id
+        # one executemany INSERT, as in insert_recipe_chunk
+        if ingredients:
+            db.session.execute(Ingredient.__table__.insert(), [
+                {"recipe_id": recipe_id, **ingredient}
+                for ingredient
+                in ingredients
+            ])
+        generation = bump_ingredient_index()
         db.session.commit()
+        update_ingredient_index({
+            recipe_id: [ingredient["name"] for ingredient in ingredients],
+        }, generation)
         return success2(
             "msg", f"Added recipe with id {recipe_id}",
             "id", recipe_id,
@@ -190,7 +907,172 @@ def add_recipe():
         err_server_error(msg)
 
 
+def read_bulk_rows():
+    """
+    Yields (data, error) for every row of a bulk request body.
+
+    The body is either a JSON array or, for the NDJSON content
+    types, one JSON document per line, which is read as a stream.
+    """
+    if request.mimetype in NDJSON_MIMETYPES:
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line), None
+            except ValueError:
+                yield None, "Invalid JSON"
+    else:
+        data = request.get_json()
+        if not isinstance(data, list):
+            err_bad_request("Body must be a JSON array of recipes")
+        for row in data:
+            yield row, None
+
+
+def add_recipe_rows(chunk):
+    """
+    Adds a chunk of validated recipes to the session and
+    returns their ids.
+
+    The recipes are inserted in one flush (batched into multi-row
+    INSERTs by the postgresql driver), the ingredients with one
+    executemany INSERT.
+    """
+    recipes = [
+        Recipe(username=g.username, **fields)
+        for _, fields, _
+        in chunk
+    ]
+    db.session.add_all(recipes)
+    db.session.flush()
+    ingredients = [
+        {"recipe_id": recipe.id, **ingredient}
+        for recipe, (_, _, recipe_ingredients)
+        in zip(recipes, chunk)
+        for ingredient
+        in recipe_ingredients
+    ]
+    if ingredients:
+        db.session.execute(Ingredient.__table__.insert(), ingredients)
+    return [recipe.id for recipe in recipes]
+
+
+def commit_recipe_rows(chunk, recipe_ids, generation):
+    """
+    Commits the added recipes and returns the result for every row.
+    """
+    db.session.commit()
+    db.session.expunge_all()
+    update_ingredient_index({
+        recipe_id: [ingredient["name"] for ingredient in recipe_ingredients]
+        for recipe_id, (_, _, recipe_ingredients)
+        in zip(recipe_ids, chunk)
+    }, generation)
+    return [
+        {"index": idx, "id": recipe_id}
+        for (idx, _, _), recipe_id
+        in zip(chunk, recipe_ids)
+    ]
+
+
+def add_recipe_rows_one_by_one(chunk):
+    """
+    Adds the recipes of a chunk one by one, each in a SAVEPOINT, so
+    that only the recipes the database rejects fail. Returns the
+    ingredient index generation, the added rows, their ids and the
+    results of the failed rows.
+    """
+    # the first statement, which begins the transaction
+    generation = bump_ingredient_index()
+    rows = []
+    recipe_ids = []
+    errors = []
+    for row in chunk:
+        try:
+            with db.session.begin_nested():
+                recipe_ids.extend(add_recipe_rows([row]))
+            rows.append(row)
+        except Exception:
+            logging.exception(f"Cannot insert recipe {row[0]}")
+            errors.append({"index": row[0], "error": "Cannot insert recipe"})
+    return generation, rows, recipe_ids, errors
+
+
+def insert_recipe_chunk(chunk):
+    """
+    Inserts a chunk of validated recipes and commits them.
+    Returns the result for every row.
+
+    If the chunk cannot be inserted at once, the recipes are
+    inserted one by one.
+    """
+    try:
+        try:
+            generation = bump_ingredient_index()
+            rows, recipe_ids = chunk, add_recipe_rows(chunk)
+            errors = []
+        except Exception:
+            db.session.rollback()
+            logging.exception("Cannot insert chunk of recipes, inserting one by one")
+            generation, rows, recipe_ids, errors = add_recipe_rows_one_by_one(chunk)
+        return errors + commit_recipe_rows(rows, recipe_ids, generation)
+    except Exception:
+        db.session.rollback()
+        logging.exception("Cannot insert chunk of recipes")
+        return [
+            {"index": idx, "error": "Cannot insert recipe"}
+            for idx, _, _
+            in chunk
+        ]
+
+
+# no query budget, the number of statements grows with the chunks
+@app.route("/recipe/bulk", methods=("POST",))
+@requires_auth("add:recipe")
+def add_recipes_bulk():
+    """
+    Adds many recipes to the database at once.
+
+    The body is a JSON array of recipes or a stream of recipes in
+    NDJSON format. Each recipe is validated as in add_recipe. Valid
+    recipes are inserted and committed in chunks of BULK_CHUNK_SIZE.
+    Returns the id or the error of every row.
+    """
+    try:
+        results = []
+        chunk = []
+        for idx, (data, error) in enumerate(read_bulk_rows()):
+            if error is None:
+                try:
+                    chunk.append((idx, *validate_recipe(data)))
+                except HTTPException as e:
+                    error = e.description
+            if error is not None:
+                results.append({"index": idx, "error": error})
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                results.extend(insert_recipe_chunk(chunk))
+                chunk = []
+        if chunk:
+            results.extend(insert_recipe_chunk(chunk))
+        results.sort(key=lambda result: result["index"])
+        return jsonify({
+            "success": True,
+            "inserted": sum(1 for result in results if "id" in result),
+            "failed": sum(1 for result in results if "error" in result),
+            "results": results,
+        })
+    except HTTPException:
+        raise
+    except Exception:
+        msg = "Cannot add recipes"
+        logging.exception(msg)
+        err_server_error(msg)
+
+
 @app.route("/recipe/<int:recipe_id>", methods=("PATCH",))
+@query_budget(8)
 @requires_auth("update:recipe")
 def update_recipe(recipe_id):
     """
@@ -206,33 +1088,38 @@ def update_recipe(recipe_id):
             err_not_found(f"Recipe {recipe_id} not found")
         if recipe.username != g.username and not has_permission("update:any-recipe"):
             err_forbidden("Cannot update recipes of other users")
+        if not isinstance(data, dict):
+            err_bad_request("Recipe must be a JSON object")
         if "name" in data:
+            validate_string(data["name"], "name", Recipe.__table__.c.name)
             recipe.name = data["name"]
         if "servings" in data:
             if not isinstance(data["servings"], int):
                 err_bad_request("Field 'servings' is not an integer")
             recipe.servings = data["servings"]
+        ingredients = None
         if "ingredients" in data:
-            new_ingredients = data["ingredients"]
-            recipe.ingredients.clear()
-            for idx, ingredient in enumerate(data["ingredients"]):
-                if "amount" not in ingredient:
-                    err_bad_request(f"Field 'amount' is missing in ingredient {idx}")
-                if "name" not in ingredient:
-                    err_bad_request(f"Field 'name' is missing in ingredient {idx}")
-                if (
-                    not isinstance(ingredient["amount"], int)
-                    and not isinstance(ingredient["amount"], float)
-                ):
-                    err_bad_request(f"Field 'amount' is not numerical in ingredient {idx}")
-                new_ingredient = Ingredient(
-                    name=ingredient["name"],
-                    amount=ingredient["amount"],
-                )
-                recipe.ingredients.append(new_ingredient)
+            ingredients = validate_ingredients(data["ingredients"])
+            update_ingredients(recipe_id, ingredients)
         if "preparation" in data:
+            validate_preparation(data["preparation"])
             recipe.preparation = data["preparation"]
+        recipe.version = Recipe.version + 1
+        menu_ids = get_recipe_menu_ids(recipe_id)
+        if "name" in data:
+            # the recipe name is part of the menu details
+            bump_menu_versions(menu_ids)
+        if ingredients is not None:
+            generation = bump_ingredient_index()
         db.session.commit()
+        response_cache.invalidate(
+            f"recipe:{recipe_id}",
+            *(f"menu:{menu_id}" for menu_id in menu_ids),
+        )
+        if ingredients is not None:
+            update_ingredient_index({
+                recipe_id: [ingredient["name"] for ingredient in ingredients],
+            }, generation)
         return success2(
             "msg", f"Updated recipe with id {recipe_id}",
             "id", recipe_id,
@@ -246,6 +1133,7 @@ def update_recipe(recipe_id):
 
 
 @app.route("/recipe/<int:recipe_id>", methods=("DELETE",))
+@query_budget(7)
 @requires_auth("delete:recipe")
 def delete_recipe(recipe_id):
     """
@@ -258,7 +1146,7 @@ def delete_recipe(recipe_id):
         recipe = db.session.get(Recipe, recipe_id)
         if not recipe:
             err_not_found(f"Recipe {recipe_id} not found")
-        if recipe.menus:
+        if is_recipe_used(recipe_id):
             err_forbidden(
                 f"Cannot delete recipe {recipe_id} "
                 "because it is used in menus"
@@ -266,7 +1154,10 @@ def delete_recipe(recipe_id):
         if recipe.username != g.username and not has_permission("delete:any-recipe"):
             err_forbidden("Cannot delete recipes of other users")
         db.session.delete(recipe)
+        generation = bump_ingredient_index()
         db.session.commit()
+        response_cache.invalidate(f"recipe:{recipe_id}")
+        update_ingredient_index({recipe_id: None}, generation)
         return success2(
             "msg", f"Recipe {recipe_id} deleted",
             "id", recipe_id,
@@ -280,6 +1171,7 @@ def delete_recipe(recipe_id):
 
 
 @app.route("/menu")
+@query_budget(2)
 def get_menu_list():
     """
     Returns the paged list of menus.
@@ -287,19 +1179,36 @@ def get_menu_list():
     This endpoint is public, thus does not require authentication.
     """
     try:
-        page, start, end = get_page()
-        menus = Menu.query.order_by(Menu.name).all()
-        check_page(start, len(menus))
-        return jsonify({
+        fields = get_fields(Menu.LIST_FIELDS) or Menu.LIST_FIELDS
+        query = read_session().query(Menu).options(*Menu.list_options(fields))
+        if is_cursor_mode():
+            menus, next_cursor = get_cursor_page(Menu, query)
+            etag = list_etag("menus", menus, next_cursor, fields)
+            response = not_modified(etag) or jsonify({
+                "success": True,
+                "next_cursor": next_cursor,
+                "menus": [
+                    menu.json_list(fields)
+                    for menu
+                    in menus
+                ],
+            })
+            response.set_etag(etag)
+            return response
+        page, menus, total_pages = get_offset_page(Menu, query)
+        etag = list_etag("menus", menus, page, total_pages, fields)
+        response = not_modified(etag) or jsonify({
             "success": True,
             "page": page,
-            "total_pages": get_total_pages(len(menus)),
+            "total_pages": total_pages,
             "menus": [
-                menu.json_short()
+                menu.json_list(fields)
                 for menu
-                in menus[start:end]
+                in menus
             ],
         })
+        response.set_etag(etag)
+        return response
     except HTTPException:
         raise
     except:
@@ -308,7 +1217,96 @@ def get_menu_list():
         err_server_error(msg)
 
 
+def get_menu_ids():
+    """
+    Returns the distinct menu ids of the comma separated
+    'ids' request parameter.
+    """
+    menu_ids = []
+    for value in request.args.get("ids", "").split(","):
+        value = value.strip()
+        if not value:
+            continue
+        if not (value.isascii() and value.isdigit()):
+            err_bad_request(f"Invalid menu id '{value}'")
+        if int(value) not in menu_ids:
+            menu_ids.append(int(value))
+    if not menu_ids:
+        err_bad_request("Parameter 'ids' is missing")
+    if len(menu_ids) > MAX_LIMIT:
+        err_bad_request(f"At most {MAX_LIMIT} menus are allowed")
+    return menu_ids
+
+
+@app.route("/menu/shopping-list")
+@query_budget(2)
+def get_shopping_list():
+    """
+    Returns the combined ingredients of all recipes of the menus given
+    by the 'ids' request parameter, summed up by ingredient name.
+
+    With the 'servings' request parameter, the amounts of every recipe
+    are scaled from its own number of servings to the given number.
+    The amounts are aggregated by a single SQL query.
+
+    This endpoint is public, thus does not require authentication.
+    """
+    try:
+        menu_ids = get_menu_ids()
+        servings = request.args.get("servings", type=int)
+        if "servings" in request.args and (servings is None or servings < 1):
+            err_bad_request("Parameter 'servings' must be a positive integer")
+        found = set(db.session.execute(
+            select(Menu.__table__.c.id).where(Menu.__table__.c.id.in_(menu_ids))
+        ).scalars())
+        missing = [
+            str(menu_id)
+            for menu_id
+            in menu_ids
+            if menu_id not in found
+        ]
+        if missing:
+            err_not_found(f"Menus not found: {', '.join(missing)}")
+        recipe_table = Recipe.__table__
+        ingredient_table = Ingredient.__table__
+        amount = ingredient_table.c.amount
+        if servings is not None:
+            # recipes without servings are not scaled
+            amount = func.coalesce(
+                amount * servings / func.nullif(recipe_table.c.servings, 0),
+                amount,
+            )
+        rows = db.session.execute(
+            select(ingredient_table.c.name, func.sum(amount).label("amount"))
+            .select_from(menu_recipe_table)
+            .join(recipe_table, recipe_table.c.id == menu_recipe_table.c.recipe_id)
+            .join(ingredient_table, ingredient_table.c.recipe_id == recipe_table.c.id)
+            .where(menu_recipe_table.c.menu_id.in_(menu_ids))
+            .group_by(ingredient_table.c.name)
+            .order_by(ingredient_table.c.name)
+        )
+        return jsonify({
+            "success": True,
+            "servings": servings,
+            "ingredients": [
+                {
+                    "name": row.name,
+                    "amount": row.amount,
+                }
+                for row
+                in rows
+            ],
+        })
+    except HTTPException:
+        raise
+    except:
+        msg = "Cannot get the shopping list"
+        logging.exception(msg)
+        err_server_error(msg)
+
+
 @app.route("/menu/<int:menu_id>")
+@query_budget(3)
 def get_menu(menu_id):
     """
     Return a specific menu given by the menu_id.
@@ -316,13 +1314,32 @@ def get_menu(menu_id):
     This endpoint is public, thus does not require authentication.
     """
     try:
-        menu = db.session.get(Menu, menu_id)
+        fields = get_fields(Menu.DETAIL_FIELDS)
+        if fields:
+            return get_sparse_item(Menu, menu_id, fields)
+        response = cached_response(f"menu:{menu_id}")
+        if response:
+            return response
+        generation = response_cache.generation(f"menu:{menu_id}")
+        if request.if_none_match:
+            version = get_version(Menu, menu_id, "Menu")
+            response = not_modified(f"menu-{menu_id}-{version}")
+            if response:
+                return response
+        # loaded from the primary, see get_recipe
+        menu = db.session.get(
+            Menu,
+            menu_id,
+            options=Menu.detail_options(),
+        )
         if not menu:
             err_not_found(f"Menu {menu_id} not found")
-        return jsonify({
-            "success": True,
-            "menu": menu.json(),
-        })
+        return cache_response(
+            f"menu:{menu_id}",
+            {"success": True, "menu": menu.json()},
+            menu.etag(),
+            generation,
+        )
     except HTTPException:
         raise
     except:
@@ -332,6 +1349,7 @@ def get_menu(menu_id):
 
 
 @app.route("/menu", methods=("POST",))
+@query_budget(4)
 @requires_auth("add:menu")
 def add_menu():
     """
@@ -343,21 +1361,17 @@ def add_menu():
             err_bad_request("Field 'name' is missing")
         if "dishes" not in data:
             err_bad_request("Field 'dishes' is missing")
+        dishes = get_dish_recipes(data["dishes"])
         menu = Menu(
             name=data["name"],
             username=g.username,
+            dishes=dishes,
+            dish_count=len(dishes),
         )
-        for idx, dish in enumerate(data["dishes"]):
-            if "recipe_id" not in dish:
-                err_bad_request(f"Field 'recipe_id' is missing in dish {idx}")
-            recipe_id = dish["recipe_id"]
-            recipe = db.session.get(Recipe, recipe_id)
-            if not recipe:
-                err_bad_request(f"Recipe {recipe_id} in dish {idx} not found")
-            menu.dishes.append(recipe)
         db.session.add(menu)
         db.session.flush()
         menu_id = menu.id
+        change_menu_counts([recipe.id for recipe in dishes], 1)
         db.session.commit()
         return success2(
             "msg", f"Added menu with id {menu_id}",
@@ -372,6 +1386,7 @@ def add_menu():
 
 
 @app.route("/menu/<int:menu_id>", methods=("PATCH",))
+@query_budget(8)
 @requires_auth("update:menu")
 def update_menu(menu_id):
     """
@@ -382,7 +1397,9 @@ def update_menu(menu_id):
     """
     data = request.get_json()
     try:
-        menu = db.session.get(Menu, menu_id)
+        # locked, so that concurrent updates of the dishes
+        # change the menu counts of the recipes consistently
+        menu = db.session.get(Menu, menu_id, with_for_update=True)
         if not menu:
             err_not_found(f"Menu {menu_id} not found")
         if menu.username != g.username and not has_permission("update:any-menu"):
@@ -390,16 +1407,16 @@ def update_menu(menu_id):
         if "name" in data:
             menu.name = data["name"]
         if "dishes" in data:
-            menu.dishes.clear()
-            for idx, dish in enumerate(data["dishes"]):
-                if "recipe_id" not in dish:
-                    err_bad_request(f"Field 'recipe_id' is missing in dish {idx}")
-                recipe_id = dish["recipe_id"]
-                recipe = db.session.get(Recipe, recipe_id)
-                if not recipe:
-                    err_bad_request(f"Recipe {recipe_id} in dish {idx} not found")
-                menu.dishes.append(recipe)
+            dishes = get_dish_recipes(data["dishes"])
+            old_ids = {recipe.id for recipe in menu.dishes}
+            new_ids = {recipe.id for recipe in dishes}
+            menu.dishes = dishes
+            menu.dish_count = len(dishes)
+            change_menu_counts(old_ids - new_ids, -1)
+            change_menu_counts(new_ids - old_ids, 1)
+        menu.version = Menu.version + 1
         db.session.commit()
+        response_cache.invalidate(f"menu:{menu_id}")
         return success2(
             "msg", f"Updated menu with id {menu_id}",
             "id", menu_id,
@@ -413,6 +1430,7 @@ def update_menu(menu_id):
 
 
 @app.route("/menu/<int:menu_id>", methods=("DELETE",))
+@query_budget(5)
 @requires_auth("delete:menu")
 def delete_menu(menu_id):
     """
@@ -422,13 +1440,15 @@ def delete_menu(menu_id):
     or if the current user has administrative privileges.
     """
     try:
-        menu = db.session.get(Menu, menu_id)
+        menu = db.session.get(Menu, menu_id, with_for_update=True)
         if not menu:
             err_not_found(f"Menu {menu_id} not found")
         if menu.username != g.username and not has_permission("delete:any-menu"):
             err_forbidden("Cannot delete menus of other users")
+        change_menu_counts([recipe.id for recipe in menu.dishes], -1)
         db.session.delete(menu)
         db.session.commit()
+        response_cache.invalidate(f"menu:{menu_id}")
         return success2(
             "msg", f"Menu {menu_id} deleted",
             "id", menu_id,
@@ -441,6 +1461,30 @@ def delete_menu(menu_id):
         err_server_error(msg)
 
 
+@app.cli.command("seed")
+@click.option("--recipes", default=1000, show_default=True,
+              help="Number of recipes to add.")
+@click.option("--menus", type=int,
+              help="Number of menus to add (default: a tenth of the recipes).")
+@click.option("--seed", "seed_value", default=1, show_default=True,
+              help="Seed of the random generator.")
+@click.option("--clear", is_flag=True,
+              help="Delete all recipes and menus first.")
+def seed_command(recipes, menus, seed_value, clear):
+    """
+    Fills the database with synthetic recipes and menus.
+    """
+    if menus is None:
+        menus = recipes // 10
+    if clear:
+        clear_database(db.session)
+        response_cache.clear()
+    recipe_ids, menu_ids = seed_database(db.session, recipes, menus, seed_value)
+    bump_ingredient_index()
+    db.session.commit()
+    click.echo(f"Added {len(recipe_ids)} recipes and {len(menu_ids)} menus")
+
+
 # The following two routes are not formally part of the API.
 # Instead, they provide a very simple GUI for logging in
 # using Auth0 and retrieving the JWT token required for accessing
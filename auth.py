@@ -1,4 +1,8 @@
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
 import jwt
@@ -7,12 +11,88 @@ from flask import g
 from flask import _request_ctx_stack
 
 from error import AuthError
+from jwks import JWKSKeyStore
 
 
 AUTH0_DOMAIN = os.environ.get("AUTH0_DOMAIN", "")
 ALGORITHMS = os.environ.get("AUTH0_ALGORITHMS", "").split(",")
 API_AUDIENCE = os.environ.get("AUTH0_API_AUDIENCE")
 
+# The JWKS url may point to a local stub server or a local
+# jwks.json file (file:// url or plain path) for offline testing.
+JWKS_URL = (
+    os.environ.get("AUTH0_JWKS_URL")
+    or f"https://{AUTH0_DOMAIN}/.well-known/jwks.json"
+)
+JWKS_TTL = int(os.environ.get("AUTH0_JWKS_TTL", "600"))
+
+jwks_store = JWKSKeyStore(JWKS_URL, ttl=JWKS_TTL)
+
+TOKEN_CACHE_SIZE = int(os.environ.get("AUTH_TOKEN_CACHE_SIZE", "1024"))
+
+
+class TokenCache:
+    '''
+    Bounded LRU cache of verified token payloads.
+
+    Entries are keyed by the sha256 hash of the token and are returned
+    only until the exp claim of the token has passed, so that repeated
+    requests with the same token skip the signature verification.
+    Tokens without an exp claim are never cached.
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                exp, payload = entry
+                if exp > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        exp = payload.get("exp")
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (exp, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+        }
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
 
 def get_token_auth_header():
     '''
@@ -78,6 +158,7 @@ def verify_decode_jwt(token):
 
         it should be an Auth0 token with key id (kid)
         it should verify the token using Auth0 /.well-known/jwks.json
+        (the signing keys are cached in jwks_store, see jwks.py)
         it should decode the payload from the token
         it should validate the claims
 
@@ -91,9 +172,13 @@ def verify_decode_jwt(token):
         return jwt.decode(token, "test", algorithms=["HS256"])
     else:
         try:
-            url = f"https://{AUTH0_DOMAIN}/.well-known/jwks.json"
-            jwks_client = jwt.PyJWKClient(url)
-            signing_key = jwks_client.get_signing_key_from_jwt(token)
+            header = jwt.get_unverified_header(token)
+            signing_key = jwks_store.get_signing_key(header.get("kid"))
+            if signing_key is None:
+                raise AuthError({
+                    'code': 'invalid_header',
+                    'description': 'Unable to find appropriate key.'
+                }, 401)
             payload = jwt.decode(
                 token,
                 signing_key.key,
@@ -126,6 +211,40 @@ def verify_decode_jwt(token):
             'description': 'Cannot decode token.'
         }, 400)
 
+
+def load_payload():
+    '''
+    Returns the verified payload of the bearer token of the current
+    request, from token_cache if the token was verified before.
+
+    setup_timing in timing.py replaces this function by one that
+    also measures how long it took, if timing is enabled.
+    '''
+    token = get_token_auth_header()
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = verify_decode_jwt(token)
+        token_cache.put(token, payload)
+    return payload
+
+
+def get_verified_payload():
+    '''
+    Returns the verified payload of the bearer token of the current request.
+
+    The payload and a frozenset of its permissions are kept on g
+    (g.jwt_payload, g.permissions), so that the token is decoded
+    only once per request. Across requests, verified tokens are
+    cached in token_cache until they expire.
+    '''
+
+    if "jwt_payload" not in g:
+        payload = load_payload()
+        g.jwt_payload = payload
+        g.permissions = frozenset(payload.get("permissions", ()))
+    return g.jwt_payload
+
+
 def requires_auth(permission=""):
     '''
         @INPUTS
@@ -133,6 +252,7 @@ def requires_auth(permission=""):
 
         it should use the get_token_auth_header method to get the token
         it should use the verify_decode_jwt method to decode the jwt
+        (through get_verified_payload, which caches the result)
         it should use the check_permissions method validate claims and check the requested permission
         return the decorator which passes the decoded payload to the decorated method
     '''
@@ -140,8 +260,7 @@ def requires_auth(permission=""):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            payload = get_verified_payload()
             check_permissions(permission, payload)
             g.username = payload.get("user-email", "")
             return f(*args, **kwargs)
@@ -154,9 +273,9 @@ def has_permission(permission):
     Checks whether the current user has a permission.
 
     This is similar to the decorator requires_auth, but
-    can be used within functions.
+    can be used within functions. The token is not decoded
+    again if requires_auth already did so for this request.
     """
-    
-    token = get_token_auth_header()
-    payload = verify_decode_jwt(token)
-    return permission in payload["permissions"]
+
+    get_verified_payload()
+    return permission in g.permissions
@@ -0,0 +1,96 @@
+import sys
+import timeit
+
+from flask import Flask
+
+from jsonprovider import StdlibJSONProvider
+from jsonprovider import OrjsonProvider
+from jsonprovider import orjson
+
+# This file provides a micro-benchmark comparing the stdlib and
+# the orjson JSON providers on realistic recipe payloads.
+#
+# Usage: python bench_json.py [<number>]
+
+
+def create_recipe(idx, number_of_ingredients=12):
+    return {
+        "id": idx,
+        "name": f"Recipe number {idx}",
+        "username": "recipe@recipe.dabr.ch",
+        "servings": 4,
+        "ingredients": [
+            {"name": f"gramms of ingredient {jdx}", "amount": 12.5 * jdx}
+            for jdx in range(number_of_ingredients)
+        ],
+        "preparation": "Chop, stir and cook until done.\n" * 40,
+    }
+
+
+def create_payloads():
+    return {
+        "recipe detail": {
+            "success": True,
+            "recipe": create_recipe(1),
+        },
+        "recipe list": {
+            "success": True,
+            "page": 1,
+            "total_pages": 1000,
+            "recipes": [
+                {
+                    "id": idx,
+                    "name": f"Recipe number {idx}",
+                    "username": "recipe@recipe.dabr.ch",
+                }
+                for idx in range(100)
+            ],
+        },
+        "large menu": {
+            "success": True,
+            "menu": {
+                "id": 1,
+                "name": "Festive menu",
+                "username": "menu@recipe.dabr.ch",
+                "number_of_dishes": 50,
+                "dishes": [
+                    {
+                        "id": idx,
+                        "name": f"Recipe number {idx}",
+                        "username": "recipe@recipe.dabr.ch",
+                    }
+                    for idx in range(50)
+                ],
+            },
+        },
+        "export chunk": [create_recipe(idx) for idx in range(500)],
+    }
+
+
+def run(number):
+    app = Flask(__name__)
+    providers = {"stdlib": StdlibJSONProvider(app)}
+    if orjson is not None:
+        providers["orjson"] = OrjsonProvider(app)
+    else:
+        print("orjson is not installed, only the stdlib is measured")
+    for name, payload in create_payloads().items():
+        results = {}
+        for provider_name, provider in providers.items():
+            seconds = min(timeit.repeat(
+                lambda: provider.dumps_bytes(payload),
+                number=number,
+                repeat=5,
+            ))
+            results[provider_name] = seconds / number * 1e6
+        line = ", ".join(
+            f"{provider_name} {microseconds:10.1f} us"
+            for provider_name, microseconds in results.items()
+        )
+        if len(results) == 2:
+            line += f", speedup {results['stdlib'] / results['orjson']:.1f}x"
+        print(f"{name:15} {line}")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,382 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import jwt
+
+from seed import INGREDIENTS
+from seed import DataGenerator
+
+# This file provides a load test of all API routes. It seeds a
+# database through the API with the synthetic data of seed.py,
+# drives every route with a fixed number of requests and reports
+# requests/sec and latency percentiles per route as JSON.
+#
+# By default, the app runs in-process on the sqlite test database
+# (TEST=true). With --url, a running server is load-tested instead;
+# it must run with TEST=true, so that the HS256 test tokens are
+# accepted.
+#
+# A run can be compared against a stored baseline (the JSON written
+# by --output); the exit code is 1 on a regression or on errors.
+#
+# Usage: python bench_routes.py [--recipes N] [--menus N] [--requests N]
+#            [--concurrency N] [--seed N] [--url URL] [--output FILE]
+#            [--baseline FILE] [--tolerance FRACTION]
+
+def create_token(email, permissions):
+    return jwt.encode(
+        {
+            "user-email": email,
+            "permissions": permissions,
+            "exp": int(time.time()) + 3600,
+        },
+        key="test",
+        algorithm="HS256",
+    )
+
+
+class LocalClient:
+    """
+    Sends requests to the app in this process.
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, json=None, headers=None):
+        res = self.client.open(path, method=method, json=json, headers=headers)
+        return res.status_code, res.get_json(silent=True)
+
+
+class RemoteClient:
+    """
+    Sends requests to a running server.
+    """
+
+    def __init__(self, url):
+        import requests
+
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def request(self, method, path, json=None, headers=None):
+        res = self.session.request(
+            method,
+            self.url + path,
+            json=json,
+            headers=headers,
+        )
+        data = None
+        if res.headers.get("Content-Type", "").startswith("application/json"):
+            data = res.json()
+        return res.status_code, data
+
+
+class Benchmark:
+    """
+    The seeded data and the request generators of all routes.
+    """
+
+    def __init__(self, create_client, args):
+        self.create_client = create_client
+        self.args = args
+        self.generator = DataGenerator(args.seed)
+        self.rng = self.generator.rng
+        self.lock = threading.Lock()
+        self.recipe_ids = []
+        self.menu_ids = []
+        self.created_recipe_ids = []
+        self.created_menu_ids = []
+        self.recipe_headers = {"Authorization": "Bearer " + create_token(
+            "bench@recipe.dabr.ch",
+            ["add:recipe", "update:recipe", "delete:recipe"],
+        )}
+        self.menu_headers = {"Authorization": "Bearer " + create_token(
+            "bench@recipe.dabr.ch",
+            ["add:menu", "update:menu", "delete:menu"],
+        )}
+
+    def seed(self):
+        client = self.create_client()
+        recipes = [
+            self.generator.recipe(idx)
+            for idx
+            in range(self.args.recipes)
+        ]
+        for start in range(0, len(recipes), 500):
+            status, data = client.request(
+                "POST",
+                "/recipe/bulk",
+                json=recipes[start:start + 500],
+                headers=self.recipe_headers,
+            )
+            if status != 200:
+                raise RuntimeError(f"Cannot seed recipes: {status} {data}")
+            self.recipe_ids.extend(
+                result["id"]
+                for result
+                in data["results"]
+                if "id" in result
+            )
+        for idx in range(self.args.menus):
+            status, data = client.request(
+                "POST",
+                "/menu",
+                json=self.generate_menu(idx),
+                headers=self.menu_headers,
+            )
+            if status != 200:
+                raise RuntimeError(f"Cannot seed menus: {status} {data}")
+            self.menu_ids.append(data["id"])
+
+    def generate_menu(self, idx):
+        return {
+            "name": f"Menu {idx}",
+            "dishes": [
+                {"recipe_id": recipe_id}
+                for recipe_id
+                in self.rng.sample(self.recipe_ids, min(len(self.recipe_ids), 3))
+            ],
+        }
+
+    def routes(self):
+        """
+        Returns (name, request generator) for every route, in the
+        order they are run. A generator returns the method, path,
+        JSON body and headers of the next request. The generators
+        are called while holding self.lock.
+        """
+        rng = self.rng
+        pages = max(1, len(self.recipe_ids) // 10)
+        return [
+            ("GET /", lambda: ("GET", "/", None, None)),
+            ("GET /recipe", lambda: (
+                "GET", f"/recipe?page={rng.randint(1, pages)}", None, None,
+            )),
+            ("GET /recipe?limit", lambda: (
+                "GET", "/recipe?limit=20", None, None,
+            )),
+            ("GET /recipe/<id>", lambda: (
+                "GET", f"/recipe/{rng.choice(self.recipe_ids)}", None, None,
+            )),
+            ("GET /recipe/search", lambda: (
+                "GET", f"/recipe/search?q={rng.choice(INGREDIENTS).split()[-1]}", None, None,
+            )),
+            ("POST /recipe/match", lambda: (
+                "POST", "/recipe/match",
+                {"ingredients": rng.sample(INGREDIENTS, 5)}, None,
+            )),
+            ("GET /recipe/export", lambda: (
+                "GET", f"/recipe/export?since={rng.choice(self.recipe_ids)}",
+                None, None,
+            )),
+            ("GET /menu", lambda: ("GET", "/menu", None, None)),
+            ("GET /menu?limit", lambda: ("GET", "/menu?limit=20", None, None)),
+            ("GET /menu/<id>", lambda: (
+                "GET", f"/menu/{rng.choice(self.menu_ids)}", None, None,
+            )),
+            ("GET /menu/shopping-list", lambda: (
+                "GET",
+                "/menu/shopping-list?servings=4&ids="
+                + ",".join(map(str, rng.sample(self.menu_ids, min(len(self.menu_ids), 3)))),
+                None, None,
+            )),
+            ("POST /recipe", lambda: (
+                "POST", "/recipe", self.generator.recipe(rng.randint(0, 10 ** 6)),
+                self.recipe_headers,
+            )),
+            ("POST /recipe/bulk", lambda: (
+                "POST", "/recipe/bulk",
+                [self.generator.recipe(idx) for idx in range(20)],
+                self.recipe_headers,
+            )),
+            ("PATCH /recipe/<id>", lambda: (
+                "PATCH", f"/recipe/{rng.choice(self.created_recipe_ids)}",
+                {"servings": rng.randint(1, 8)}, self.recipe_headers,
+            )),
+            ("POST /menu", lambda: (
+                "POST", "/menu", self.generate_menu(rng.randint(0, 10 ** 6)),
+                self.menu_headers,
+            )),
+            ("PATCH /menu/<id>", lambda: (
+                "PATCH", f"/menu/{rng.choice(self.created_menu_ids)}",
+                self.generate_menu(rng.randint(0, 10 ** 6)), self.menu_headers,
+            )),
+            ("DELETE /menu/<id>", lambda: (
+                "DELETE", f"/menu/{pop(self.created_menu_ids)}",
+                None, self.menu_headers,
+            )),
+            ("DELETE /recipe/<id>", lambda: (
+                "DELETE", f"/recipe/{pop(self.created_recipe_ids)}",
+                None, self.recipe_headers,
+            )),
+        ]
+
+    def run_route(self, name, generate):
+        """
+        Sends args.requests requests of one route from args.concurrency
+        threads and returns the statistics.
+        """
+        latencies = []
+        errors = []
+
+        def worker(count):
+            client = self.create_client()
+            for _ in range(count):
+                with self.lock:
+                    method, path, body, headers = generate()
+                start = time.perf_counter()
+                status, data = client.request(method, path, json=body, headers=headers)
+                latencies.append(time.perf_counter() - start)
+                if status >= 400:
+                    errors.append(status)
+                elif name == "POST /recipe":
+                    self.created_recipe_ids.append(data["id"])
+                elif name == "POST /menu":
+                    self.created_menu_ids.append(data["id"])
+
+        concurrency = self.args.concurrency
+        counts = [
+            self.args.requests // concurrency
+            + (1 if idx < self.args.requests % concurrency else 0)
+            for idx
+            in range(concurrency)
+        ]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            for future in [executor.submit(worker, count) for count in counts]:
+                future.result()
+        seconds = time.perf_counter() - start
+        latencies.sort()
+        return {
+            "requests": len(latencies),
+            "errors": len(errors),
+            "rps": round(len(latencies) / seconds, 1),
+            "p50_ms": percentile_ms(latencies, 50),
+            "p95_ms": percentile_ms(latencies, 95),
+            "p99_ms": percentile_ms(latencies, 99),
+        }
+
+    def run(self):
+        self.seed()
+        return {
+            "config": {
+                "recipes": self.args.recipes,
+                "menus": self.args.menus,
+                "requests": self.args.requests,
+                "concurrency": self.args.concurrency,
+                "seed": self.args.seed,
+                "url": self.args.url,
+            },
+            "routes": {
+                name: self.run_route(name, generate)
+                for name, generate
+                in self.routes()
+            },
+        }
+
+
+def pop(ids):
+    return ids.pop() if ids else 0
+
+
+def percentile_ms(sorted_latencies, percent):
+    """
+    Returns the percentile (nearest rank) of the sorted
+    latencies in milliseconds.
+    """
+    if not sorted_latencies:
+        return None
+    rank = max(1, -(-len(sorted_latencies) * percent // 100))
+    return round(sorted_latencies[int(rank) - 1] * 1000, 3)
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Returns a description of every regression of results against
+    baseline: a route whose throughput dropped, or whose p95 latency
+    grew, by more than the tolerance (a fraction, e.g. 0.2).
+    """
+    regressions = []
+    for name, stats in results["routes"].items():
+        base = baseline.get("routes", {}).get(name)
+        if base is None:
+            continue
+        if stats["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {stats['rps']} req/s, baseline {base['rps']} req/s"
+            )
+        if (
+            stats["p95_ms"] is not None
+            and base["p95_ms"] is not None
+            and stats["p95_ms"] > base["p95_ms"] * (1 + tolerance)
+        ):
+            regressions.append(
+                f"{name}: p95 {stats['p95_ms']} ms, baseline {base['p95_ms']} ms"
+            )
+    return regressions
+
+
+def create_local_client_factory():
+    os.environ["TEST"] = "true"
+    from app import app
+    from app import db
+
+    with app.app_context():
+        db.create_all()
+    return lambda: LocalClient(app)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Load test of all API routes")
+    parser.add_argument("--recipes", type=int, default=1000)
+    parser.add_argument("--menus", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--url", help="base url of a running server")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.url:
+        create_client = lambda: RemoteClient(args.url)
+    else:
+        create_client = create_local_client_factory()
+    results = Benchmark(create_client, args).run()
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    failed = False
+    errors = [
+        name
+        for name, stats
+        in results["routes"].items()
+        if stats["errors"]
+    ]
+    if errors:
+        print(f"Routes with errors: {', '.join(errors)}", file=sys.stderr)
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for regression in compare_results(results, baseline, args.tolerance):
+            print(f"Regression: {regression}", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
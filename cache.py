@@ -0,0 +1,622 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+
+# This file provides the caches for encoded response bodies.
+#
+# All backends have the same interface:
+#
+#   get(key)                          -> (body, etag) or None
+#   generation(key)                   -> current generation of key
+#   set(key, body, etag, generation)
+#   invalidate(*keys)
+#   clear()
+#   stats()                           -> dict
+#   mark(key, seconds)
+#   marked(key)                       -> True while the mark is set
+#
+# Invalidation increments the generation counter of a key. An entry
+# is only returned if it was stored with the current generation, so
+# a reader must fetch the generation *before* loading the entity from
+# the database. This way, an entry built from data read before a
+# concurrent write is never served after the write invalidated it.
+#
+# MemoryCache is private to one process. SQLiteCache (a database
+# file, ideally on tmpfs such as /dev/shm) and RedisCache share the
+# entries and the generation counters between all gunicorn workers.
+# NullCache caches nothing.
+#
+# Marks are flags that expire after some seconds, used by replica.py
+# to send the reads of a client that wrote recently to the primary.
+# They are shared like the entries; MemoryCache and NullCache keep
+# them in the process.
+
+
+class Marks:
+    """
+    Marks that expire, kept within one process.
+    """
+
+    def __init__(self):
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def mark(self, key, seconds):
+        if seconds <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._until = {
+                other: until
+                for other, until
+                in self._until.items()
+                if until > now
+            }
+            self._until[key] = now + seconds
+
+    def marked(self, key):
+        until = self._until.get(key)
+        return until is not None and until > time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._until = {}
+
+
+class MemoryCache:
+    """
+    LRU cache of encoded response bodies within one process,
+    limited by the total size of the bodies in bytes.
+
+    Generations are taken from one counter, so that a value is never
+    reused. Only the max_generations most recently invalidated keys
+    keep their own generation, all other keys share the floor, the
+    highest generation dropped so far. Raising the floor makes the
+    entries of these keys misses, which is safe.
+    """
+
+    def __init__(self, max_bytes, max_generations=10000):
+        self.max_bytes = max_bytes
+        self.max_generations = max_generations
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._generations = OrderedDict()
+        self._counter = 0
+        self._floor = 0
+        self._marks = Marks()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != self._generation(key):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def generation(self, key):
+        with self._lock:
+            return self._generation(key)
+
+    def set(self, key, body, etag, generation):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self._generation(key):
+                return
+            self._remove(key)
+            self._entries[key] = (generation, body, etag)
+            self.size_bytes += len(body)
+            while self.size_bytes > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._counter += 1
+                self._generations.pop(key, None)
+                self._generations[key] = self._counter
+                self._remove(key)
+            while len(self._generations) > self.max_generations:
+                _, generation = self._generations.popitem(last=False)
+                self._floor = max(self._floor, generation)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            # readers that loaded before the clear must not store
+            self._counter += 1
+            self._floor = self._counter
+            self.size_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+        self._marks.clear()
+
+    def mark(self, key, seconds):
+        self._marks.mark(key, seconds)
+
+    def marked(self, key):
+        return self._marks.marked(key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+        }
+
+    def _generation(self, key):
+        return self._generations.get(key, self._floor)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= len(entry[1])
+
+
+class SQLiteCache:
+    """
+    Cache stored in a SQLite database file shared by all worker
+    processes on one host. Put the file on a tmpfs (e.g. /dev/shm)
+    so that it never touches the disk.
+
+    The total size is limited to max_bytes, the oldest entries
+    are evicted first. Hits and misses are counted per process.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS entries ("
+        " key TEXT PRIMARY KEY, generation INTEGER NOT NULL,"
+        " body BLOB NOT NULL, etag TEXT NOT NULL, size INTEGER NOT NULL,"
+        " created REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_entries_created ON entries (created)",
+        "CREATE TABLE IF NOT EXISTS generations ("
+        " key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS counters ("
+        " name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS marks ("
+        " key TEXT PRIMARY KEY, until REAL NOT NULL)",
+    )
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        with self._connection() as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+    def _connection(self):
+        # connections must not be shared between threads,
+        # nor survive the fork of the gunicorn workers
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT e.body, e.etag FROM entries e"
+            " LEFT JOIN generations g ON g.key = e.key"
+            " WHERE e.key = ? AND e.generation = COALESCE(g.value, 0)",
+            (key,),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return bytes(row[0]), row[1]
+
+    def generation(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM generations WHERE key = ?",
+            (key,),
+        ).fetchone()
+        return row[0] if row else 0
+
+    def set(self, key, body, etag, generation):
+        if len(body) > self.max_bytes:
+            return
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries"
+                " SELECT ?, ?, ?, ?, ?, ?"
+                " WHERE ? = COALESCE("
+                "  (SELECT value FROM generations WHERE key = ?), 0)",
+                (
+                    key, generation, body, etag, len(body), time.time(),
+                    generation, key,
+                ),
+            )
+            total = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()[0]
+            while total > self.max_bytes:
+                oldest_key, size = connection.execute(
+                    "SELECT key, size FROM entries ORDER BY created LIMIT 1"
+                ).fetchone()
+                connection.execute(
+                    "DELETE FROM entries WHERE key = ?",
+                    (oldest_key,),
+                )
+                self._count(connection, "evictions")
+                total -= size
+
+    def invalidate(self, *keys):
+        with self._connection() as connection:
+            for key in keys:
+                connection.execute(
+                    "INSERT INTO generations VALUES (?, 1)"
+                    " ON CONFLICT (key) DO UPDATE SET value = value + 1",
+                    (key,),
+                )
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM entries")
+            connection.execute("DELETE FROM generations")
+            connection.execute("DELETE FROM counters")
+            connection.execute("DELETE FROM marks")
+        self.hits = 0
+        self.misses = 0
+
+    def mark(self, key, seconds):
+        if seconds <= 0:
+            return
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute("DELETE FROM marks WHERE until <= ?", (now,))
+            connection.execute(
+                "INSERT OR REPLACE INTO marks VALUES (?, ?)",
+                (key, now + seconds),
+            )
+
+    def marked(self, key):
+        row = self._connection().execute(
+            "SELECT 1 FROM marks WHERE key = ? AND until > ?",
+            (key, time.time()),
+        ).fetchone()
+        return row is not None
+
+    def stats(self):
+        connection = self._connection()
+        entries, size_bytes = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        row = connection.execute(
+            "SELECT value FROM counters WHERE name = 'evictions'"
+        ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": row[0] if row else 0,
+            "entries": entries,
+            "size_bytes": size_bytes,
+        }
+
+    @staticmethod
+    def _count(connection, name):
+        connection.execute(
+            "INSERT INTO counters VALUES (?, 1)"
+            " ON CONFLICT (name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    """
+    Minimal client for the Redis protocol (RESP), sufficient
+    for the few commands the RedisCache needs.
+    """
+
+    def __init__(self, host, port, db=0, password=None, timeout=2):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.command("AUTH", password)
+        if db:
+            self.command("SELECT", db)
+
+    def command(self, *args):
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        """
+        Sends several commands at once and returns their replies.
+        """
+        data = bytearray()
+        for args in commands:
+            data += b"*%d\r\n" % len(args)
+            for arg in args:
+                if not isinstance(arg, bytes):
+                    arg = str(arg).encode("utf-8")
+                data += b"$%d\r\n%s\r\n" % (len(arg), arg)
+        self.sock.sendall(data)
+        return [self._read_reply() for _ in commands]
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise RedisError("Connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise RedisError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply {line!r}")
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class RedisCache:
+    """
+    Cache stored in Redis (or any server speaking the Redis protocol),
+    shared by all workers on all hosts.
+
+    Entries expire after ttl seconds. Bodies larger than max_bytes are
+    not cached, the total memory limit is left to the maxmemory policy
+    of the server. Hits and misses are counted per process.
+
+    If the server cannot be reached, the error is logged and the cache
+    behaves as if empty for retry_seconds before it tries again, so
+    that the requests are served from the database. Invalidations that
+    failed are kept and sent before the next command of the process.
+    """
+
+    def __init__(self, url, max_bytes, ttl=3600, prefix="recipe-service",
+                 retry_seconds=5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.password = parsed.password
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.prefix = prefix
+        self.retry_seconds = retry_seconds
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._down_until = 0
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = RedisConnection(
+                self.host,
+                self.port,
+                self.db,
+                self.password,
+            )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _pipeline(self, commands):
+        try:
+            return self._connection().pipeline(commands)
+        except (OSError, RedisError):
+            # reconnect once, e.g. after the server closed the connection
+            self._local.connection = None
+            return self._connection().pipeline(commands)
+
+    def _run(self, commands, default=None):
+        """
+        Runs the commands, preceded by the pending invalidations,
+        and returns their replies, or default if the server
+        cannot be reached.
+        """
+        if time.monotonic() < self._down_until:
+            return default
+        with self._lock:
+            pending = self._pending
+            self._pending = set()
+        invalidations = self._invalidate_commands(pending)
+        try:
+            replies = self._pipeline(invalidations + commands)
+        except (OSError, RedisError) as error:
+            self._local.connection = None
+            with self._lock:
+                self._pending |= pending
+                self._down_until = time.monotonic() + self.retry_seconds
+                self.errors += 1
+            logging.warning("Redis cache unavailable: %s", error)
+            return default
+        return replies[len(invalidations):]
+
+    def _invalidate_commands(self, keys):
+        commands = []
+        for key in keys:
+            commands.append(("INCR", self._generation_key(key)))
+            commands.append(("DEL", self._entry_key(key)))
+        return commands
+
+    def _entry_key(self, key):
+        return f"{self.prefix}:entry:{key}"
+
+    def _generation_key(self, key):
+        return f"{self.prefix}:generation:{key}"
+
+    def _mark_key(self, key):
+        return f"{self.prefix}:mark:{key}"
+
+    def get(self, key):
+        replies = self._run([
+            ("MGET", self._generation_key(key), self._entry_key(key)),
+        ])
+        if replies is not None:
+            generation, entry = replies[0]
+            if entry is not None:
+                entry_generation, etag, body = entry.split(b"\n", 2)
+                if int(entry_generation) == int(generation or 0):
+                    self.hits += 1
+                    return body, etag.decode("utf-8")
+        self.misses += 1
+        return None
+
+    def generation(self, key):
+        """
+        Returns the generation of the key, or None if the server
+        cannot be reached (set() ignores entries of generation None).
+        """
+        replies = self._run([("GET", self._generation_key(key))])
+        if replies is None:
+            return None
+        return int(replies[0] or 0)
+
+    def set(self, key, body, etag, generation):
+        if generation is None or len(body) > self.max_bytes:
+            return
+        value = f"{generation}\n{etag}\n".encode("utf-8") + body
+        self._run([
+            ("SET", self._entry_key(key), value, "EX", self.ttl),
+        ])
+
+    def invalidate(self, *keys):
+        if not keys:
+            return
+        if self._run(self._invalidate_commands(keys)) is None:
+            # retried before the next command, until then other
+            # workers may still serve the invalidated entries
+            with self._lock:
+                self._pending.update(keys)
+
+    def clear(self):
+        cursor = b"0"
+        while True:
+            replies = self._run([
+                ("SCAN", cursor, "MATCH", f"{self.prefix}:*", "COUNT", 1000),
+            ])
+            if replies is None:
+                break
+            cursor, keys = replies[0]
+            if keys:
+                self._run([("DEL", *keys)])
+            if cursor in (b"0", 0):
+                break
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def mark(self, key, seconds):
+        milliseconds = int(seconds * 1000)
+        if milliseconds <= 0:
+            return
+        self._run([("SET", self._mark_key(key), 1, "PX", milliseconds)])
+
+    def marked(self, key):
+        """
+        Returns whether the key is marked, False if the
+        server cannot be reached.
+        """
+        replies = self._run([("EXISTS", self._mark_key(key))])
+        return bool(replies and replies[0])
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "pending_invalidations": len(self._pending),
+        }
+
+
+class NullCache:
+    """
+    Cache that stores nothing, used if the cache is disabled.
+    Only the marks are kept, within the process.
+    """
+
+    def __init__(self):
+        self._marks = Marks()
+
+    def get(self, key):
+        return None
+
+    def generation(self, key):
+        return 0
+
+    def set(self, key, body, etag, generation):
+        pass
+
+    def invalidate(self, *keys):
+        pass
+
+    def clear(self):
+        self._marks.clear()
+
+    def mark(self, key, seconds):
+        self._marks.mark(key, seconds)
+
+    def marked(self, key):
+        return self._marks.marked(key)
+
+    def stats(self):
+        return {}
+
+
+def create_cache(url, max_bytes):
+    """
+    Creates the cache backend configured by url:
+
+    memory://                     cache within each process
+    sqlite:////dev/shm/cache.db   cache shared by the processes on a host
+    redis://host:6379/0           cache shared through a redis server
+
+    If max_bytes is 0, the cache is disabled.
+    """
+    if max_bytes <= 0:
+        return NullCache()
+    if url.startswith("sqlite://"):
+        return SQLiteCache(url.removeprefix("sqlite://").removeprefix("/"), max_bytes)
+    if url.startswith("redis://"):
+        return RedisCache(url, max_bytes)
+    if url.startswith("memory://"):
+        return MemoryCache(max_bytes)
+    raise ValueError(f"Unknown cache url {url}")
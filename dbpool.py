@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import QueuePool
+
+
+# This file provides the configuration of the database connection
+# pool and the measurement of the time spent waiting for connections.
+#
+# The pool is configured by environment variables (see the README):
+#
+#   DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+#   DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_EXTERNAL_POOLER
+#
+# With DB_EXTERNAL_POOLER=true (e.g. behind PgBouncer), connections are
+# not pooled by the application: every checkout opens a new connection
+# to the pooler and closes it afterwards.
+
+
+class PoolMetrics:
+    """
+    Counts the connection checkouts of this process, the time spent
+    waiting for them and the checkouts that timed out.
+
+    Every checkout is also passed to the observers, callables taking
+    the seconds waited and whether the checkout timed out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.observers = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def record(self, seconds, timeout=False):
+        with self._lock:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+        for observer in self.observers:
+            observer(seconds, timeout)
+
+    def stats(self):
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+        }
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedPoolMixin:
+    """
+    Records the time every checkout takes in pool_metrics, including
+    waiting for a free connection and opening a new one.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.record(time.perf_counter() - start, timeout=True)
+            raise
+        pool_metrics.record(time.perf_counter() - start)
+        return connection
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedNullPool(TimedPoolMixin, NullPool):
+    pass
+
+
+def get_bool(environ, name, default):
+    value = environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_engine_options(database_url, environ=None):
+    """
+    Returns the SQLALCHEMY_ENGINE_OPTIONS for database_url
+    as configured by the environment.
+
+    The pool sizes only apply to server databases. For sqlite
+    (the tests), the default pool of the dialect is kept.
+    """
+    if environ is None:
+        environ = os.environ
+    options = {
+        "pool_pre_ping": get_bool(environ, "DB_POOL_PRE_PING", True),
+        "pool_recycle": int(environ.get("DB_POOL_RECYCLE", "1800")),
+    }
+    if get_bool(environ, "DB_EXTERNAL_POOLER", False):
+        options["poolclass"] = TimedNullPool
+    elif not database_url.startswith("sqlite"):
+        options["poolclass"] = TimedQueuePool
+        options["pool_size"] = int(environ.get("DB_POOL_SIZE", "5"))
+        options["max_overflow"] = int(environ.get("DB_MAX_OVERFLOW", "10"))
+        options["pool_timeout"] = float(environ.get("DB_POOL_TIMEOUT", "30"))
+    return options
+
+
+def pool_stats(engine):
+    """
+    Returns the state of the connection pool of engine
+    together with the checkout metrics of this process.
+    """
+    stats = pool_metrics.stats()
+    pool = engine.pool
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        })
+    return stats
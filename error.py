@@ -1,4 +1,5 @@
 from flask import abort
+from flask import g
 from flask import jsonify
 
 
@@ -79,6 +80,8 @@ def setup_error_handlers(app):
 
     @app.errorhandler(AuthError)
     def auth_error(error):
+        # counted by the metrics, see metrics.py
+        g.auth_error = error
         return generic_error(error.status_code, error.error)
 
 
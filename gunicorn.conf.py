@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+
+from prometheus_client import multiprocess
+
+
+# gunicorn loads this file before it starts the workers.
+#
+# The workers share their Prometheus metrics through files in
+# PROMETHEUS_MULTIPROC_DIR (see metrics.py). The directory is emptied
+# when the server starts, so that no metrics of a previous run remain,
+# and the files of a worker that exits are marked as dead, so that
+# its gauges are no longer summed.
+#
+# The response cache defaults to a SQLite file shared by the workers
+# (on /dev/shm if available), since the invalidations of a per-process
+# memory:// cache would not reach the other workers. The default file
+# is deleted when the server starts, so that no entries of a previous
+# run remain.
+
+metrics_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR",
+    os.path.join(tempfile.gettempdir(), "recipe-service-metrics"),
+)
+
+cache_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+default_cache_path = os.path.join(cache_dir, "recipe-service-cache.db")
+cache_url = os.environ.setdefault(
+    "RESPONSE_CACHE_URL",
+    f"sqlite:///{default_cache_path}",
+)
+
+
+def on_starting(server):
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+    if cache_url == f"sqlite:///{default_cache_path}":
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(default_cache_path + suffix):
+                os.remove(default_cache_path + suffix)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,66 @@
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    """
+    Flask's default JSON provider (stdlib json module),
+    extended by dumps_bytes.
+    """
+
+    def dumps_bytes(self, obj):
+        return self.dumps(obj).encode("utf-8")
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider using orjson, which encodes directly to bytes
+    and is considerably faster than the stdlib json module.
+
+    Like the default provider, keys are sorted and the default
+    provider's fallback is used for types orjson does not know.
+    """
+
+    def _options(self):
+        options = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps_bytes(self, obj):
+        return orjson.dumps(obj, default=self.default, option=self._options())
+
+    def dumps(self, obj, **kwargs):
+        return self.dumps_bytes(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            self.dumps_bytes(obj) + b"\n",
+            mimetype=self.mimetype,
+        )
+
+
+def setup_json_provider(app):
+    """
+    Installs the JSON provider selected by the environment variable
+    JSON_PROVIDER: "orjson", "stdlib" or "auto" (the default), which
+    uses orjson if it is installed and the stdlib otherwise.
+    """
+    name = os.environ.get("JSON_PROVIDER", "auto")
+    if name == "stdlib" or (name == "auto" and orjson is None):
+        app.json = StdlibJSONProvider(app)
+    elif orjson is None:
+        raise RuntimeError("JSON_PROVIDER is orjson, but orjson is not installed")
+    else:
+        app.json = OrjsonProvider(app)
+    return app.json
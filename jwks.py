@@ -0,0 +1,152 @@
+import json
+import logging
+import threading
+import time
+import urllib.request
+
+import jwt
+
+
+class JWKSKeyStore:
+    """
+    Process-wide cache of the JWKS signing keys, keyed by kid.
+
+    The keys are loaded from url, which is either an http(s) url
+    (Auth0 or a local stub server) or a file:// url or plain path
+    to a local jwks.json file.
+
+    Keys are kept for ttl seconds. After refresh_ahead * ttl seconds
+    the next lookup starts a refresh in a background thread, so that
+    requests normally never wait for the network. An unknown kid
+    forces one synchronous refetch (at most every min_refetch_interval
+    seconds), so that key rotation is picked up immediately.
+
+    If a fetch fails, the stale keys are served and the next fetch is
+    only tried after retry_interval seconds, so that an outage of the
+    key source does not block every request for the timeout.
+    """
+
+    def __init__(
+        self,
+        url,
+        ttl=600,
+        refresh_ahead=0.8,
+        min_refetch_interval=30,
+        retry_interval=30,
+        timeout=5,
+    ):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.min_refetch_interval = min_refetch_interval
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._failed_at = None
+        self._last_forced_refetch = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    def load(self):
+        """
+        Loads the key set from the configured source and returns
+        a dict mapping kid to jwt.PyJWK.
+        """
+        if self.url.startswith("file://") or "://" not in self.url:
+            path = self.url.removeprefix("file://")
+            with open(path) as infile:
+                data = json.load(infile)
+        else:
+            with urllib.request.urlopen(self.url, timeout=self.timeout) as response:
+                data = json.load(response)
+        self.fetch_count += 1
+        return {
+            key.key_id: key
+            for key
+            in jwt.PyJWKSet.from_dict(data).keys
+        }
+
+    def refresh(self):
+        """
+        Fetches the keys and replaces the cached key set, unless
+        another thread fetched them while this one waited, or failed
+        to while stale keys are available.
+        """
+        requested = time.monotonic()
+        with self._fetch_lock:
+            if self._fetched_at is not None and self._fetched_at >= requested:
+                return
+            if (
+                self._keys
+                and self._failed_at is not None
+                and self._failed_at >= requested
+            ):
+                return
+            try:
+                keys = self.load()
+            except Exception:
+                self._failed_at = time.monotonic()
+                raise
+            with self._lock:
+                self._keys = keys
+                self._fetched_at = time.monotonic()
+                self._failed_at = None
+
+    def get_signing_key(self, kid):
+        """
+        Returns the jwt.PyJWK for kid or None if the key is unknown
+        even after a forced refetch.
+        """
+        now = time.monotonic()
+        age = None if self._fetched_at is None else now - self._fetched_at
+        if not self._may_retry(now):
+            # the last fetch failed, keep the stale keys for now
+            pass
+        elif age is None or age >= self.ttl:
+            self._refresh_or_keep_stale()
+        elif age >= self.ttl * self.refresh_ahead:
+            self._refresh_in_background()
+        key = self._keys.get(kid)
+        if key is None and (
+            self._last_forced_refetch is None
+            or now - self._last_forced_refetch >= self.min_refetch_interval
+        ):
+            self._last_forced_refetch = now
+            self._refresh_or_keep_stale()
+            key = self._keys.get(kid)
+        return key
+
+    def _may_retry(self, now):
+        # without keys there is nothing stale to serve
+        return (
+            not self._keys
+            or self._failed_at is None
+            or now - self._failed_at >= self.retry_interval
+        )
+
+    def _refresh_or_keep_stale(self):
+        try:
+            self.refresh()
+        except Exception:
+            if not self._keys:
+                raise
+            logging.exception("Cannot refresh JWKS keys, keeping stale keys")
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logging.exception("Cannot refresh JWKS keys in background")
+        finally:
+            with self._lock:
+                self._refreshing = False
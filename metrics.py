@@ -0,0 +1,240 @@
+import os
+import threading
+import time
+
+from flask import g
+from flask import request
+from flask import Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import REGISTRY
+from prometheus_client import CollectorRegistry
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client import generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy.pool import QueuePool
+
+from dbpool import pool_metrics
+
+
+# This file provides the /metrics endpoint in the Prometheus text format.
+#
+# It exposes the latency of every route by method and status, the
+# requests in progress, the state of the database connection pool,
+# the requests rejected with an AuthError and the hit rates and sizes
+# of the caches (response cache and token cache).
+#
+# With gunicorn, every worker is a separate process. If the environment
+# variable PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py), the
+# workers write their metrics to files in this directory and /metrics
+# aggregates the files of all workers, no matter which worker serves
+# the scrape. The variable must be set before this module is imported.
+
+METRICS_PATH = "/metrics"
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+CHECKOUT_BUCKETS = (
+    0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0,
+)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Latency of the HTTP requests",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "HTTP requests currently being served",
+    ["method", "route"],
+    multiprocess_mode="livesum",
+)
+AUTH_FAILURES = Counter(
+    "auth_failures",
+    "Requests rejected with an AuthError",
+    ["code", "status"],
+)
+POOL_CONNECTIONS = Gauge(
+    "db_pool_connections",
+    "Connections of the database pool by state",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_seconds",
+    "Time taken to check out a database connection",
+    buckets=CHECKOUT_BUCKETS,
+)
+POOL_CHECKOUT_TIMEOUTS = Counter(
+    "db_pool_checkout_timeouts",
+    "Database connection checkouts that timed out",
+)
+CACHE_COUNTERS = {
+    "hits": Counter("cache_hits", "Cache lookups that found an entry", ["cache"]),
+    "misses": Counter("cache_misses", "Cache lookups that found no entry", ["cache"]),
+    "errors": Counter("cache_errors", "Cache backend errors", ["cache"]),
+}
+
+
+class CacheMetrics:
+    """
+    Exports the statistics of the caches, a dict from name to cache.
+
+    The hits, misses and errors a cache counted since the last update
+    are added to Prometheus counters after every request, so that the
+    counts of all workers are summed. The sizes are collected from
+    stats() when /metrics is scraped, thus are those of the worker
+    serving the scrape (or of all workers for a shared cache).
+    """
+
+    # stats() keys exported as gauges, and their metric names
+    GAUGES = {
+        "entries": "cache_entries",
+        "size": "cache_entries",
+        "size_bytes": "cache_size_bytes",
+        "pending_invalidations": "cache_pending_invalidations",
+    }
+
+    def __init__(self):
+        self.caches = {}
+        self._counted = {}
+        self._lock = threading.Lock()
+
+    def update_counters(self):
+        with self._lock:
+            for name, cache in self.caches.items():
+                for attribute, counter in CACHE_COUNTERS.items():
+                    value = getattr(cache, attribute, 0)
+                    counted = self._counted.get((name, attribute), 0)
+                    # the counts restart at 0 when the cache is cleared
+                    if value < counted:
+                        counted = 0
+                    if value > counted:
+                        counter.labels(name).inc(value - counted)
+                    self._counted[(name, attribute)] = value
+
+    def collect(self):
+        gauges = {}
+        evictions = CounterMetricFamily(
+            "cache_evictions",
+            "Cache entries evicted to stay within the size limit",
+            labels=["cache"],
+        )
+        for name, cache in self.caches.items():
+            for key, value in cache.stats().items():
+                if key == "evictions":
+                    evictions.add_metric([name], value)
+                elif key in self.GAUGES:
+                    metric = self.GAUGES[key]
+                    if metric not in gauges:
+                        gauges[metric] = GaugeMetricFamily(
+                            metric,
+                            f"Cache {key.replace('_', ' ')}",
+                            labels=["cache"],
+                        )
+                    gauges[metric].add_metric([name], value)
+        yield from gauges.values()
+        yield evictions
+
+
+cache_metrics = CacheMetrics()
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    REGISTRY.register(cache_metrics)
+
+
+def get_route():
+    """
+    Returns the url rule of the request (e.g. /recipe/<int:id>), so
+    that the number of label values stays bounded.
+    """
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+def observe_checkout(seconds, timeout):
+    if timeout:
+        POOL_CHECKOUT_TIMEOUTS.inc()
+    else:
+        POOL_CHECKOUT_WAIT.observe(seconds)
+
+
+def update_pool_gauges(engine):
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return
+    POOL_CONNECTIONS.labels("checked_out").set(pool.checkedout())
+    POOL_CONNECTIONS.labels("checked_in").set(pool.checkedin())
+    # overflow() is negative while the pool is not yet filled
+    POOL_CONNECTIONS.labels("overflow").set(max(0, pool.overflow()))
+
+
+def get_registry():
+    """
+    Returns the registry to collect: the metrics of all
+    workers in multiprocess mode, else of this process.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(cache_metrics)
+    return registry
+
+
+def setup_metrics(app, db=None, caches=None):
+    """
+    Installs the request hooks and the /metrics route. The pool
+    gauges are only updated if the database (Flask-SQLAlchemy)
+    is given, caches is a dict from name to cache to export.
+    """
+    if observe_checkout not in pool_metrics.observers:
+        pool_metrics.observers.append(observe_checkout)
+    cache_metrics.caches.update(caches or {})
+
+    @app.before_request
+    def start_metrics():
+        if request.path == METRICS_PATH:
+            return
+        g.metrics_start = time.perf_counter()
+        g.metrics_route = get_route()
+        REQUESTS_IN_PROGRESS.labels(request.method, g.metrics_route).inc()
+
+    @app.after_request
+    def record_metrics(response):
+        start = g.get("metrics_start")
+        if start is None:
+            return response
+        REQUEST_LATENCY.labels(
+            request.method,
+            g.metrics_route,
+            str(response.status_code),
+        ).observe(time.perf_counter() - start)
+        error = g.get("auth_error")
+        if error is not None:
+            AUTH_FAILURES.labels(
+                error.error.get("code", "unknown"),
+                str(error.status_code),
+            ).inc()
+        if db is not None:
+            update_pool_gauges(db.engine)
+        cache_metrics.update_counters()
+        return response
+
+    @app.teardown_request
+    def finish_metrics(exception):
+        # also runs if the request failed without a response
+        if g.pop("metrics_start", None) is not None:
+            REQUESTS_IN_PROGRESS.labels(request.method, g.metrics_route).dec()
+
+    @app.route(METRICS_PATH)
+    def metrics():
+        return Response(
+            generate_latest(get_registry()),
+            headers={"Content-Type": CONTENT_TYPE_LATEST},
+        )
@@ -0,0 +1,32 @@
+"""Add version columns
+
+Revision ID: 4f7e0a6c2d18
+Revises: 9c41d2e7a5b3
+Create Date: 2026-10-16 11:03:27.904415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f7e0a6c2d18'
+down_revision = '9c41d2e7a5b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('recipe', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+    with op.batch_alter_table('menu', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('menu', schema=None) as batch_op:
+        batch_op.drop_column('version')
+
+    with op.batch_alter_table('recipe', schema=None) as batch_op:
+        batch_op.drop_column('version')
@@ -0,0 +1,50 @@
+"""Add secondary indexes
+
+Revision ID: 9c41d2e7a5b3
+Revises: 0b9402c08c78
+Create Date: 2026-10-16 09:12:41.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c41d2e7a5b3'
+down_revision = '0b9402c08c78'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_ingredient_recipe_id', 'ingredient', ['recipe_id']),
+    ('ix_menu_recipe_table_recipe_id', 'menu_recipe_table', ['recipe_id']),
+    ('ix_recipe_name_id', 'recipe', ['name', 'id']),
+    ('ix_recipe_username', 'recipe', ['username']),
+    ('ix_menu_name_id', 'menu', ['name', 'id']),
+]
+
+
+def upgrade():
+    # On postgresql the indexes are built concurrently, so that the
+    # tables are not locked during deployment. CREATE INDEX CONCURRENTLY
+    # cannot run inside a transaction, hence the autocommit block.
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                unique=False,
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(
+                name,
+                table_name=table,
+                postgresql_concurrently=True,
+            )
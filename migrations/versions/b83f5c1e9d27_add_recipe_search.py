@@ -0,0 +1,190 @@
+"""Add recipe search
+
+Revision ID: b83f5c1e9d27
+Revises: 4f7e0a6c2d18
+Create Date: 2026-10-16 13:47:05.221630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b83f5c1e9d27'
+down_revision = '4f7e0a6c2d18'
+branch_labels = None
+depends_on = None
+
+
+POSTGRES_UPGRADE = [
+    "ALTER TABLE recipe ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    """
+    CREATE OR REPLACE FUNCTION recipe_search_vector(
+        p_recipe_id integer, p_name text, p_preparation text
+    ) RETURNS tsvector AS $$
+        SELECT setweight(to_tsvector('english', coalesce(p_name, '')), 'A')
+            || setweight(to_tsvector('english', coalesce((
+                SELECT string_agg(i.name, ' ')
+                FROM ingredient i
+                WHERE i.recipe_id = p_recipe_id
+            ), '')), 'B')
+            || setweight(to_tsvector('english', coalesce(p_preparation, '')), 'C')
+    $$ LANGUAGE sql STABLE
+    """,
+    """
+    CREATE OR REPLACE FUNCTION recipe_search_trigger() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := recipe_search_vector(NEW.id, NEW.name, NEW.preparation);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS recipe_search_update ON recipe",
+    """
+    CREATE TRIGGER recipe_search_update
+    BEFORE INSERT OR UPDATE OF name, preparation ON recipe
+    FOR EACH ROW EXECUTE FUNCTION recipe_search_trigger()
+    """,
+    """
+    CREATE OR REPLACE FUNCTION ingredient_search_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE recipe
+            SET search_vector = recipe_search_vector(id, name, preparation)
+            WHERE id = OLD.recipe_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            UPDATE recipe
+            SET search_vector = recipe_search_vector(id, name, preparation)
+            WHERE id = NEW.recipe_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS ingredient_search_update ON ingredient",
+    """
+    CREATE TRIGGER ingredient_search_update
+    AFTER INSERT OR UPDATE OR DELETE ON ingredient
+    FOR EACH ROW EXECUTE FUNCTION ingredient_search_trigger()
+    """,
+    "UPDATE recipe SET search_vector = recipe_search_vector(id, name, preparation)",
+]
+
+POSTGRES_DOWNGRADE = [
+    "DROP TRIGGER IF EXISTS ingredient_search_update ON ingredient",
+    "DROP TRIGGER IF EXISTS recipe_search_update ON recipe",
+    "DROP FUNCTION IF EXISTS ingredient_search_trigger()",
+    "DROP FUNCTION IF EXISTS recipe_search_trigger()",
+    "DROP FUNCTION IF EXISTS recipe_search_vector(integer, text, text)",
+    "DROP INDEX IF EXISTS ix_recipe_search_vector",
+    "ALTER TABLE recipe DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_INGREDIENT_NAMES = (
+    "(SELECT coalesce(group_concat(name, ' '), '')"
+    " FROM ingredient WHERE recipe_id = {recipe_id})"
+)
+
+SQLITE_UPGRADE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS recipe_search"
+    " USING fts5(name, ingredients, preparation, tokenize = 'porter unicode61')",
+    """
+    CREATE TRIGGER IF NOT EXISTS recipe_search_insert AFTER INSERT ON recipe
+    BEGIN
+        INSERT INTO recipe_search (rowid, name, ingredients, preparation)
+        VALUES (new.id, new.name, '', coalesce(new.preparation, ''));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS recipe_search_update
+    AFTER UPDATE OF name, preparation ON recipe
+    BEGIN
+        UPDATE recipe_search
+        SET name = new.name, preparation = coalesce(new.preparation, '')
+        WHERE rowid = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS recipe_search_delete AFTER DELETE ON recipe
+    BEGIN
+        DELETE FROM recipe_search WHERE rowid = old.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS ingredient_search_insert
+    AFTER INSERT ON ingredient
+    BEGIN
+        UPDATE recipe_search
+        SET ingredients = {SQLITE_INGREDIENT_NAMES.format(recipe_id="new.recipe_id")}
+        WHERE rowid = new.recipe_id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS ingredient_search_update
+    AFTER UPDATE ON ingredient
+    BEGIN
+        UPDATE recipe_search
+        SET ingredients = {SQLITE_INGREDIENT_NAMES.format(recipe_id="old.recipe_id")}
+        WHERE rowid = old.recipe_id;
+        UPDATE recipe_search
+        SET ingredients = {SQLITE_INGREDIENT_NAMES.format(recipe_id="new.recipe_id")}
+        WHERE rowid = new.recipe_id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS ingredient_search_delete
+    AFTER DELETE ON ingredient
+    BEGIN
+        UPDATE recipe_search
+        SET ingredients = {SQLITE_INGREDIENT_NAMES.format(recipe_id="old.recipe_id")}
+        WHERE rowid = old.recipe_id;
+    END
+    """,
+    f"""
+    INSERT INTO recipe_search (rowid, name, ingredients, preparation)
+    SELECT id, name,
+        {SQLITE_INGREDIENT_NAMES.format(recipe_id="recipe.id")},
+        coalesce(preparation, '')
+    FROM recipe
+    """,
+]
+
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER IF EXISTS ingredient_search_delete",
+    "DROP TRIGGER IF EXISTS ingredient_search_update",
+    "DROP TRIGGER IF EXISTS ingredient_search_insert",
+    "DROP TRIGGER IF EXISTS recipe_search_delete",
+    "DROP TRIGGER IF EXISTS recipe_search_update",
+    "DROP TRIGGER IF EXISTS recipe_search_insert",
+    "DROP TABLE IF EXISTS recipe_search",
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        statements = POSTGRES_UPGRADE
+    else:
+        statements = SQLITE_UPGRADE
+    for statement in statements:
+        op.execute(statement)
+    if op.get_bind().dialect.name == 'postgresql':
+        # built concurrently (outside of the transaction),
+        # so that the recipe table is not locked
+        with op.get_context().autocommit_block():
+            op.create_index(
+                'ix_recipe_search_vector',
+                'recipe',
+                ['search_vector'],
+                postgresql_using='gin',
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        statements = POSTGRES_DOWNGRADE
+    else:
+        statements = SQLITE_DOWNGRADE
+    for statement in statements:
+        op.execute(statement)
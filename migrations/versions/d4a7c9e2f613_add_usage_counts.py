@@ -0,0 +1,44 @@
+"""Add usage counts
+
+Revision ID: d4a7c9e2f613
+Revises: b83f5c1e9d27
+Create Date: 2026-10-16 23:18:42.507316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7c9e2f613'
+down_revision = 'b83f5c1e9d27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('recipe', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('menu_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('menu', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('dish_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill, from then on maintained by the menu routes
+    op.execute(
+        "UPDATE recipe SET menu_count = ("
+        "SELECT count(*) FROM menu_recipe_table"
+        " WHERE menu_recipe_table.recipe_id = recipe.id)"
+    )
+    op.execute(
+        "UPDATE menu SET dish_count = ("
+        "SELECT count(*) FROM menu_recipe_table"
+        " WHERE menu_recipe_table.menu_id = menu.id)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('menu', schema=None) as batch_op:
+        batch_op.drop_column('dish_count')
+
+    with op.batch_alter_table('recipe', schema=None) as batch_op:
+        batch_op.drop_column('menu_count')
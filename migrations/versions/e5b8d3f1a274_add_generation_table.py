@@ -0,0 +1,28 @@
+"""Add generation table
+
+Revision ID: e5b8d3f1a274
+Revises: d4a7c9e2f613
+Create Date: 2026-10-16 23:52:07.184930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8d3f1a274'
+down_revision = 'd4a7c9e2f613'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('generation',
+    sa.Column('key', sa.String(length=64), nullable=False),
+    sa.Column('value', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade():
+    op.drop_table('generation')
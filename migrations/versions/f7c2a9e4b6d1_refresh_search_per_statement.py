@@ -0,0 +1,109 @@
+"""Refresh search per statement
+
+Revision ID: f7c2a9e4b6d1
+Revises: e5b8d3f1a274
+Create Date: 2026-10-17 00:21:36.802417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7c2a9e4b6d1'
+down_revision = 'e5b8d3f1a274'
+branch_labels = None
+depends_on = None
+
+
+# replaces the ingredient trigger of b83f5c1e9d27, which ran per row,
+# by statement triggers refreshing each affected recipe once
+# (sqlite has no statement triggers and keeps its row triggers)
+
+POSTGRES_UPGRADE = [
+    "DROP TRIGGER IF EXISTS ingredient_search_update ON ingredient",
+    "DROP FUNCTION IF EXISTS ingredient_search_trigger()",
+    """
+    CREATE OR REPLACE FUNCTION ingredient_search_refresh() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE recipe
+            SET search_vector = recipe_search_vector(id, name, preparation)
+            WHERE id IN (SELECT recipe_id FROM new_ingredients);
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE recipe
+            SET search_vector = recipe_search_vector(id, name, preparation)
+            WHERE id IN (SELECT recipe_id FROM old_ingredients);
+        ELSE
+            UPDATE recipe
+            SET search_vector = recipe_search_vector(id, name, preparation)
+            WHERE id IN (
+                SELECT recipe_id FROM old_ingredients
+                UNION
+                SELECT recipe_id FROM new_ingredients
+            );
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER ingredient_search_insert
+    AFTER INSERT ON ingredient
+    REFERENCING NEW TABLE AS new_ingredients
+    FOR EACH STATEMENT EXECUTE FUNCTION ingredient_search_refresh()
+    """,
+    """
+    CREATE TRIGGER ingredient_search_update
+    AFTER UPDATE ON ingredient
+    REFERENCING OLD TABLE AS old_ingredients NEW TABLE AS new_ingredients
+    FOR EACH STATEMENT EXECUTE FUNCTION ingredient_search_refresh()
+    """,
+    """
+    CREATE TRIGGER ingredient_search_delete
+    AFTER DELETE ON ingredient
+    REFERENCING OLD TABLE AS old_ingredients
+    FOR EACH STATEMENT EXECUTE FUNCTION ingredient_search_refresh()
+    """,
+]
+
+POSTGRES_DOWNGRADE = [
+    "DROP TRIGGER IF EXISTS ingredient_search_delete ON ingredient",
+    "DROP TRIGGER IF EXISTS ingredient_search_update ON ingredient",
+    "DROP TRIGGER IF EXISTS ingredient_search_insert ON ingredient",
+    "DROP FUNCTION IF EXISTS ingredient_search_refresh()",
+    """
+    CREATE OR REPLACE FUNCTION ingredient_search_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE recipe
+            SET search_vector = recipe_search_vector(id, name, preparation)
+            WHERE id = OLD.recipe_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            UPDATE recipe
+            SET search_vector = recipe_search_vector(id, name, preparation)
+            WHERE id = NEW.recipe_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER ingredient_search_update
+    AFTER INSERT OR UPDATE OR DELETE ON ingredient
+    FOR EACH ROW EXECUTE FUNCTION ingredient_search_trigger()
+    """,
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for statement in POSTGRES_UPGRADE:
+            op.execute(statement)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for statement in POSTGRES_DOWNGRADE:
+            op.execute(statement)
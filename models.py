@@ -1,16 +1,38 @@
 import os
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select
+from sqlalchemy.orm import deferred
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import undefer
+
+from dbpool import get_engine_options
+from search import setup_search
 
 db = SQLAlchemy()
 
 
+'''
+get_database_url(url)
+
+returns the url in the form expected by SQLAlchemy
+(some hosting providers still use the postgres:// scheme).
+'''
+def get_database_url(url):
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql://", 1)
+    return url
+
+
 '''
 setup_db(app)
 
 binds a flask application and a SQLAlchemy service.
 
-If test is True, then a local test database is used
+If test is True, then a local test database is used.
+The connection pool is configured by the environment,
+see dbpool.get_engine_options.
 '''
 def setup_db(app):
     test = os.environ.get("TEST", "")
@@ -22,16 +44,35 @@ def setup_db(app):
         database_path = "sqlite:///" + dbfile
         app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     else:
-        database_path = os.environ["DATABASE_URL"]
-        if database_path.startswith("postgres://"):
-            database_path = database_path.replace("postgres://", "postgresql://", 1)
+        database_path = get_database_url(os.environ["DATABASE_URL"])
         app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(database_path)
     db.app = app
     db.init_app(app)
     return db
 
 
+'''
+field_options(model, fields, required)
+
+returns the loader options that load only the columns and
+relationships needed for the given fields (see the FIELDS of
+the models) and the columns required.
+'''
+def field_options(model, fields, required=()):
+    columns = set(required)
+    options = []
+    for field in fields:
+        attribute = model.FIELDS[field]
+        if attribute in model.RELATIONSHIPS:
+            options.append(model.relationship_option(attribute))
+        else:
+            columns.add(attribute)
+    options.append(load_only(*(getattr(model, name) for name in sorted(columns))))
+    return options
+
+
 '''
 Recipe
 
@@ -40,22 +81,74 @@ preparation instructions.
 '''
 class Recipe(db.Model):  
     __tablename__ = 'recipe'
+    __table_args__ = (
+        db.Index("ix_recipe_name_id", "name", "id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(128), nullable=False)
+    username = db.Column(db.String(128), nullable=False, index=True)
     name = db.Column(db.String(128), nullable=False)
     servings = db.Column(db.Integer, nullable=False)
-    preparation = db.Column(db.String())
+    # can be many kilobytes, only loaded where needed
+    preparation = deferred(db.Column(db.String()))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # number of menus containing the recipe, maintained by the menu routes
+    menu_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     ingredients = db.relationship(
         "Ingredient",
         cascade="all, delete-orphan",
-        backref="recipe"
+        backref="recipe",
+        order_by="Ingredient.id",
     )
 
+    # the fields of the responses and the attributes they need
+    FIELDS = {
+        "id": "id",
+        "name": "name",
+        "username": "username",
+        "servings": "servings",
+        "ingredients": "ingredients",
+        "preparation": "preparation",
+        "number_of_menus": "menu_count",
+    }
+    RELATIONSHIPS = ("ingredients",)
+    LIST_FIELDS = ("id", "name", "username", "number_of_menus")
+    DETAIL_FIELDS = ("id", "name", "username", "servings", "ingredients", "preparation")
+
     def __repr__(self):
         return f"<Recipe {self.id}: {self.name} ({self.username})>"
 
+    @staticmethod
+    def relationship_option(name):
+        return selectinload(getattr(Recipe, name))
+
+    @staticmethod
+    def detail_options():
+        """
+        Loader options for everything json() needs, so that
+        a recipe is loaded in a fixed number of queries.
+        """
+        return [selectinload(Recipe.ingredients), undefer(Recipe.preparation)]
+
+    @staticmethod
+    def list_options(fields=LIST_FIELDS):
+        """
+        Loader options for the given fields of json_list(),
+        including what list_version() and the cursor need.
+        """
+        return field_options(Recipe, fields, ("version", "name", "menu_count"))
+
+    def etag(self):
+        return f"recipe-{self.id}-{self.version}"
+
+    def list_version(self):
+        """
+        Changes whenever json_list() changes. The menu count
+        changes without a new version of the recipe.
+        """
+        return (self.id, self.version, self.menu_count)
+
     def json_short(self):
         return {
             "id": self.id,
@@ -63,19 +156,20 @@ class Recipe(db.Model):
             "username": self.username,
         }
 
-    def json(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "username": self.username,
-            "servings": self.servings,
-            "ingredients": [
+    def field(self, name):
+        if name == "ingredients":
+            return [
                 ingredient.json()
                 for ingredient
                 in self.ingredients
-            ],
-            "preparation": self.preparation,
-        }
+            ]
+        return getattr(self, Recipe.FIELDS[name])
+
+    def json_list(self, fields=LIST_FIELDS):
+        return {name: self.field(name) for name in fields}
+
+    def json(self, fields=DETAIL_FIELDS):
+        return {name: self.field(name) for name in fields}
 
 
 '''
@@ -91,7 +185,7 @@ class Ingredient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), nullable=False)
     amount = db.Column(db.Float, nullable=False)
-    recipe_id = db.Column(db.Integer, db.ForeignKey("recipe.id"))
+    recipe_id = db.Column(db.Integer, db.ForeignKey("recipe.id"), index=True)
 
     def __repr__(self):
         return f"<Ingredient {self.id}: {self.amount} {self.name}>"
@@ -113,6 +207,7 @@ menu_recipe_table = db.Table(
     "menu_recipe_table",
     db.Column('menu_id', db.Integer, db.ForeignKey('menu.id'), primary_key=True),
     db.Column('recipe_id', db.Integer, db.ForeignKey('recipe.id'), primary_key=True),
+    db.Index("ix_menu_recipe_table_recipe_id", "recipe_id"),
 )
 
 
@@ -123,19 +218,68 @@ A menu consists of a series of dishes/recipes.
 '''
 class Menu(db.Model):
     __tablename__ = 'menu'
+    __table_args__ = (
+        db.Index("ix_menu_name_id", "name", "id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(128), nullable=False)
     name = db.Column(db.String(128), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    dish_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # recipes used in menus cannot be deleted, thus the menus
+    # of a deleted recipe need not be loaded (passive_deletes)
     dishes = db.relationship(
         "Recipe", 
         secondary=menu_recipe_table,
-        backref=db.backref('menus', lazy=True),
+        backref=db.backref('menus', lazy=True, passive_deletes=True),
     )
 
+    FIELDS = {
+        "id": "id",
+        "name": "name",
+        "username": "username",
+        "number_of_dishes": "dish_count",
+        "dishes": "dishes",
+    }
+    RELATIONSHIPS = ("dishes",)
+    LIST_FIELDS = ("id", "name", "username", "number_of_dishes")
+    DETAIL_FIELDS = ("id", "name", "username", "number_of_dishes", "dishes")
+
     def __repr__(self):
         return f"<Menu {self.id}: {self.name} ({self.username})>"
 
+    @staticmethod
+    def relationship_option(name):
+        # the dishes are shown by json_short()
+        return selectinload(getattr(Menu, name)).load_only(
+            Recipe.id,
+            Recipe.name,
+            Recipe.username,
+        )
+
+    @staticmethod
+    def detail_options():
+        """
+        Loader options for everything json() needs, so that
+        a menu is loaded in a fixed number of queries.
+        """
+        return [Menu.relationship_option("dishes")]
+
+    @staticmethod
+    def list_options(fields=LIST_FIELDS):
+        """
+        Loader options for the given fields of json_list(),
+        including what list_version() and the cursor need.
+        """
+        return field_options(Menu, fields, ("version", "name"))
+
+    def etag(self):
+        return f"menu-{self.id}-{self.version}"
+
+    def list_version(self):
+        return (self.id, self.version)
+
     def json_short(self):
         return {
             "id": self.id,
@@ -143,15 +287,72 @@ class Menu(db.Model):
             "username": self.username,
         }
 
-    def json(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "username": self.username,
-            "number_of_dishes": len(self.dishes),
-            "dishes": [
+    def field(self, name):
+        if name == "dishes":
+            return [
                 recipe.json_short()
                 for recipe
                 in self.dishes
-            ],
-        }
+            ]
+        return getattr(self, Menu.FIELDS[name])
+
+    def json_list(self, fields=LIST_FIELDS):
+        return {name: self.field(name) for name in fields}
+
+    def json(self, fields=DETAIL_FIELDS):
+        return {name: self.field(name) for name in fields}
+
+
+'''
+Generation
+
+A counter shared by all processes through the database. The
+processes compare it to detect changes made by the others,
+e.g. the "ingredient-index" generation is incremented by every
+transaction that changes the ingredients of recipes.
+'''
+class Generation(db.Model):
+    __tablename__ = 'generation'
+
+    key = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    def __repr__(self):
+        return f"<Generation {self.key}: {self.value}>"
+
+
+'''
+get_generation(session, key)
+
+returns the current value of the generation key (0 if the
+key was never incremented).
+'''
+def get_generation(session, key):
+    value = session.execute(
+        select(Generation.value).where(Generation.key == key)
+    ).scalar()
+    return value or 0
+
+
+'''
+bump_generation(session, key)
+
+increments the generation key within the current transaction
+and returns the new value. The row stays locked until the
+transaction ends, thus concurrent transactions get consecutive
+values in the order they commit.
+'''
+def bump_generation(session, key):
+    table = Generation.__table__
+    result = session.execute(
+        table.update()
+        .where(table.c.key == key)
+        .values(value=table.c.value + 1)
+    )
+    if result.rowcount == 0:
+        session.execute(table.insert().values(key=key, value=1))
+        return 1
+    return get_generation(session, key)
+
+
+setup_search(db.metadata)
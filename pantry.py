@@ -0,0 +1,198 @@
+import re
+import threading
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# This file provides the in-memory inverted index used to find the
+# recipes that can be cooked with the ingredients of a pantry.
+#
+# The index maps each normalized ingredient name to the ids of the
+# recipes using it, and stores the number of distinct ingredients of
+# every recipe. A pantry is matched by counting, for every recipe, how
+# many of its postings the pantry hits: with numpy, the posting arrays
+# are concatenated and counted with one bincount, otherwise a Counter
+# over the posting sets is used.
+#
+# The index is private to one process. It is built from the database
+# on first use and kept up to date by the recipe write routes.
+
+
+# units stripped by normalize_ingredient, singular and plural
+UNITS = (
+    "bit", "branch", "bunch", "bundle", "can", "clove", "cup", "dash",
+    "glass", "gram", "gramm", "handful", "kilogram", "kilogramm", "litre",
+    "liter", "millilitre", "milliliter", "ounce", "piece", "pinch", "pound",
+    "slice", "spoon", "sprig", "stick", "tablespoon", "teaspoon",
+)
+QUANTITY_PATTERN = re.compile(
+    r"^(?:(?:a|an|[\d.,/]+) )?(?:%s)(?:e?s)? of " % "|".join(UNITS)
+)
+
+
+def normalize_ingredient(name):
+    """
+    Returns the name under which an ingredient is indexed: lower case,
+    without a leading quantity such as "3 teaspoons of". Other names
+    containing "of", such as "cream of tartar", are kept.
+    """
+    name = " ".join(str(name).lower().split())
+    return QUANTITY_PATTERN.sub("", name)
+
+
+class IngredientIndex:
+    """
+    Inverted index from normalized ingredient names to recipe ids.
+
+    generation is the "ingredient-index" generation stored in the
+    database (see models.Generation) the index was built or last
+    updated at, so that changes made by other processes are detected.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.generation = None
+        self._postings = {}
+        self._arrays = {}
+        self._recipe_names = {}
+        self._counts = []
+        self._counts_array = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.loaded = False
+            self.generation = None
+            self._postings = {}
+            self._arrays = {}
+            self._recipe_names = {}
+            self._counts = []
+            self._counts_array = None
+
+    def load(self, rows, generation):
+        """
+        Rebuilds the index from (recipe_id, ingredient name) rows.
+        """
+        names = {}
+        for recipe_id, name in rows:
+            names.setdefault(recipe_id, set()).add(normalize_ingredient(name))
+        with self._lock:
+            self._postings = {}
+            self._arrays = {}
+            self._recipe_names = {}
+            self._counts = []
+            self._counts_array = None
+            for recipe_id, recipe_names in names.items():
+                self._add(recipe_id, recipe_names)
+            self.loaded = True
+            self.generation = generation
+
+    def set_recipe(self, recipe_id, names):
+        """
+        Sets the ingredient names of a new or updated recipe.
+        """
+        names = {normalize_ingredient(name) for name in names}
+        with self._lock:
+            self._remove(recipe_id)
+            self._add(recipe_id, names)
+
+    def remove_recipe(self, recipe_id):
+        with self._lock:
+            self._remove(recipe_id)
+
+    def match(self, names, limit):
+        """
+        Returns up to limit tuples (recipe_id, matched, total) of the
+        recipes using the most of the given ingredient names. Ties are
+        broken by the fraction of the recipe's ingredients matched,
+        then by recipe id.
+        """
+        names = {normalize_ingredient(name) for name in names}
+        with self._lock:
+            if numpy is not None:
+                return self._match_numpy(names, limit)
+            return self._match_python(names, limit)
+
+    def _match_numpy(self, names, limit):
+        arrays = [
+            self._posting_array(name)
+            for name
+            in names
+            if name in self._postings
+        ]
+        if not arrays:
+            return []
+        if self._counts_array is None:
+            self._counts_array = numpy.asarray(self._counts, dtype=numpy.int64)
+        counts = self._counts_array
+        matched = numpy.bincount(numpy.concatenate(arrays), minlength=len(counts))
+        candidates = numpy.flatnonzero(matched)
+        matched = matched[candidates]
+        # the coverage is at most 1, so the key orders by the number
+        # of matched ingredients first and by the coverage second
+        keys = matched + 0.5 * matched / counts[candidates]
+        if len(candidates) > limit:
+            # keep all ties of the limit-th key, so that they
+            # are decided by recipe id below
+            kth = -numpy.partition(-keys, limit - 1)[limit - 1]
+            top = keys >= kth
+            candidates, matched, keys = candidates[top], matched[top], keys[top]
+        order = numpy.lexsort((candidates, -keys))[:limit]
+        return [
+            (int(recipe_id), int(count), self._counts[recipe_id])
+            for recipe_id, count
+            in zip(candidates[order], matched[order])
+        ]
+
+    def _match_python(self, names, limit):
+        matched = Counter()
+        for name in names:
+            matched.update(self._postings.get(name, ()))
+        ranked = sorted(
+            matched.items(),
+            key=lambda item: (
+                -item[1],
+                -item[1] / self._counts[item[0]],
+                item[0],
+            ),
+        )
+        return [
+            (recipe_id, count, self._counts[recipe_id])
+            for recipe_id, count
+            in ranked[:limit]
+        ]
+
+    def _posting_array(self, name):
+        array = self._arrays.get(name)
+        if array is None:
+            array = numpy.fromiter(self._postings[name], dtype=numpy.int64)
+            self._arrays[name] = array
+        return array
+
+    def _add(self, recipe_id, names):
+        if not names:
+            return
+        self._recipe_names[recipe_id] = names
+        if recipe_id >= len(self._counts):
+            self._counts.extend([0] * (recipe_id + 1 - len(self._counts)))
+        self._counts[recipe_id] = len(names)
+        self._counts_array = None
+        for name in names:
+            self._postings.setdefault(name, set()).add(recipe_id)
+            self._arrays.pop(name, None)
+
+    def _remove(self, recipe_id):
+        names = self._recipe_names.pop(recipe_id, ())
+        for name in names:
+            postings = self._postings[name]
+            postings.discard(recipe_id)
+            if not postings:
+                del self._postings[name]
+            self._arrays.pop(name, None)
+        if names:
+            self._counts[recipe_id] = 0
+            self._counts_array = None
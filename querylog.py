@@ -0,0 +1,221 @@
+import re
+from contextlib import contextmanager
+
+from flask import g
+from flask import has_request_context
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# This file provides helpers for inspecting the SQL statements
+# issued by the application, e.g. for checking the query plans
+# of all statements a route executes.
+#
+# It also provides the query budgets: routes declare the maximum
+# number of statements they may execute with @query_budget, and in
+# the unit tests (see setup_query_guard) every request is checked against
+# its budget and for N+1 patterns, i.e. the same SELECT executed
+# repeatedly with different parameters, as happens when a lazy
+# relationship is loaded once per row. Tests can pin the number of
+# statements of a block with max_queries.
+
+
+SQLITE_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$")
+POSTGRES_SEQ_SCAN = re.compile(r"Seq Scan on (\w+)")
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def normalize_statement(statement):
+    """
+    Returns statement with its literals and whitespace normalized,
+    so that statements differing only in parameters compare equal.
+    """
+    return " ".join(LITERAL.sub("?", statement).split())
+
+
+class QueryLog:
+    """
+    The statements (with their parameters) recorded by capture_queries.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def __iter__(self):
+        return iter(self.statements)
+
+    def repeated(self):
+        """
+        Returns (statement, count) for every SELECT that was executed
+        more than once with different parameters.
+        """
+        parameters = {}
+        for statement, params in self.statements:
+            if statement.lstrip()[:6].upper() != "SELECT":
+                continue
+            key = normalize_statement(statement)
+            parameters.setdefault(key, set()).add(repr(params))
+        return [
+            (statement, len(params))
+            for statement, params
+            in parameters.items()
+            if len(params) > 1
+        ]
+
+    def check(self, budget, allow_repeated=False, context="block"):
+        """
+        Raises QueryBudgetExceeded if more than budget statements were
+        executed or, unless allow_repeated, if a SELECT was repeated.
+        """
+        problems = []
+        if budget is not None and len(self) > budget:
+            problems.append(
+                f"{context} executed {len(self)} statements,"
+                f" the budget is {budget}"
+            )
+        if not allow_repeated:
+            problems.extend(
+                f"{context} executed {count} times (N+1): {statement}"
+                for statement, count
+                in self.repeated()
+            )
+        if problems:
+            raise QueryBudgetExceeded("\n".join(problems + [
+                "Statements:",
+                *(" ".join(statement.split()) for statement, _ in self),
+            ]))
+
+
+def record_statement(log, statement, parameters, executemany):
+    if executemany:
+        parameters = parameters[0] if parameters else ()
+    log.statements.append((statement, parameters))
+
+
+@contextmanager
+def capture_queries(engine=None):
+    """
+    Records all statements executed on engine within the block,
+    or on any engine if no engine is given.
+    """
+    log = QueryLog()
+    target = Engine if engine is None else engine
+
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        record_statement(log, statement, parameters, executemany)
+
+    event.listen(target, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield log
+    finally:
+        event.remove(target, "before_cursor_execute", before_cursor_execute)
+
+
+@contextmanager
+def max_queries(budget, engine=None, allow_repeated=False):
+    """
+    Fails with QueryBudgetExceeded if the block executes more than
+    budget statements or repeats a SELECT with different parameters.
+    Can also be used as decorator of a test method.
+    """
+    with capture_queries(engine) as log:
+        yield log
+    log.check(budget, allow_repeated)
+
+
+def query_budget(budget, allow_repeated=False):
+    """
+    Declares the maximum number of statements a route may execute
+    per request. Must be applied below @app.route.
+    """
+    def decorator(f):
+        f.query_budget = budget
+        f.allow_repeated_queries = allow_repeated
+        return f
+    return decorator
+
+
+def record_request_statement(
+    conn, cursor, statement, parameters, context, executemany
+):
+    if has_request_context() and "query_log" in g:
+        record_statement(g.query_log, statement, parameters, executemany)
+
+
+def setup_query_guard(app):
+    """
+    Checks every request against the query budget of its route and
+    for N+1 patterns, and raises QueryBudgetExceeded on a violation.
+
+    Only meant for the unit tests, which install it explicitly:
+    exceptions are propagated, so that the violation fails the
+    test that sent the request.
+    """
+    app.config["PROPAGATE_EXCEPTIONS"] = True
+    if not event.contains(Engine, "before_cursor_execute", record_request_statement):
+        event.listen(Engine, "before_cursor_execute", record_request_statement)
+
+    @app.before_request
+    def start_query_log():
+        g.query_log = QueryLog()
+
+    @app.after_request
+    def check_query_log(response):
+        log = g.pop("query_log", None)
+        view = app.view_functions.get(request.endpoint)
+        if log is None or view is None:
+            return response
+        log.check(
+            getattr(view, "query_budget", None),
+            getattr(view, "allow_repeated_queries", False),
+            f"{request.method} {request.url_rule.rule}",
+        )
+        return response
+
+
+def explain(connection, statement, parameters):
+    """
+    Returns the lines of the query plan of statement.
+    """
+    if connection.dialect.name == "sqlite":
+        rows = connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + statement,
+            parameters,
+        )
+        return [row[-1] for row in rows]
+    rows = connection.exec_driver_sql("EXPLAIN " + statement, parameters)
+    return [row[0] for row in rows]
+
+
+def find_seq_scans(connection, statements, tables):
+    """
+    Returns a (statement, plan line) tuple for each statement
+    whose plan sequentially scans one of the given tables.
+
+    Only SELECT, UPDATE and DELETE statements are explained.
+    """
+    pattern = (
+        SQLITE_FULL_SCAN
+        if connection.dialect.name == "sqlite"
+        else POSTGRES_SEQ_SCAN
+    )
+    found = []
+    for statement, parameters in statements:
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb not in ("SELECT", "UPDATE", "DELETE"):
+            continue
+        for line in explain(connection, statement, parameters):
+            match = pattern.search(line.strip())
+            if match and match.group(1) in tables:
+                found.append((statement, line.strip()))
+    return found
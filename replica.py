@@ -0,0 +1,146 @@
+import hashlib
+import os
+import random
+
+from flask import g
+from flask import request
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from cache import NullCache
+from dbpool import get_engine_options
+from models import db
+from models import get_database_url
+
+
+# This file provides the routing of public reads to read replicas.
+#
+# The replicas are configured by DATABASE_REPLICA_URL, a comma
+# separated list of database urls. Each request that reads through
+# read_session() uses one randomly chosen replica. Writes, and the
+# permission checks around them, always use db.session (the primary).
+#
+# After a successful write, requests with the same Authorization header
+# read from the primary for REPLICA_STICKY_SECONDS, so that clients see
+# their own writes even if the replicas lag behind. The recent writes
+# are marked in the response cache backend, thus all workers sharing
+# the cache see them (with the memory cache, or the cache disabled,
+# only the worker that served the write does). The response to the
+# write also sets the cookie recent_write, which browsers send to
+# every worker, for the same time.
+
+REPLICA_COOKIE = "recent_write"
+
+
+class Replicas:
+    """
+    The engines of the read replicas.
+    """
+
+    def __init__(self, urls=(), sticky_seconds=10):
+        self.sticky_seconds = sticky_seconds
+        self.engines = []
+        # cache backend keeping the recent writes, see setup_replicas
+        self.store = NullCache()
+        self.configure(urls)
+
+    def configure(self, urls):
+        """
+        Replaces the replicas by the given database urls.
+        """
+        self.dispose()
+        self.engines = [
+            create_engine(url, **get_engine_options(url))
+            for url
+            in map(get_database_url, urls)
+        ]
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = []
+
+    def mark_recent_write(self, key):
+        """
+        Makes the client given by its key read from the primary
+        for the next sticky_seconds.
+        """
+        self.store.mark(f"recent-write:{key}", self.sticky_seconds)
+
+    def wrote_recently(self, key):
+        return self.store.marked(f"recent-write:{key}")
+
+    def choose(self):
+        """
+        Returns the engine to read from, or None if the
+        request must read from the primary.
+        """
+        if not self.engines or request.cookies.get(REPLICA_COOKIE):
+            return None
+        key = get_client_key()
+        if key is not None and self.wrote_recently(key):
+            return None
+        return random.choice(self.engines)
+
+
+def get_client_key():
+    """
+    Returns a key for the client of the request, the digest of its
+    Authorization header, or None if the request has none.
+    """
+    auth = request.headers.get("Authorization")
+    if not auth:
+        return None
+    return hashlib.sha256(auth.encode()).hexdigest()
+
+
+def get_replica_urls():
+    urls = os.environ.get("DATABASE_REPLICA_URL", "")
+    return [url.strip() for url in urls.split(",") if url.strip()]
+
+
+replicas = Replicas(
+    get_replica_urls(),
+    int(os.environ.get("DATABASE_REPLICA_STICKY_SECONDS", "10")),
+)
+
+
+def read_session():
+    """
+    Returns the session for the public reads of the current request:
+    a session on a replica, or db.session if no replica is configured
+    or the client wrote recently.
+    """
+    if "read_session" not in g:
+        engine = replicas.choose()
+        g.read_session = db.session if engine is None else Session(bind=engine)
+    return g.read_session
+
+
+def setup_replicas(app, store):
+    replicas.store = store
+
+    @app.after_request
+    def mark_recent_write(response):
+        # g.username is only set by authenticated (write) routes
+        if (
+            replicas.engines
+            and "username" in g
+            and request.method in ("POST", "PATCH", "PUT", "DELETE")
+            and response.status_code < 400
+        ):
+            replicas.mark_recent_write(get_client_key())
+            response.set_cookie(
+                REPLICA_COOKIE,
+                "1",
+                max_age=replicas.sticky_seconds,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
+
+    @app.teardown_appcontext
+    def close_read_session(exception):
+        session = g.pop("read_session", None)
+        if session is not None and session is not db.session:
+            session.close()
@@ -0,0 +1,278 @@
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import DDL
+from sqlalchemy import event
+from sqlalchemy import text
+
+
+# This file provides the full-text search over recipes.
+#
+# On postgresql, the recipe table has a tsvector column search_vector
+# with a GIN index. It is maintained by triggers on recipe (name,
+# preparation) and on ingredient (ingredient names). The ingredient
+# triggers run once per statement and refresh each affected recipe
+# once, no matter how many of its ingredients the statement changed.
+#
+# On sqlite (used by the unit tests), an FTS5 virtual table
+# recipe_search, whose rowid is the recipe id, is maintained by
+# triggers in the same way (per row, sqlite has no statement triggers).
+#
+# The migrations "Add recipe search" and "Refresh search per statement"
+# apply the same statements to existing databases.
+
+
+POSTGRES_DDL = [
+    "ALTER TABLE recipe ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    "CREATE INDEX IF NOT EXISTS ix_recipe_search_vector"
+    " ON recipe USING GIN (search_vector)",
+    """
+    CREATE OR REPLACE FUNCTION recipe_search_vector(
+        p_recipe_id integer, p_name text, p_preparation text
+    ) RETURNS tsvector AS $$
+        SELECT setweight(to_tsvector('english', coalesce(p_name, '')), 'A')
+            || setweight(to_tsvector('english', coalesce((
+                SELECT string_agg(i.name, ' ')
+                FROM ingredient i
+                WHERE i.recipe_id = p_recipe_id
+            ), '')), 'B')
+            || setweight(to_tsvector('english', coalesce(p_preparation, '')), 'C')
+    $$ LANGUAGE sql STABLE
+    """,
+    """
+    CREATE OR REPLACE FUNCTION recipe_search_trigger() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := recipe_search_vector(NEW.id, NEW.name, NEW.preparation);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS recipe_search_update ON recipe",
+    """
+    CREATE TRIGGER recipe_search_update
+    BEFORE INSERT OR UPDATE OF name, preparation ON recipe
+    FOR EACH ROW EXECUTE FUNCTION recipe_search_trigger()
+    """,
+    "DROP TRIGGER IF EXISTS ingredient_search_insert ON ingredient",
+    "DROP TRIGGER IF EXISTS ingredient_search_update ON ingredient",
+    "DROP TRIGGER IF EXISTS ingredient_search_delete ON ingredient",
+    """
+    CREATE OR REPLACE FUNCTION ingredient_search_refresh() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE recipe
+            SET search_vector = recipe_search_vector(id, name, preparation)
+            WHERE id IN (SELECT recipe_id FROM new_ingredients);
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE recipe
+            SET search_vector = recipe_search_vector(id, name, preparation)
+            WHERE id IN (SELECT recipe_id FROM old_ingredients);
+        ELSE
+            UPDATE recipe
+            SET search_vector = recipe_search_vector(id, name, preparation)
+            WHERE id IN (
+                SELECT recipe_id FROM old_ingredients
+                UNION
+                SELECT recipe_id FROM new_ingredients
+            );
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    # transition tables require one trigger per event
+    """
+    CREATE TRIGGER ingredient_search_insert
+    AFTER INSERT ON ingredient
+    REFERENCING NEW TABLE AS new_ingredients
+    FOR EACH STATEMENT EXECUTE FUNCTION ingredient_search_refresh()
+    """,
+    """
+    CREATE TRIGGER ingredient_search_update
+    AFTER UPDATE ON ingredient
+    REFERENCING OLD TABLE AS old_ingredients NEW TABLE AS new_ingredients
+    FOR EACH STATEMENT EXECUTE FUNCTION ingredient_search_refresh()
+    """,
+    """
+    CREATE TRIGGER ingredient_search_delete
+    AFTER DELETE ON ingredient
+    REFERENCING OLD TABLE AS old_ingredients
+    FOR EACH STATEMENT EXECUTE FUNCTION ingredient_search_refresh()
+    """,
+]
+
+SQLITE_INGREDIENT_NAMES = (
+    "(SELECT coalesce(group_concat(name, ' '), '')"
+    " FROM ingredient WHERE recipe_id = {recipe_id})"
+)
+
+SQLITE_INGREDIENT_INSERT_TRIGGER = f"""
+    CREATE TRIGGER IF NOT EXISTS ingredient_search_insert
+    AFTER INSERT ON ingredient
+    BEGIN
+        UPDATE recipe_search
+        SET ingredients = {SQLITE_INGREDIENT_NAMES.format(recipe_id="new.recipe_id")}
+        WHERE rowid = new.recipe_id;
+    END
+"""
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS recipe_search"
+    " USING fts5(name, ingredients, preparation, tokenize = 'porter unicode61')",
+    """
+    CREATE TRIGGER IF NOT EXISTS recipe_search_insert AFTER INSERT ON recipe
+    BEGIN
+        INSERT INTO recipe_search (rowid, name, ingredients, preparation)
+        VALUES (new.id, new.name, '', coalesce(new.preparation, ''));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS recipe_search_update
+    AFTER UPDATE OF name, preparation ON recipe
+    BEGIN
+        UPDATE recipe_search
+        SET name = new.name, preparation = coalesce(new.preparation, '')
+        WHERE rowid = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS recipe_search_delete AFTER DELETE ON recipe
+    BEGIN
+        DELETE FROM recipe_search WHERE rowid = old.id;
+    END
+    """,
+    SQLITE_INGREDIENT_INSERT_TRIGGER,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS ingredient_search_update
+    AFTER UPDATE ON ingredient
+    BEGIN
+        UPDATE recipe_search
+        SET ingredients = {SQLITE_INGREDIENT_NAMES.format(recipe_id="old.recipe_id")}
+        WHERE rowid = old.recipe_id;
+        UPDATE recipe_search
+        SET ingredients = {SQLITE_INGREDIENT_NAMES.format(recipe_id="new.recipe_id")}
+        WHERE rowid = new.recipe_id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS ingredient_search_delete
+    AFTER DELETE ON ingredient
+    BEGIN
+        UPDATE recipe_search
+        SET ingredients = {SQLITE_INGREDIENT_NAMES.format(recipe_id="old.recipe_id")}
+        WHERE rowid = old.recipe_id;
+    END
+    """,
+]
+
+POSTGRES_MATCHES = """
+    SELECT recipe.id, recipe.name, recipe.username,
+        CAST(ts_rank(recipe.search_vector, query) AS DOUBLE PRECISION) AS score
+    FROM recipe, plainto_tsquery('english', :q) AS query
+    WHERE recipe.search_vector @@ query
+"""
+
+# bm25 weights of the columns name, ingredients and preparation.
+# bm25 is lower for better matches, hence the negation.
+SQLITE_MATCHES = """
+    SELECT recipe.id, recipe.name, recipe.username,
+        -bm25(recipe_search, 10.0, 5.0, 1.0) AS score
+    FROM recipe_search JOIN recipe ON recipe.id = recipe_search.rowid
+    WHERE recipe_search MATCH :q
+"""
+
+
+def setup_search(metadata):
+    """
+    Registers the search DDL to run after metadata.create_all().
+    """
+    for statement in POSTGRES_DDL:
+        event.listen(
+            metadata,
+            "after_create",
+            DDL(statement).execute_if(dialect="postgresql"),
+        )
+    for statement in SQLITE_DDL:
+        event.listen(
+            metadata,
+            "after_create",
+            DDL(statement).execute_if(dialect="sqlite"),
+        )
+
+
+@contextmanager
+def bulk_insert_mode(session, first_recipe_id):
+    """
+    Suspends the maintenance of the ingredient names in the search
+    index on insert while bulk inserting ingredients, and rebuilds the
+    search data of all recipes from first_recipe_id on afterwards.
+
+    Ingredients added by other connections in the meantime are not
+    indexed, so this is only meant for seeding an idle database.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        session.execute(text("DROP TRIGGER IF EXISTS ingredient_search_insert"))
+    else:
+        session.execute(text(
+            "ALTER TABLE ingredient DISABLE TRIGGER ingredient_search_insert"
+        ))
+    session.commit()
+    try:
+        yield
+    finally:
+        session.rollback()
+        if dialect == "sqlite":
+            session.execute(text(SQLITE_INGREDIENT_INSERT_TRIGGER))
+            session.execute(
+                text(
+                    "UPDATE recipe_search SET ingredients = "
+                    + SQLITE_INGREDIENT_NAMES.format(recipe_id="recipe_search.rowid")
+                    + " WHERE rowid >= :first_id"
+                ),
+                {"first_id": first_recipe_id},
+            )
+        else:
+            session.execute(text(
+                "ALTER TABLE ingredient ENABLE TRIGGER ingredient_search_insert"
+            ))
+            session.execute(
+                text(
+                    "UPDATE recipe"
+                    " SET search_vector = recipe_search_vector(id, name, preparation)"
+                    " WHERE id >= :first_id"
+                ),
+                {"first_id": first_recipe_id},
+            )
+        session.commit()
+
+
+def search_recipes(session, q, limit, after=None):
+    """
+    Returns up to limit rows (id, name, username, score) of the
+    recipes matching all words of q, best matches first.
+
+    after is the (score, id) of the last row of the previous page.
+    """
+    if session.get_bind().dialect.name == "sqlite":
+        matches = SQLITE_MATCHES
+        # quote the words, so that the input is never parsed
+        # as FTS5 query syntax
+        q = " ".join(f'"{word}"' for word in re.findall(r"\w+", q))
+    else:
+        matches = POSTGRES_MATCHES
+    params = {"q": q, "limit": limit}
+    condition = ""
+    if after is not None:
+        condition = (
+            "WHERE matches.score < :score"
+            " OR (matches.score = :score AND matches.id > :id)"
+        )
+        params["score"], params["id"] = after
+    return session.execute(
+        text(
+            f"SELECT * FROM ({matches}) AS matches {condition}"
+            " ORDER BY matches.score DESC, matches.id LIMIT :limit"
+        ),
+        params,
+    ).all()
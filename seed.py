@@ -0,0 +1,281 @@
+import itertools
+import random
+from collections import Counter
+
+from sqlalchemy import bindparam
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import text
+
+from models import Ingredient
+from models import Menu
+from models import Recipe
+from models import menu_recipe_table
+from search import bulk_insert_mode
+
+
+# This file provides the generation of synthetic recipes and menus,
+# e.g. for reproducing performance problems on a realistically sized
+# database (see the "flask seed" command) and for the load test.
+#
+# The data is deterministic for a given seed. Like in real data, a few
+# ingredients, users and recipes are very common and most are rare
+# (Zipf distributions), and the numbers of ingredients and preparation
+# steps follow a skewed (log-normal) distribution.
+
+INGREDIENTS = [
+    "salt and pepper", "spoons of olive oil", "onion", "cloves of garlic",
+    "gramms of butter", "eggs", "gramms of flour", "gramms of sugar",
+    "millilitres of milk", "tomatoes", "litres of water", "lemon",
+    "bunch of parsley", "millilitres of cream", "potatoes", "carrots",
+    "branch of basil", "gramms of rice", "gramms of parmesan",
+    "teaspoons of thyme", "gramms of chicken", "gramms of spaghetti",
+    "bell pepper", "teaspoons of ginger", "spoons of soy sauce",
+    "spoons of honey", "gramms of mushrooms", "gramms of spinach",
+    "zucchini", "gramms of beef", "teaspoons of paprika",
+    "teaspoons of cumin", "branch of rosemary", "lettuce",
+    "teaspoons of vinegar", "mozzarella", "gramms of chickpeas",
+    "gramms of lentils", "gramms of tofu", "millilitres of coconut milk",
+    "teaspoons of cinnamon", "gramms of chocolate", "apples",
+    "gramms of oats", "gramms of yoghurt", "teaspoons of mustard",
+    "stick of celery", "leek", "cabbage", "broccoli", "cauliflower",
+    "gramms of peas", "gramms of green beans", "gramms of corn", "avocado",
+    "lime", "bunch of coriander", "chili", "gramms of pork",
+    "gramms of bacon", "gramms of salmon", "gramms of shrimps",
+    "can of tuna", "gramms of feta", "gramms of ricotta",
+    "gramms of walnuts", "gramms of almonds", "gramms of raisins",
+    "vanilla pod", "gramms of yeast", "gramms of bread crumbs",
+    "gramms of polenta", "gramms of couscous", "gramms of quinoa",
+    "gramms of noodles", "pumpkin", "sweet potatoes", "beetroot",
+    "radish", "cucumber", "pears", "bananas", "gramms of strawberries",
+    "gramms of blueberries", "spoons of maple syrup",
+    "teaspoons of sesame", "spoons of curry paste",
+    "millilitres of red wine", "millilitres of white wine",
+    "millilitres of stock", "spoons of capers", "gramms of olives",
+    "anchovies",
+]
+
+DISHES = [
+    "salad", "soup", "risotto", "pasta", "curry", "stew", "gratin",
+    "omelette", "pie", "cake", "stir fry", "casserole", "burger",
+    "tart", "bowl", "lasagna", "pancakes", "muffins", "chili", "tacos",
+]
+
+ADJECTIVES = [
+    "simple", "spicy", "creamy", "quick", "rustic", "summer", "winter",
+    "grandma's", "green", "roasted", "smoky", "fresh", "crispy", "hearty",
+    "light", "festive", "classic", "vegan", "lemony", "sweet",
+]
+
+STEPS = [
+    "Chop the vegetables into small pieces.",
+    "Heat the oil in a large pan.",
+    "Season with salt and pepper.",
+    "Simmer on low heat for twenty minutes, stirring occasionally.",
+    "Preheat the oven to 200 degrees.",
+    "Bake in the oven until golden.",
+    "Whisk the eggs with the milk until smooth.",
+    "Bring a large pot of salted water to the boil.",
+    "Drain and set aside.",
+    "Fry until crisp on both sides.",
+    "Mix all ingredients in a large bowl.",
+    "Let rest for ten minutes before serving.",
+    "Garnish with fresh herbs and serve immediately.",
+]
+
+SERVINGS = [1, 2, 4, 6, 8]
+SERVINGS_WEIGHTS = [5, 30, 45, 15, 5]
+AMOUNTS = [1, 2, 3, 5, 10, 50, 100, 250, 500]
+MENU_SIZES = [1, 2, 3, 4, 5, 6, 8, 12]
+MENU_SIZE_WEIGHTS = [5, 15, 35, 25, 10, 5, 3, 2]
+CHUNK_SIZE = 1000
+
+
+def zipf_weights(n, exponent=1.1):
+    return list(itertools.accumulate(
+        1 / (rank ** exponent)
+        for rank
+        in range(1, n + 1)
+    ))
+
+
+class DataGenerator:
+    """
+    Generates synthetic recipes and menus, deterministic for a seed.
+    """
+
+    def __init__(self, seed, users=50):
+        self.rng = random.Random(seed)
+        self.ingredient_weights = zipf_weights(len(INGREDIENTS))
+        self.usernames = [f"user{idx}@recipe.dabr.ch" for idx in range(users)]
+        self.user_weights = zipf_weights(users)
+
+    def ingredients(self):
+        """
+        Returns the ingredients of a recipe as dicts with name and
+        amount, 2 to 30 distinct ones, about 7 in the median.
+        """
+        count = min(30, max(2, round(self.rng.lognormvariate(2.0, 0.45))))
+        names = set()
+        while len(names) < count:
+            names.update(self.rng.choices(
+                INGREDIENTS,
+                cum_weights=self.ingredient_weights,
+                k=count - len(names),
+            ))
+        return [
+            {"name": name, "amount": float(self.rng.choice(AMOUNTS))}
+            for name
+            in sorted(names)
+        ]
+
+    def preparation(self):
+        count = min(60, max(1, round(self.rng.lognormvariate(1.8, 0.6))))
+        return "\n".join(self.rng.choice(STEPS) for _ in range(count))
+
+    def recipe(self, idx):
+        """
+        Returns a recipe as dict in the format of the add recipe route,
+        extended by the username.
+        """
+        return {
+            "name": (
+                f"{self.rng.choice(ADJECTIVES)} {self.rng.choice(DISHES)} {idx}"
+            ).capitalize(),
+            "username": self.rng.choices(
+                self.usernames,
+                cum_weights=self.user_weights,
+            )[0],
+            "servings": self.rng.choices(SERVINGS, weights=SERVINGS_WEIGHTS)[0],
+            "ingredients": self.ingredients(),
+            "preparation": self.preparation(),
+        }
+
+    def dishes(self, recipe_ids, recipe_weights):
+        """
+        Returns the distinct recipe ids of a menu, popular recipes
+        being chosen more often.
+        """
+        size = self.rng.choices(MENU_SIZES, weights=MENU_SIZE_WEIGHTS)[0]
+        size = min(size, len(recipe_ids))
+        dishes = []
+        while len(dishes) < size:
+            recipe_id = self.rng.choices(recipe_ids, cum_weights=recipe_weights)[0]
+            if recipe_id not in dishes:
+                dishes.append(recipe_id)
+        return dishes
+
+
+def next_id(session, model):
+    return (session.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def reset_sequence(session, model):
+    """
+    Moves the id sequence of the table (postgresql) past the
+    explicitly inserted ids.
+    """
+    if session.get_bind().dialect.name != "postgresql":
+        return
+    table = model.__tablename__
+    session.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'),"
+        f" (SELECT MAX(id) FROM {table}))"
+    ))
+
+
+def clear_database(session):
+    session.execute(menu_recipe_table.delete())
+    session.execute(Menu.__table__.delete())
+    session.execute(Ingredient.__table__.delete())
+    session.execute(Recipe.__table__.delete())
+    session.commit()
+
+
+def seed_database(session, recipes, menus, seed):
+    """
+    Inserts the given numbers of synthetic recipes and menus using
+    Core executemany INSERTs in chunks, and returns the inserted
+    (recipe ids, menu ids).
+
+    The ids are assigned explicitly after the highest existing id,
+    so that ingredients and dishes need no round trip per row. The
+    search index is rebuilt once at the end instead of per ingredient.
+    The dish and menu counts are set like the menu routes do.
+    """
+    generator = DataGenerator(seed)
+    if not recipes and next_id(session, Recipe) == 1:
+        # menus need recipes
+        menus = 0
+    recipe_table = Recipe.__table__
+    ingredient_table = Ingredient.__table__
+    first_recipe_id = next_id(session, Recipe)
+    recipe_ids = list(range(first_recipe_id, first_recipe_id + recipes))
+    with bulk_insert_mode(session, first_recipe_id):
+        for start in range(0, recipes, CHUNK_SIZE):
+            rows = []
+            ingredients = []
+            for recipe_id in recipe_ids[start:start + CHUNK_SIZE]:
+                recipe = generator.recipe(recipe_id)
+                rows.append({
+                    "id": recipe_id,
+                    "name": recipe["name"],
+                    "username": recipe["username"],
+                    "servings": recipe["servings"],
+                    "preparation": recipe["preparation"],
+                })
+                ingredients.extend(
+                    {"recipe_id": recipe_id, **ingredient}
+                    for ingredient
+                    in recipe["ingredients"]
+                )
+            session.execute(recipe_table.insert(), rows)
+            session.execute(ingredient_table.insert(), ingredients)
+            session.commit()
+    reset_sequence(session, Recipe)
+
+    menu_table = Menu.__table__
+    first_menu_id = next_id(session, Menu)
+    menu_ids = list(range(first_menu_id, first_menu_id + menus))
+    # rank the recipes by popularity in a random order
+    ranked = list(recipe_ids) or session.execute(
+        select(Recipe.id).order_by(Recipe.id)
+    ).scalars().all()
+    generator.rng.shuffle(ranked)
+    weights = zipf_weights(len(ranked), 0.8)
+    add_menu_count = (
+        recipe_table.update()
+        .where(recipe_table.c.id == bindparam("_id"))
+        .values(menu_count=recipe_table.c.menu_count + bindparam("_count"))
+    )
+    for start in range(0, menus, CHUNK_SIZE):
+        rows = []
+        dishes = []
+        for menu_id in menu_ids[start:start + CHUNK_SIZE]:
+            recipe_ids_of_menu = generator.dishes(ranked, weights)
+            rows.append({
+                "id": menu_id,
+                "name": f"Menu {menu_id}",
+                "username": generator.rng.choices(
+                    generator.usernames,
+                    cum_weights=generator.user_weights,
+                )[0],
+                "dish_count": len(recipe_ids_of_menu),
+            })
+            dishes.extend(
+                {"menu_id": menu_id, "recipe_id": recipe_id}
+                for recipe_id
+                in recipe_ids_of_menu
+            )
+        menu_counts = Counter(dish["recipe_id"] for dish in dishes)
+        session.execute(menu_table.insert(), rows)
+        session.execute(menu_recipe_table.insert(), dishes)
+        session.execute(add_menu_count, [
+            {"_id": recipe_id, "_count": count}
+            for recipe_id, count
+            in menu_counts.items()
+        ])
+        session.commit()
+    reset_sequence(session, Menu)
+    session.commit()
+    return recipe_ids, menu_ids
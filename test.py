@@ -1,17 +1,68 @@
+import gzip
+import json
 import os
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+from cryptography.hazmat.primitives.asymmetric import rsa
 from flask import Flask
+from flask import jsonify
 import jwt
+from sqlalchemy import create_engine
+from sqlalchemy import exc
+from sqlalchemy import text
+from sqlalchemy.orm import Session
 
 os.environ["TEST"] = "true"
 
 from app import app
 from app import db
+from app import ingredient_index
+from app import response_cache
 from models import Recipe
 from models import Ingredient
 from models import Menu
+from models import bump_generation
+from models import get_generation
 from auth import requires_auth
+from auth import token_cache
+from bench_routes import compare_results
+from bench_routes import percentile_ms
+from cache import MemoryCache
+from cache import NullCache
+from cache import RedisCache
+from cache import create_cache
+from dbpool import TimedNullPool
+from dbpool import TimedQueuePool
+from dbpool import get_engine_options
+from dbpool import pool_metrics
+from dbpool import pool_stats
+from jsonprovider import OrjsonProvider
+from jsonprovider import StdlibJSONProvider
+from jwks import JWKSKeyStore
+from prometheus_client import REGISTRY
+from prometheus_client import CollectorRegistry
+from prometheus_client import multiprocess
+from querylog import QueryBudgetExceeded
+from querylog import capture_queries
+from querylog import max_queries
+from querylog import query_budget
+from querylog import setup_query_guard
+from querylog import find_seq_scans
+from replica import replicas
+from seed import DataGenerator
+from timing import setup_timing
+import pantry
+from pantry import IngredientIndex
+
+# every request of the tests is checked against the query
+# budget of its route and for N+1 patterns
+setup_query_guard(app)
 
 
 def create_token(payload):
@@ -95,6 +146,18 @@ def create_recipe(spec):
     return recipe
 
 
+def create_menu(**fields):
+    """
+    Returns a new menu with the dish and menu counts
+    set like the menu routes do.
+    """
+    menu = Menu(**fields)
+    menu.dish_count = len(menu.dishes)
+    for recipe in menu.dishes:
+        recipe.menu_count = (recipe.menu_count or 0) + 1
+    return menu
+
+
 def create_simple_salad():
     return create_recipe("""
     Simple Salad
@@ -160,6 +223,8 @@ class RecipeTestCase(unittest.TestCase):
         """
         self.app = app
         self.db = db
+        response_cache.clear()
+        ingredient_index.clear()
         with self.app.app_context():
             self.db.create_all()
         self.client = self.app.test_client
@@ -213,6 +278,54 @@ class RecipeTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertEqual(len(data["recipes"]), 2)
 
+    def test_get_recipe_list_offset_page(self):
+        with self.app.app_context():
+            for idx in range(12):
+                recipe = create_simple_salad()
+                recipe.name = f"Salad {idx:02}"
+                self.db.session.add(recipe)
+            self.db.session.commit()
+
+        res = self.client().get("/recipe?page=2")
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["total_pages"], 2)
+        self.assertEqual(
+            [recipe["name"] for recipe in data["recipes"]],
+            ["Salad 10", "Salad 11"],
+        )
+
+    def test_get_recipe_list_cursor(self):
+        with self.app.app_context():
+            for idx in range(12):
+                recipe = create_simple_salad()
+                recipe.name = f"Salad {idx % 6}"
+                self.db.session.add(recipe)
+            self.db.session.commit()
+
+        ids = []
+        url = "/recipe?limit=5"
+        while True:
+            res = self.client().get(url)
+            data = res.get_json()
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data["success"], True)
+            ids.extend(recipe["id"] for recipe in data["recipes"])
+            if not data["next_cursor"]:
+                break
+            url = f"/recipe?limit=5&after={data['next_cursor']}"
+
+        self.assertEqual(len(ids), 12)
+        self.assertEqual(len(set(ids)), 12)
+
+    def test_get_recipe_list_error_invalid_cursor(self):
+        res = self.client().get("/recipe?after=invalid")
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
     def test_get_recipe(self):
         recipe = create_simple_salad()
         with self.app.app_context():
@@ -228,6 +341,323 @@ class RecipeTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertEqual(data["recipe"]["name"], "Simple Salad")
 
+    def test_search_recipe_list(self):
+        with self.app.app_context():
+            self.db.session.add(create_simple_salad())
+            self.db.session.add(create_spaghetti_with_tomato_sauce())
+            self.db.session.commit()
+
+        res = self.client().get("/recipe/search?q=tomato")
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(
+            [recipe["name"] for recipe in data["recipes"]],
+            ["Spaghetti with tomato sauce"],
+        )
+
+        res = self.client().get("/recipe/search?q=salt+pepper")
+        data = res.get_json()
+
+        self.assertEqual(len(data["recipes"]), 2)
+
+        res = self.client().get("/recipe/search?q=" + "\"vinaigrette*")
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["recipes"][0]["name"], "Simple Salad")
+
+    def test_search_recipe_list_follows_updates(self):
+        recipe = create_simple_salad()
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        res = self.client().get("/recipe/search?q=flower")
+        self.assertEqual(len(res.get_json()["recipes"]), 1)
+
+        self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"ingredients": [{"name": "rocket", "amount": 1}]},
+            headers=get_headers_recipe_user(),
+        )
+
+        res = self.client().get("/recipe/search?q=rocket")
+        self.assertEqual(len(res.get_json()["recipes"]), 1)
+        res = self.client().get("/recipe/search?q=flower")
+        self.assertEqual(res.get_json()["recipes"], [])
+
+        self.client().delete(
+            f"/recipe/{recipe_id}",
+            headers=get_headers_recipe_user(),
+        )
+
+        res = self.client().get("/recipe/search?q=rocket")
+        self.assertEqual(res.get_json()["recipes"], [])
+
+    def test_search_recipe_list_cursor(self):
+        with self.app.app_context():
+            for idx in range(7):
+                recipe = create_simple_salad()
+                recipe.name = f"Salad {idx}"
+                if idx % 2:
+                    recipe.name += " with lettuce"
+                self.db.session.add(recipe)
+            self.db.session.commit()
+
+        names = []
+        url = "/recipe/search?q=lettuce&limit=3"
+        while url:
+            data = self.client().get(url).get_json()
+            names.extend(recipe["name"] for recipe in data["recipes"])
+            url = None
+            if data["next_cursor"]:
+                url = f"/recipe/search?q=lettuce&limit=3&after={data['next_cursor']}"
+
+        self.assertEqual(len(names), 7)
+        self.assertEqual(len(set(names)), 7)
+        self.assertTrue(all(name.endswith("lettuce") for name in names[:3]))
+
+    def test_search_recipe_list_error_missing_query(self):
+        res = self.client().get("/recipe/search?q=+")
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_match_recipe_list(self):
+        with self.app.app_context():
+            self.db.session.add(create_simple_salad())
+            self.db.session.add(create_spaghetti_with_tomato_sauce())
+            self.db.session.commit()
+
+        res = self.client().post("/recipe/match", json={
+            "ingredients": ["Basil", "tomatoes", "olive oil", "salt and pepper"],
+        })
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(
+            [
+                (recipe["name"], recipe["matched_ingredients"])
+                for recipe
+                in data["recipes"]
+            ],
+            [("Spaghetti with tomato sauce", 4), ("Simple Salad", 1)],
+        )
+        self.assertEqual(data["recipes"][0]["number_of_ingredients"], 7)
+
+        res = self.client().post("/recipe/match", json={
+            "ingredients": ["salt and pepper"],
+            "limit": 1,
+        })
+        data = res.get_json()
+
+        # both recipes match once, the salad has fewer other ingredients
+        self.assertEqual(len(data["recipes"]), 1)
+        self.assertEqual(data["recipes"][0]["name"], "Simple Salad")
+
+        res = self.client().post("/recipe/match", json={"ingredients": ["caviar"]})
+
+        self.assertEqual(res.get_json()["recipes"], [])
+
+    def test_match_recipe_list_follows_updates(self):
+        res = self.client().post(
+            "/recipe",
+            json={
+                "name": "Rocket salad",
+                "servings": 2,
+                "ingredients": [{"name": "rocket", "amount": 1}],
+            },
+            headers=get_headers_recipe_user(),
+        )
+        recipe_id = res.get_json()["id"]
+
+        res = self.client().post("/recipe/match", json={"ingredients": ["rocket"]})
+        self.assertEqual(len(res.get_json()["recipes"]), 1)
+
+        self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"ingredients": [{"name": "lettuce", "amount": 1}]},
+            headers=get_headers_recipe_user(),
+        )
+
+        res = self.client().post("/recipe/match", json={"ingredients": ["rocket"]})
+        self.assertEqual(res.get_json()["recipes"], [])
+        res = self.client().post("/recipe/match", json={"ingredients": ["lettuce"]})
+        self.assertEqual(len(res.get_json()["recipes"]), 1)
+
+        self.client().delete(
+            f"/recipe/{recipe_id}",
+            headers=get_headers_recipe_user(),
+        )
+
+        res = self.client().post("/recipe/match", json={"ingredients": ["lettuce"]})
+        self.assertEqual(res.get_json()["recipes"], [])
+
+    def test_match_recipe_list_rebuilds_after_foreign_change(self):
+        with self.app.app_context():
+            self.db.session.add(create_simple_salad())
+            self.db.session.commit()
+
+        res = self.client().post("/recipe/match", json={"ingredients": ["basil"]})
+        self.assertEqual(res.get_json()["recipes"], [])
+
+        # another worker adds a recipe and bumps the shared generation
+        with self.app.app_context():
+            self.db.session.add(create_spaghetti_with_tomato_sauce())
+            bump_generation(self.db.session, "ingredient-index")
+            self.db.session.commit()
+
+        res = self.client().post("/recipe/match", json={"ingredients": ["basil"]})
+        self.assertEqual(len(res.get_json()["recipes"]), 1)
+
+    def test_recipe_changes_bump_ingredient_index_generation(self):
+        res = self.client().post(
+            "/recipe",
+            json={
+                "name": "Rocket salad",
+                "servings": 2,
+                "ingredients": [{"name": "rocket", "amount": 1}],
+            },
+            headers=get_headers_recipe_user(),
+        )
+        recipe_id = res.get_json()["id"]
+        self.client().delete(
+            f"/recipe/{recipe_id}",
+            headers=get_headers_recipe_user(),
+        )
+
+        with self.app.app_context():
+            self.assertEqual(get_generation(self.db.session, "ingredient-index"), 2)
+
+    def test_match_recipe_list_error_invalid_body(self):
+        res = self.client().post("/recipe/match", json={"pantry": ["basil"]})
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().post("/recipe/match", json={"ingredients": "basil"})
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().post(
+            "/recipe/match",
+            json={"ingredients": ["basil"], "limit": 0},
+        )
+        self.assertEqual(res.status_code, 400)
+
+    def test_export_recipe_list(self):
+        with self.app.app_context():
+            self.db.session.add(create_simple_salad())
+            self.db.session.add(create_spaghetti_with_tomato_sauce())
+            self.db.session.commit()
+
+        res = self.client().get("/recipe/export")
+        recipes = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/x-ndjson")
+        self.assertEqual(len(recipes), 2)
+        self.assertEqual(recipes[0]["name"], "Simple Salad")
+        self.assertEqual(len(recipes[1]["ingredients"]), 7)
+
+        res = self.client().get(
+            f"/recipe/export?since={recipes[0]['id']}",
+            headers={"Accept-Encoding": "gzip"},
+        )
+        lines = gzip.decompress(res.data).splitlines()
+
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0]), recipes[1])
+
+    def test_get_recipe_etag(self):
+        recipe = create_simple_salad()
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        res = self.client().get(f"/recipe/{recipe_id}")
+        etag = res.headers["ETag"]
+
+        self.assertEqual(res.status_code, 200)
+
+        response_cache.clear()
+        with self.app.app_context():
+            with capture_queries(self.db.engine) as queries:
+                res = self.client().get(
+                    f"/recipe/{recipe_id}",
+                    headers={"If-None-Match": etag},
+                )
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers["ETag"], etag)
+        self.assertEqual(len(queries), 1)
+
+        self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"servings": 2},
+            headers=get_headers_recipe_user(),
+        )
+        res = self.client().get(
+            f"/recipe/{recipe_id}",
+            headers={"If-None-Match": etag},
+        )
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+        self.assertEqual(res.get_json()["recipe"]["servings"], 2)
+
+    def test_get_recipe_list_etag(self):
+        with self.app.app_context():
+            self.db.session.add(create_simple_salad())
+            self.db.session.commit()
+
+        res = self.client().get("/recipe")
+        etag = res.headers["ETag"]
+        res = self.client().get("/recipe", headers={"If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 304)
+
+        with self.app.app_context():
+            self.db.session.add(create_spaghetti_with_tomato_sauce())
+            self.db.session.commit()
+
+        res = self.client().get("/recipe", headers={"If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.get_json()["recipes"]), 2)
+
+    def test_get_recipe_cached(self):
+        recipe = create_simple_salad()
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        res = self.client().get(f"/recipe/{recipe_id}")
+        data = res.get_json()
+        with self.app.app_context():
+            with capture_queries(self.db.engine) as queries:
+                res = self.client().get(f"/recipe/{recipe_id}")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json(), data)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(response_cache.stats()["hits"], 1)
+
+        self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"name": "Green Salad"},
+            headers=get_headers_recipe_user(),
+        )
+        res = self.client().get(f"/recipe/{recipe_id}")
+
+        self.assertEqual(res.get_json()["recipe"]["name"], "Green Salad")
+
     def test_get_recipe_error_not_found(self):
         res = self.client().get(f"/recipe/1")
         data = res.get_json()
@@ -316,84 +746,323 @@ class RecipeTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data["success"], False)
 
-    def test_update_recipe(self):
-        recipe = create_simple_salad()
-        with self.app.app_context():
-            self.db.session.add(recipe)
-            self.db.session.flush()
-            recipe_id = recipe.id
-            self.db.session.commit()
-
-        recipe = {
-            "name": "Test Salad",
-            "servings": 1,
-        }
-        res = self.client().patch(
-            f"/recipe/{recipe_id}",
-            json=recipe,
+    def test_add_recipes_bulk(self):
+        recipes = [
+            {
+                "name": "Bread",
+                "servings": 1,
+                "ingredients": [{"name": "flour", "amount": 500}],
+            },
+            {
+                "name": "Invalid",
+                "servings": "many",
+                "ingredients": [],
+            },
+            {
+                "name": "Butter bread",
+                "servings": 2,
+                "ingredients": [
+                    {"name": "slice of bread", "amount": 2},
+                    {"name": "bit of butter", "amount": 1},
+                ],
+            },
+        ]
+        res = self.client().post(
+            "/recipe/bulk",
+            json=recipes,
             headers=get_headers_recipe_user(),
         )
         data = res.get_json()
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
-        self.assertEqual(data["id"], recipe_id)
+        self.assertEqual(data["inserted"], 2)
+        self.assertEqual(data["failed"], 1)
+        self.assertEqual(data["results"][1]["index"], 1)
+        self.assertIn("servings", data["results"][1]["error"])
 
+        recipe_id = data["results"][2]["id"]
         res = self.client().get(f"/recipe/{recipe_id}")
         data = res.get_json()
 
-        self.assertEqual(res.status_code, 200)
-        self.assertEqual(data["success"], True)
-        self.assertEqual(data["recipe"]["name"], "Test Salad")
-        self.assertEqual(data["recipe"]["servings"], 1)
-
-    def test_update_recipe_error_wrong_user(self):
-        recipe = create_simple_salad()
-        recipe.username = "test@recipe.dabr.ch"
-        with self.app.app_context():
-            self.db.session.add(recipe)
-            self.db.session.flush()
-            recipe_id = recipe.id
-            self.db.session.commit()
+        self.assertEqual(data["recipe"]["name"], "Butter bread")
+        self.assertEqual(len(data["recipe"]["ingredients"]), 2)
 
-        recipe = {
-            "name": "Test Salad",
-            "servings": 1,
-        }
-        res = self.client().patch(
-            f"/recipe/{recipe_id}",
-            json=recipe,
+    def test_add_recipes_bulk_error_invalid_types(self):
+        recipes = [
+            {"name": "Soup", "servings": 1, "ingredients": 5},
+            {"name": "Stew", "servings": 1, "ingredients": [5]},
+            {"name": "Bread", "servings": 1, "ingredients": []},
+        ]
+        res = self.client().post(
+            "/recipe/bulk",
+            json=recipes,
             headers=get_headers_recipe_user(),
         )
         data = res.get_json()
 
-        self.assertEqual(res.status_code, 403)
-        self.assertEqual(data["success"], False)
-
-    def test_update_recipe_wrong_user_but_admin(self):
-        recipe = create_simple_salad()
-        recipe.username = "test@recipe.dabr.ch"
-        with self.app.app_context():
-            self.db.session.add(recipe)
-            self.db.session.flush()
-            recipe_id = recipe.id
-            self.db.session.commit()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["inserted"], 1)
+        self.assertIn("not a list", data["results"][0]["error"])
+        self.assertIn("Ingredient 0", data["results"][1]["error"])
+        self.assertIn("id", data["results"][2])
 
-        recipe = {
-            "name": "Test Salad",
-            "servings": 1,
-        }
+        recipe_id = data["results"][2]["id"]
         res = self.client().patch(
             f"/recipe/{recipe_id}",
-            json=recipe,
-            headers=get_headers_admin_user(),
+            json={"ingredients": [5]},
+            headers=get_headers_recipe_user(),
         )
-        data = res.get_json()
 
-        self.assertEqual(res.status_code, 200)
-        self.assertEqual(data["success"], True)
+        self.assertEqual(res.status_code, 400)
 
-    def test_update_recipe_error_not_found(self):
+    def test_add_recipes_bulk_error_invalid_strings(self):
+        recipes = [
+            {"name": "Soup", "servings": 1, "ingredients": [], "preparation": {"x": 1}},
+            {"name": "x" * 129, "servings": 1, "ingredients": []},
+            {
+                "name": "Stew",
+                "servings": 1,
+                "ingredients": [{"name": "y" * 129, "amount": 1}],
+            },
+            {"name": "Bread", "servings": 1, "ingredients": [], "preparation": None},
+        ]
+        res = self.client().post(
+            "/recipe/bulk",
+            json=recipes,
+            headers=get_headers_recipe_user(),
+        )
+        data = res.get_json()
+
+        self.assertEqual(data["inserted"], 1)
+        self.assertIn("'preparation' is not a string", data["results"][0]["error"])
+        self.assertIn("longer than 128", data["results"][1]["error"])
+        self.assertIn("in ingredient 0", data["results"][2]["error"])
+
+        recipe_id = data["results"][3]["id"]
+        res = self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"preparation": ["Bake"]},
+            headers=get_headers_recipe_user(),
+        )
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_add_recipes_bulk_rejected_row_fails_alone(self):
+        recipes = [
+            {
+                "name": f"Bread {idx}",
+                "servings": 1,
+                "ingredients": [{"name": "flour", "amount": 500}],
+            }
+            for idx in range(5)
+        ]
+        recipes[2]["name"] = "Poison"
+        # a row that passes the validation, but the database rejects
+        with self.app.app_context():
+            self.db.session.execute(text(
+                "CREATE TRIGGER reject_poison BEFORE INSERT ON recipe"
+                " WHEN new.name = 'Poison'"
+                " BEGIN SELECT RAISE(ABORT, 'rejected'); END"
+            ))
+            self.db.session.commit()
+        with self.assertLogs(level="ERROR"):
+            res = self.client().post(
+                "/recipe/bulk",
+                json=recipes,
+                headers=get_headers_recipe_user(),
+            )
+        data = res.get_json()
+
+        self.assertEqual(data["inserted"], 4)
+        self.assertEqual(data["results"][2], {"index": 2, "error": "Cannot insert recipe"})
+        res = self.client().get("/recipe?limit=10")
+        self.assertEqual(len(res.get_json()["recipes"]), 4)
+        res = self.client().post("/recipe/match", json={"ingredients": ["flour"]})
+        self.assertEqual(len(res.get_json()["recipes"]), 4)
+
+    def test_add_recipes_bulk_ndjson(self):
+        lines = [
+            json.dumps({
+                "name": f"Bread {idx}",
+                "servings": 1,
+                "ingredients": [{"name": "flour", "amount": 500}],
+            })
+            for idx in range(5)
+        ]
+        lines.insert(2, "{not json")
+        res = self.client().post(
+            "/recipe/bulk",
+            data="\n".join(lines) + "\n",
+            content_type="application/x-ndjson",
+            headers=get_headers_recipe_user(),
+        )
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["inserted"], 5)
+        self.assertEqual(data["failed"], 1)
+        self.assertEqual(data["results"][2]["error"], "Invalid JSON")
+
+        res = self.client().get("/recipe")
+        data = res.get_json()
+
+        self.assertEqual(len(data["recipes"]), 5)
+
+    def test_add_recipes_bulk_error_no_permission(self):
+        res = self.client().post(
+            "/recipe/bulk",
+            json=[],
+            headers=get_headers_menu_user(),
+        )
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data["success"], False)
+
+    def test_update_recipe(self):
+        recipe = create_simple_salad()
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        recipe = {
+            "name": "Test Salad",
+            "servings": 1,
+        }
+        res = self.client().patch(
+            f"/recipe/{recipe_id}",
+            json=recipe,
+            headers=get_headers_recipe_user(),
+        )
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["id"], recipe_id)
+
+        res = self.client().get(f"/recipe/{recipe_id}")
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["recipe"]["name"], "Test Salad")
+        self.assertEqual(data["recipe"]["servings"], 1)
+
+    def test_update_recipe_ingredients_diff(self):
+        recipe = create_simple_salad()
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            ingredients = [ingredient.json() for ingredient in recipe.ingredients]
+            self.db.session.commit()
+
+        ingredients[1]["name"] = "teaspoons of apple vinegar"
+        ingredients.append({"name": "bundle of chives", "amount": 1})
+        with self.app.app_context():
+            with capture_queries(self.db.engine) as queries:
+                res = self.client().patch(
+                    f"/recipe/{recipe_id}",
+                    json={"ingredients": ingredients},
+                    headers=get_headers_recipe_user(),
+                )
+        self.assertEqual(res.status_code, 200)
+        verbs = [
+            statement.split(None, 1)[0]
+            for statement, _ in queries
+            if "ingredient" in statement.split("(", 1)[0].split()[:3]
+        ]
+        self.assertEqual(verbs.count("UPDATE"), 1)
+        self.assertEqual(verbs.count("INSERT"), 1)
+        self.assertEqual(verbs.count("DELETE"), 0)
+
+        res = self.client().get(f"/recipe/{recipe_id}")
+        data = res.get_json()
+
+        self.assertEqual(data["recipe"]["ingredients"], ingredients)
+
+        res = self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"ingredients": ingredients[:2]},
+            headers=get_headers_recipe_user(),
+        )
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get(f"/recipe/{recipe_id}")
+        data = res.get_json()
+
+        self.assertEqual(data["recipe"]["ingredients"], ingredients[:2])
+
+    def test_update_recipe_error_invalid_ingredient(self):
+        recipe = create_simple_salad()
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        res = self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"ingredients": [{"name": "salt"}]},
+            headers=get_headers_recipe_user(),
+        )
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().get(f"/recipe/{recipe_id}")
+        data = res.get_json()
+
+        self.assertEqual(len(data["recipe"]["ingredients"]), 4)
+
+    def test_update_recipe_error_wrong_user(self):
+        recipe = create_simple_salad()
+        recipe.username = "test@recipe.dabr.ch"
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        recipe = {
+            "name": "Test Salad",
+            "servings": 1,
+        }
+        res = self.client().patch(
+            f"/recipe/{recipe_id}",
+            json=recipe,
+            headers=get_headers_recipe_user(),
+        )
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data["success"], False)
+
+    def test_update_recipe_wrong_user_but_admin(self):
+        recipe = create_simple_salad()
+        recipe.username = "test@recipe.dabr.ch"
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        recipe = {
+            "name": "Test Salad",
+            "servings": 1,
+        }
+        res = self.client().patch(
+            f"/recipe/{recipe_id}",
+            json=recipe,
+            headers=get_headers_admin_user(),
+        )
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+
+    def test_update_recipe_error_not_found(self):
         recipe = {
             "name": "Test Salad",
             "servings": 1,
@@ -444,7 +1113,7 @@ class RecipeTestCase(unittest.TestCase):
 
     def test_delete_recipe_error_included_in_menu(self):
         recipe = create_simple_salad()
-        menu = Menu(
+        menu = create_menu(
             name="Testmenu",
             username="menu@recipe.dabr.ch",
             dishes=[recipe],
@@ -518,6 +1187,49 @@ class RecipeTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
 
+    def test_verified_token_is_cached(self):
+        recipe = create_simple_salad()
+        recipe.username = "test@recipe.dabr.ch"
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        token_cache.clear()
+        payload = jwt.decode(create_token_admin_user(), "test", algorithms=["HS256"])
+        payload["exp"] = int(time.time()) + 3600
+        headers = {"Authorization": "Bearer " + create_token(payload)}
+
+        res = self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"servings": 2},
+            headers=headers,
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(token_cache.stats()["misses"], 1)
+        self.assertEqual(token_cache.stats()["hits"], 0)
+
+        res = self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"servings": 3},
+            headers=headers,
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(token_cache.stats()["misses"], 1)
+        self.assertEqual(token_cache.stats()["hits"], 1)
+
+    def test_token_without_exp_is_not_cached(self):
+        token_cache.clear()
+        for _ in range(2):
+            self.client().post(
+                "/recipe",
+                json={"name": "Test"},
+                headers=get_headers_recipe_user(),
+            )
+        self.assertEqual(token_cache.stats()["misses"], 2)
+        self.assertEqual(token_cache.stats()["size"], 0)
+
     def test_get_menu_list_empty(self):
         res = self.client().get("/menu")
         data = res.get_json()
@@ -533,9 +1245,31 @@ class RecipeTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data["success"], False)
 
+    def test_get_menu_list_cursor(self):
+        with self.app.app_context():
+            for idx in range(3):
+                self.db.session.add(create_menu(
+                    name=f"Menu {idx}",
+                    username="menu@recipe.dabr.ch",
+                ))
+            self.db.session.commit()
+
+        res = self.client().get("/menu?limit=2")
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["menus"]), 2)
+
+        res = self.client().get(f"/menu?limit=2&after={data['next_cursor']}")
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([menu["name"] for menu in data["menus"]], ["Menu 2"])
+        self.assertIsNone(data["next_cursor"])
+
     def test_get_menu_list_one(self):
         recipe = create_simple_salad()
-        menu = Menu(
+        menu = create_menu(
             name="Testmenu",
             username="menu@recipe.dabr.ch",
             dishes=[recipe],
@@ -557,7 +1291,7 @@ class RecipeTestCase(unittest.TestCase):
 
     def test_get_menu(self):
         recipe = create_simple_salad()
-        menu = Menu(
+        menu = create_menu(
             name="Testmenu",
             username="menu@recipe.dabr.ch",
             dishes=[recipe],
@@ -577,55 +1311,263 @@ class RecipeTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertEqual(data["menu"]["name"], "Testmenu")
 
-    def test_get_menu_error_not_found(self):
-        res = self.client().get(f"/menu/1")
+    def test_get_shopping_list(self):
+        salad = create_simple_salad()
+        spaghetti = create_spaghetti_with_tomato_sauce()
+        first = create_menu(
+            name="First",
+            username="menu@recipe.dabr.ch",
+            dishes=[salad, spaghetti],
+        )
+        second = create_menu(
+            name="Second",
+            username="menu@recipe.dabr.ch",
+            dishes=[salad],
+        )
+        with self.app.app_context():
+            self.db.session.add_all([salad, spaghetti, first, second])
+            self.db.session.flush()
+            menu_ids = f"{first.id},{second.id}"
+            self.db.session.commit()
+
+        with self.app.app_context():
+            with capture_queries(self.db.engine) as queries:
+                res = self.client().get(f"/menu/shopping-list?ids={menu_ids}")
+        data = res.get_json()
+        amounts = {item["name"]: item["amount"] for item in data["ingredients"]}
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        # one query checks the menu ids, one aggregates
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(amounts["salt and pepper"], 3)
+        self.assertEqual(amounts["lettuce"], 2)
+        self.assertEqual(amounts["gramms of spaghetti"], 500)
+        self.assertEqual(
+            [item["name"] for item in data["ingredients"]],
+            sorted(amounts),
+        )
+
+        res = self.client().get(f"/menu/shopping-list?ids={menu_ids}&servings=2")
+        amounts = {
+            item["name"]: item["amount"]
+            for item
+            in res.get_json()["ingredients"]
+        }
+
+        self.assertEqual(amounts["salt and pepper"], 1.5)
+        self.assertEqual(amounts["lettuce"], 1)
+
+    def test_get_shopping_list_error_invalid_ids(self):
+        res = self.client().get("/menu/shopping-list")
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().get("/menu/shopping-list?ids=1,x")
+        self.assertEqual(res.status_code, 400)
+
+        # unicode digits such as superscripts are not valid ids
+        res = self.client().get("/menu/shopping-list?ids=1,\u00b2")
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().get("/menu/shopping-list?ids=41,42")
         data = res.get_json()
 
         self.assertEqual(res.status_code, 404)
-        self.assertEqual(data["success"], False)
+        self.assertIn("Menus not found: 41, 42", data["message"])
 
-    def test_add_menu(self):
+    def test_get_menu_etag_changes_with_recipe_name(self):
         recipe = create_simple_salad()
+        menu = create_menu(
+            name="Testmenu",
+            username="menu@recipe.dabr.ch",
+            dishes=[recipe],
+        )
         with self.app.app_context():
             self.db.session.add(recipe)
+            self.db.session.add(menu)
             self.db.session.flush()
             recipe_id = recipe.id
+            menu_id = menu.id
             self.db.session.commit()
 
-        menu = {
-            "name": "Testmenu",
-            "dishes": [{"recipe_id": recipe_id}],
-        }
-        res = self.client().post(
-            "/menu",
-            json=menu,
-            headers=get_headers_menu_user(),
+        res = self.client().get(f"/menu/{menu_id}")
+        etag = res.headers["ETag"]
+        res = self.client().get(
+            f"/menu/{menu_id}",
+            headers={"If-None-Match": etag},
         )
-        data = res.get_json()
 
-        self.assertEqual(res.status_code, 200)
-        self.assertEqual(data["success"], True)
+        self.assertEqual(res.status_code, 304)
 
-        menu_id = data["id"]
-        res = self.client().get(f"/menu/{menu_id}")
-        data = res.get_json()
+        self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"name": "Green Salad"},
+            headers=get_headers_recipe_user(),
+        )
+        res = self.client().get(
+            f"/menu/{menu_id}",
+            headers={"If-None-Match": etag},
+        )
 
         self.assertEqual(res.status_code, 200)
-        self.assertEqual(data["success"], True)
-        self.assertEqual(data["menu"]["name"], "Testmenu")
+        self.assertEqual(res.get_json()["menu"]["dishes"][0]["name"], "Green Salad")
 
-    def test_add_menu_error_missing_name(self):
+    def test_get_menu_cache_invalidated_by_recipe_update(self):
         recipe = create_simple_salad()
+        menu = create_menu(
+            name="Testmenu",
+            username="menu@recipe.dabr.ch",
+            dishes=[recipe],
+        )
         with self.app.app_context():
             self.db.session.add(recipe)
+            self.db.session.add(menu)
             self.db.session.flush()
             recipe_id = recipe.id
+            menu_id = menu.id
             self.db.session.commit()
 
-        menu = {
-            "dishes": [{"recipe_id": recipe_id}],
-        }
-        res = self.client().post(
+        self.client().get(f"/menu/{menu_id}")
+        self.client().patch(
+            f"/recipe/{recipe_id}",
+            json={"name": "Green Salad"},
+            headers=get_headers_recipe_user(),
+        )
+        res = self.client().get(f"/menu/{menu_id}")
+
+        self.assertEqual(res.get_json()["menu"]["dishes"][0]["name"], "Green Salad")
+        self.assertEqual(response_cache.stats()["hits"], 0)
+
+    def test_get_menu_error_not_found(self):
+        res = self.client().get(f"/menu/1")
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+
+    def test_add_menu(self):
+        recipe = create_simple_salad()
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        menu = {
+            "name": "Testmenu",
+            "dishes": [{"recipe_id": recipe_id}],
+        }
+        res = self.client().post(
+            "/menu",
+            json=menu,
+            headers=get_headers_menu_user(),
+        )
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+
+        menu_id = data["id"]
+        res = self.client().get(f"/menu/{menu_id}")
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["menu"]["name"], "Testmenu")
+
+    def test_add_menu_error_missing_recipes(self):
+        recipe = create_simple_salad()
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        menu = {
+            "name": "Testmenu",
+            "dishes": [
+                {"recipe_id": 101},
+                {"recipe_id": recipe_id},
+                {"recipe_id": 102},
+            ],
+        }
+        res = self.client().post(
+            "/menu",
+            json=menu,
+            headers=get_headers_menu_user(),
+        )
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertIn("101, 102", data["message"])
+
+    def test_add_menu_error_invalid_dishes(self):
+        for dishes, message in (
+            ([1], "Dish 0 is not a JSON object"),
+            (1, "Field 'dishes' is not a list"),
+        ):
+            res = self.client().post(
+                "/menu",
+                json={"name": "Testmenu", "dishes": dishes},
+                headers=get_headers_menu_user(),
+            )
+            data = res.get_json()
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data["success"], False)
+            self.assertIn(message, data["message"])
+
+    def test_add_menu_batch_resolves_dishes(self):
+        with self.app.app_context():
+            recipes = [create_simple_salad() for _ in range(30)]
+            self.db.session.add_all(recipes)
+            self.db.session.flush()
+            recipe_ids = [recipe.id for recipe in recipes]
+            self.db.session.commit()
+
+        menu = {
+            "name": "Testmenu",
+            "dishes": [
+                {"recipe_id": recipe_id}
+                for recipe_id
+                in recipe_ids + recipe_ids[:5]
+            ],
+        }
+        with self.app.app_context():
+            with capture_queries(self.db.engine) as queries:
+                res = self.client().post(
+                    "/menu",
+                    json=menu,
+                    headers=get_headers_menu_user(),
+                )
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        selects = [
+            statement
+            for statement, _ in queries
+            if statement.startswith("SELECT")
+        ]
+        self.assertEqual(len(selects), 1)
+
+        res = self.client().get(f"/menu/{data['id']}")
+        data = res.get_json()
+
+        self.assertEqual(data["menu"]["number_of_dishes"], 30)
+
+    def test_add_menu_error_missing_name(self):
+        recipe = create_simple_salad()
+        with self.app.app_context():
+            self.db.session.add(recipe)
+            self.db.session.flush()
+            recipe_id = recipe.id
+            self.db.session.commit()
+
+        menu = {
+            "dishes": [{"recipe_id": recipe_id}],
+        }
+        res = self.client().post(
             "/menu",
             json=menu,
             headers=get_headers_menu_user(),
@@ -666,7 +1608,7 @@ class RecipeTestCase(unittest.TestCase):
 
     def test_update_menu(self):
         recipe = create_simple_salad()
-        menu = Menu(
+        menu = create_menu(
             name="Testmenu",
             username="menu@recipe.dabr.ch",
             dishes=[recipe],
@@ -743,7 +1685,7 @@ class RecipeTestCase(unittest.TestCase):
 
     def test_update_menu_error_wrong_user(self):
         recipe = create_simple_salad()
-        menu = Menu(
+        menu = create_menu(
             name="Testmenu",
             username="test@recipe.dabr.ch",
             dishes=[recipe],
@@ -771,7 +1713,7 @@ class RecipeTestCase(unittest.TestCase):
 
     def test_update_menu_wrong_user_but_admin(self):
         recipe = create_simple_salad()
-        menu = Menu(
+        menu = create_menu(
             name="Testmenu",
             username="test@recipe.dabr.ch",
             dishes=[recipe],
@@ -799,7 +1741,7 @@ class RecipeTestCase(unittest.TestCase):
         
     def test_delete_menu(self):
         recipe = create_simple_salad()
-        menu = Menu(
+        menu = create_menu(
             name="Testmenu",
             username="menu@recipe.dabr.ch",
             dishes=[recipe],
@@ -859,7 +1801,7 @@ class RecipeTestCase(unittest.TestCase):
 
     def test_delete_menu_error_wrong_user(self):
         recipe = create_simple_salad()
-        menu = Menu(
+        menu = create_menu(
             name="Testmenu",
             username="test@recipe.dabr.ch",
             dishes=[recipe],
@@ -883,7 +1825,7 @@ class RecipeTestCase(unittest.TestCase):
         
     def test_delete_menu_wrong_user_but_admin(self):
         recipe = create_simple_salad()
-        menu = Menu(
+        menu = create_menu(
             name="Testmenu",
             username="test@recipe.dabr.ch",
             dishes=[recipe],
@@ -907,7 +1849,7 @@ class RecipeTestCase(unittest.TestCase):
         
     def test_delete_menu_recipe_retained(self):
         recipe = create_simple_salad()
-        menu = Menu(
+        menu = create_menu(
             name="Testmenu",
             username="menu@recipe.dabr.ch",
             dishes=[recipe],
@@ -936,6 +1878,1299 @@ class RecipeTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
 
+    def test_menu_usage_counts(self):
+        salad = create_simple_salad()
+        spaghetti = create_spaghetti_with_tomato_sauce()
+        with self.app.app_context():
+            self.db.session.add_all([salad, spaghetti])
+            self.db.session.flush()
+            salad_id = salad.id
+            spaghetti_id = spaghetti.id
+            self.db.session.commit()
+
+        def counts():
+            recipes = self.client().get("/recipe").get_json()["recipes"]
+            menus = self.client().get("/menu").get_json()["menus"]
+            return (
+                {recipe["id"]: recipe["number_of_menus"] for recipe in recipes},
+                [menu["number_of_dishes"] for menu in menus],
+            )
+
+        etag = self.client().get("/recipe").headers["ETag"]
+        for name in ("First", "Second"):
+            res = self.client().post(
+                "/menu",
+                json={"name": name, "dishes": [{"recipe_id": salad_id}]},
+                headers=get_headers_menu_user(),
+            )
+            menu_id = res.get_json()["id"]
+
+        self.assertEqual(counts(), ({salad_id: 2, spaghetti_id: 0}, [1, 1]))
+        self.assertNotEqual(self.client().get("/recipe").headers["ETag"], etag)
+
+        self.client().patch(
+            f"/menu/{menu_id}",
+            json={"dishes": [{"recipe_id": spaghetti_id}, {"recipe_id": salad_id}]},
+            headers=get_headers_menu_user(),
+        )
+
+        self.assertEqual(counts(), ({salad_id: 2, spaghetti_id: 1}, [1, 2]))
+
+        self.client().patch(
+            f"/menu/{menu_id}",
+            json={"dishes": [{"recipe_id": spaghetti_id}]},
+            headers=get_headers_menu_user(),
+        )
+
+        self.assertEqual(counts(), ({salad_id: 1, spaghetti_id: 1}, [1, 1]))
+
+        self.client().delete(f"/menu/{menu_id}", headers=get_headers_menu_user())
+
+        self.assertEqual(counts(), ({salad_id: 1, spaghetti_id: 0}, [1]))
+        res = self.client().delete(
+            f"/recipe/{spaghetti_id}",
+            headers=get_headers_recipe_user(),
+        )
+        self.assertEqual(res.status_code, 200)
+
+    def test_sparse_fields_lists(self):
+        salad = create_simple_salad()
+        menu = create_menu(
+            name="Testmenu",
+            username="menu@recipe.dabr.ch",
+            dishes=[salad],
+        )
+        with self.app.app_context():
+            self.db.session.add_all([salad, menu])
+            self.db.session.commit()
+
+            with capture_queries(self.db.engine) as queries:
+                res = self.client().get("/recipe?fields=name")
+        statements = " ".join(statement for statement, _ in queries)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()["recipes"], [{"id": 1, "name": "Simple Salad"}])
+        self.assertNotIn("preparation", statements)
+        self.assertNotIn("username", statements)
+        self.assertNotEqual(res.headers["ETag"], self.client().get("/recipe").headers["ETag"])
+
+        res = self.client().get("/menu?limit=5&fields=number_of_dishes")
+
+        self.assertEqual(res.get_json()["menus"], [{"id": 1, "number_of_dishes": 1}])
+
+        res = self.client().get("/menu?fields=name,dishes")
+
+        self.assertEqual(res.status_code, 400)
+        self.assertIn("Unknown fields: dishes", res.get_json()["message"])
+
+    def test_sparse_fields_details(self):
+        salad = create_simple_salad()
+        menu = create_menu(
+            name="Testmenu",
+            username="menu@recipe.dabr.ch",
+            dishes=[salad],
+        )
+        with self.app.app_context():
+            self.db.session.add_all([salad, menu])
+            self.db.session.commit()
+
+            with capture_queries(self.db.engine) as queries:
+                res = self.client().get("/recipe/1?fields=name,servings")
+        statements = " ".join(statement for statement, _ in queries)
+        etag = res.headers["ETag"]
+
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn("preparation", statements)
+        self.assertEqual(
+            res.get_json()["recipe"],
+            {"id": 1, "name": "Simple Salad", "servings": 4},
+        )
+        self.assertNotEqual(etag, self.client().get("/recipe/1").headers["ETag"])
+
+        res = self.client().get(
+            "/recipe/1?fields=name,servings",
+            headers={"If-None-Match": etag},
+        )
+
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client().get("/menu/1?fields=dishes")
+
+        self.assertEqual(res.get_json()["menu"], {
+            "id": 1,
+            "dishes": [{
+                "id": 1,
+                "name": "Simple Salad",
+                "username": "recipe@recipe.dabr.ch",
+            }],
+        })
+        self.assertEqual(self.client().get("/menu/2?fields=name").status_code, 404)
+
+        with self.app.app_context():
+            with capture_queries(self.db.engine) as queries:
+                recipe = self.db.session.get(Recipe, 1)
+            # preparation is deferred by default
+            self.assertNotIn("preparation", queries.statements[0][0])
+            self.assertIn("Wash and cut lettuce", recipe.preparation)
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    """
+    This class runs every route against a seeded database,
+    explains all statements the route executes and fails
+    if one of them sequentially scans a large table.
+    """
+
+    LARGE_TABLES = {"recipe", "ingredient", "menu", "menu_recipe_table"}
+
+    def setUp(self):
+        self.app = app
+        self.db = db
+        response_cache.clear()
+        self.client = self.app.test_client
+        with self.app.app_context():
+            self.db.create_all()
+            recipes = []
+            for idx in range(300):
+                recipe = create_simple_salad()
+                recipe.name = f"Salad {idx:03}"
+                recipes.append(recipe)
+                self.db.session.add(recipe)
+            for idx in range(30):
+                self.db.session.add(create_menu(
+                    name=f"Menu {idx:02}",
+                    username="menu@recipe.dabr.ch",
+                    dishes=recipes[idx * 5:idx * 5 + 5],
+                ))
+            self.db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.db.session.close()
+        os.remove(os.path.join(self.app.instance_path, "test-database.db"))
+
+    def assertNoSeqScans(self, method, url, **kwargs):
+        with self.app.app_context():
+            engine = self.db.engine
+            with capture_queries(engine) as queries:
+                res = getattr(self.client(), method)(url, **kwargs)
+            self.assertLess(res.status_code, 500)
+            self.assertGreater(len(queries), 0)
+            with engine.connect() as connection:
+                scans = find_seq_scans(
+                    connection,
+                    queries,
+                    self.LARGE_TABLES,
+                )
+        self.assertEqual(scans, [], f"{method.upper()} {url}")
+        return res
+
+    def test_query_plans_read_routes(self):
+        self.assertNoSeqScans("get", "/recipe")
+        self.assertNoSeqScans("get", "/recipe?page=5")
+        res = self.assertNoSeqScans("get", "/recipe?limit=10")
+        cursor = res.get_json()["next_cursor"]
+        self.assertNoSeqScans("get", f"/recipe?limit=10&after={cursor}")
+        self.assertNoSeqScans("get", "/recipe/42")
+        self.assertNoSeqScans("get", "/menu")
+        self.assertNoSeqScans("get", "/menu?limit=5")
+        self.assertNoSeqScans("get", "/menu/7")
+        self.assertNoSeqScans("get", "/menu/shopping-list?ids=3,7&servings=2")
+
+    def test_query_plans_write_routes(self):
+        self.assertNoSeqScans(
+            "post",
+            "/recipe",
+            json={
+                "name": "Test",
+                "servings": 1,
+                "ingredients": [{"name": "bread", "amount": 1}],
+            },
+            headers=get_headers_recipe_user(),
+        )
+        self.assertNoSeqScans(
+            "patch",
+            "/recipe/250",
+            json={"ingredients": [{"name": "bread", "amount": 1}]},
+            headers=get_headers_admin_user(),
+        )
+        self.assertNoSeqScans(
+            "delete",
+            "/recipe/3",
+            headers=get_headers_admin_user(),
+        )
+        self.assertNoSeqScans(
+            "delete",
+            "/recipe/260",
+            headers=get_headers_admin_user(),
+        )
+        self.assertNoSeqScans(
+            "post",
+            "/menu",
+            json={"name": "Test", "dishes": [{"recipe_id": 270}]},
+            headers=get_headers_menu_user(),
+        )
+        self.assertNoSeqScans(
+            "patch",
+            "/menu/2",
+            json={"dishes": [{"recipe_id": 280}, {"recipe_id": 281}]},
+            headers=get_headers_admin_user(),
+        )
+        self.assertNoSeqScans(
+            "delete",
+            "/menu/3",
+            headers=get_headers_admin_user(),
+        )
+
+
+class QueryBudgetTestCase(unittest.TestCase):
+    """
+    This class checks that the read routes stay within the query
+    budgets declared by @query_budget, also for recipes with many
+    ingredients and menus with many dishes.
+    """
+
+    def setUp(self):
+        self.app = app
+        self.db = db
+        response_cache.clear()
+        self.client = self.app.test_client
+        with self.app.app_context():
+            self.db.create_all()
+            recipes = []
+            for idx in range(10):
+                recipe = create_spaghetti_with_tomato_sauce()
+                for jdx in range(20):
+                    recipe.ingredients.append(
+                        Ingredient(name=f"spice {jdx}", amount=1)
+                    )
+                recipes.append(recipe)
+                self.db.session.add(recipe)
+            menu = create_menu(
+                name="Testmenu",
+                username="menu@recipe.dabr.ch",
+                dishes=recipes,
+            )
+            self.db.session.add(menu)
+            self.db.session.flush()
+            self.recipe_id = recipes[0].id
+            self.menu_id = menu.id
+            self.db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.db.session.close()
+        os.remove(os.path.join(self.app.instance_path, "test-database.db"))
+
+    def assertWithinBudget(self, endpoint, url):
+        budget = self.app.view_functions[endpoint].query_budget
+        with self.app.app_context():
+            with max_queries(budget, self.db.engine):
+                res = self.client().get(url)
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_query_budget_recipe_routes(self):
+        self.assertWithinBudget("get_recipe_list", "/recipe")
+        self.assertWithinBudget("get_recipe_list", "/recipe?limit=5")
+        data = self.assertWithinBudget(
+            "get_recipe",
+            f"/recipe/{self.recipe_id}",
+        )
+        self.assertEqual(len(data["recipe"]["ingredients"]), 27)
+
+    def test_query_budget_menu_routes(self):
+        self.assertWithinBudget("get_menu_list", "/menu")
+        self.assertWithinBudget("get_menu_list", "/menu?limit=5")
+        data = self.assertWithinBudget("get_menu", f"/menu/{self.menu_id}")
+        self.assertEqual(data["menu"]["number_of_dishes"], 10)
+
+
+class QueryGuardTestCase(unittest.TestCase):
+    """
+    This class tests the detection of N+1 patterns
+    and the enforcement of the query budgets.
+    """
+
+    def setUp(self):
+        with app.app_context():
+            db.create_all()
+            for _ in range(3):
+                db.session.add(create_simple_salad())
+            db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.close()
+        os.remove(os.path.join(app.instance_path, "test-database.db"))
+
+    def create_app(self, budget):
+        flask_app = Flask(__name__)
+        engine = create_engine("sqlite://")
+
+        @flask_app.route("/budget")
+        @query_budget(budget)
+        def budget_route():
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+                connection.execute(text("SELECT 2"))
+            return jsonify({"success": True})
+
+        setup_query_guard(flask_app)
+        return flask_app
+
+    def test_detects_lazy_loads(self):
+        with app.app_context():
+            with self.assertRaises(QueryBudgetExceeded) as context:
+                with max_queries(10, db.engine):
+                    for recipe in Recipe.query.all():
+                        recipe.ingredients[0]
+            db.session.remove()
+
+        self.assertIn("executed 3 times (N+1)", str(context.exception))
+        self.assertIn("FROM ingredient", str(context.exception))
+
+    def test_allow_repeated(self):
+        with app.app_context():
+            with max_queries(10, db.engine, allow_repeated=True) as log:
+                for recipe in Recipe.query.all():
+                    recipe.ingredients[0]
+            db.session.remove()
+
+        self.assertEqual(len(log), 4)
+
+    def test_max_queries_decorator(self):
+        @max_queries(1)
+        def two_queries():
+            engine = create_engine("sqlite://")
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+                connection.execute(text("SELECT 1"))
+
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            two_queries()
+
+        self.assertIn("executed 2 statements, the budget is 1", str(context.exception))
+
+    def test_add_recipe_budget_independent_of_ingredients(self):
+        recipe = {
+            "name": "Large salad",
+            "servings": 2,
+            "ingredients": [
+                {"name": f"vegetable {idx}", "amount": 1}
+                for idx
+                in range(12)
+            ],
+        }
+
+        res = app.test_client().post(
+            "/recipe",
+            json=recipe,
+            headers=get_headers_recipe_user(),
+        )
+
+        self.assertEqual(res.status_code, 200)
+        with app.app_context():
+            recipe = db.session.get(Recipe, res.get_json()["id"])
+            self.assertEqual(len(recipe.ingredients), 12)
+
+    def test_route_budget(self):
+        self.assertEqual(
+            self.create_app(2).test_client().get("/budget").status_code,
+            200,
+        )
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            self.create_app(1).test_client().get("/budget")
+
+        self.assertIn("GET /budget executed 2 statements", str(context.exception))
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """
+    Serves the subset of the Redis protocol used by RedisCache
+    from a dict, so that no redis server is needed for the tests.
+    """
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            command = args[0].upper()
+            if command == b"GET":
+                reply = data.get(args[1])
+            elif command == b"MGET":
+                reply = [data.get(key) for key in args[1:]]
+            elif command == b"SET":
+                data[args[1]] = args[2]
+                reply = "OK"
+            elif command == b"DEL":
+                reply = sum(1 for key in args[1:] if data.pop(key, None))
+            elif command == b"INCR":
+                data[args[1]] = b"%d" % (int(data.get(args[1], 0)) + 1)
+                reply = int(data[args[1]])
+            elif command == b"EXISTS":
+                reply = sum(1 for key in args[1:] if key in data)
+            elif command == b"SCAN":
+                prefix = args[3].rstrip(b"*")
+                reply = [b"0", [key for key in data if key.startswith(prefix)]]
+            self.wfile.write(self.encode(reply))
+
+    def encode(self, reply):
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, str):
+            return b"+%s\r\n" % reply.encode()
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        return b"*%d\r\n" % len(reply) + b"".join(
+            self.encode(item) for item in reply
+        )
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """
+    This class tests the response cache backends. The shared
+    backends are tested with two instances, which play the role
+    of two gunicorn workers.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = socketserver.ThreadingTCPServer(
+            ("127.0.0.1", 0),
+            FakeRedisHandler,
+        )
+        self.server.daemon_threads = True
+        self.server.data = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def create_shared_caches(self):
+        path = os.path.join(self.tmpdir.name, "cache.db")
+        host, port = self.server.server_address
+        return [
+            (
+                create_cache(f"sqlite:///{path}", 1000),
+                create_cache(f"sqlite:///{path}", 1000),
+            ),
+            (
+                create_cache(f"redis://{host}:{port}/0", 1000),
+                create_cache(f"redis://{host}:{port}/0", 1000),
+            ),
+        ]
+
+    def test_memory_lru_eviction_by_size(self):
+        cache = MemoryCache(max_bytes=100)
+        cache.set("recipe:1", b"x" * 40, "recipe-1-1", 0)
+        cache.set("recipe:2", b"x" * 40, "recipe-2-1", 0)
+        cache.get("recipe:1")
+        cache.set("recipe:3", b"x" * 40, "recipe-3-1", 0)
+
+        self.assertIsNotNone(cache.get("recipe:1"))
+        self.assertIsNone(cache.get("recipe:2"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["size_bytes"], 80)
+
+    def test_memory_invalidate(self):
+        cache = MemoryCache(max_bytes=100)
+        cache.set("menu:1", b"{}", "menu-1-1", 0)
+        cache.invalidate("menu:1", "menu:2")
+
+        self.assertIsNone(cache.get("menu:1"))
+        self.assertEqual(cache.stats()["size_bytes"], 0)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_memory_generations_are_bounded(self):
+        cache = MemoryCache(max_bytes=100, max_generations=2)
+        generation = cache.generation("recipe:1")
+        for idx in range(2, 6):
+            cache.invalidate(f"recipe:{idx}")
+        cache.invalidate("recipe:1")
+        cache.invalidate("recipe:6")
+        cache.invalidate("recipe:7")
+
+        self.assertEqual(len(cache._generations), 2)
+        # the generation read before the invalidation stays outdated
+        cache.set("recipe:1", b"{}", "recipe-1-1", generation)
+        self.assertIsNone(cache.get("recipe:1"))
+        generation = cache.generation("recipe:1")
+        cache.set("recipe:1", b"{}", "recipe-1-2", generation)
+        self.assertEqual(cache.get("recipe:1"), (b"{}", "recipe-1-2"))
+
+    def test_shared_invalidation_is_seen_by_other_worker(self):
+        for worker1, worker2 in self.create_shared_caches():
+            generation = worker1.generation("recipe:1")
+            worker1.set("recipe:1", b'{"id": 1}', "recipe-1-1", generation)
+
+            self.assertEqual(
+                worker2.get("recipe:1"),
+                (b'{"id": 1}', "recipe-1-1"),
+            )
+
+            worker2.invalidate("recipe:1")
+
+            self.assertIsNone(worker1.get("recipe:1"))
+            self.assertEqual(worker1.stats()["hits"], 0)
+            self.assertEqual(worker2.stats()["hits"], 1)
+
+    def test_shared_mark_is_seen_by_other_worker(self):
+        for worker1, worker2 in self.create_shared_caches():
+            worker1.mark("recent-write:a", 10)
+            worker1.mark("recent-write:b", 0)
+
+            self.assertTrue(worker2.marked("recent-write:a"))
+            self.assertFalse(worker2.marked("recent-write:b"))
+
+            worker2.clear()
+
+            self.assertFalse(worker1.marked("recent-write:a"))
+
+    def test_shared_stale_entry_is_rejected(self):
+        for worker1, worker2 in self.create_shared_caches():
+            generation = worker1.generation("menu:1")
+            worker2.invalidate("menu:1")
+            worker1.set("menu:1", b"{}", "menu-1-1", generation)
+
+            self.assertIsNone(worker2.get("menu:1"))
+
+            worker1.clear()
+            generation = worker1.generation("menu:1")
+            worker1.set("menu:1", b"{}", "menu-1-2", generation)
+
+            self.assertEqual(worker2.get("menu:1"), (b"{}", "menu-1-2"))
+
+    def test_sqlite_size_limit(self):
+        worker1, worker2 = self.create_shared_caches()[0]
+        for idx in range(5):
+            worker1.set(f"recipe:{idx}", b"x" * 300, "etag", 0)
+
+        self.assertEqual(worker2.stats()["entries"], 3)
+        self.assertEqual(worker2.stats()["evictions"], 2)
+        self.assertIsNone(worker2.get("recipe:0"))
+        self.assertIsNotNone(worker2.get("recipe:4"))
+
+
+    def get_unused_port(self):
+        with socketserver.TCPServer(("127.0.0.1", 0), None) as server:
+            return server.server_address[1]
+
+    def test_redis_unavailable_is_a_miss(self):
+        cache = create_cache(f"redis://127.0.0.1:{self.get_unused_port()}/0", 1000)
+
+        with self.assertLogs(level="WARNING") as logs:
+            self.assertIsNone(cache.generation("recipe:1"))
+            cache.set("recipe:1", b"{}", "recipe-1-1", None)
+            cache.invalidate("recipe:1")
+            self.assertIsNone(cache.get("recipe:1"))
+
+        # only the first command tries to connect until retry_seconds passed
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Redis cache unavailable", logs.output[0])
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["pending_invalidations"], 1)
+
+    def test_redis_failed_invalidation_is_sent_later(self):
+        host, port = self.server.server_address
+        worker1 = create_cache(f"redis://{host}:{port}/0", 1000)
+        worker2 = RedisCache(f"redis://{host}:{port}/0", 1000, retry_seconds=0)
+        worker1.set("recipe:1", b"{}", "recipe-1-1", worker1.generation("recipe:1"))
+
+        worker2.port = self.get_unused_port()
+        with self.assertLogs(level="WARNING"):
+            worker2.invalidate("recipe:1")
+        self.assertIsNotNone(worker1.get("recipe:1"))
+
+        worker2.port = port
+        worker2.get("recipe:2")
+
+        self.assertIsNone(worker1.get("recipe:1"))
+        self.assertEqual(worker2.stats()["pending_invalidations"], 0)
+
+    def test_redis_size_limit(self):
+        host, port = self.server.server_address
+        cache = create_cache(f"redis://{host}:{port}/0", 100)
+        cache.set("recipe:1", b"x" * 300, "recipe-1-1", 0)
+
+        self.assertIsNone(cache.get("recipe:1"))
+
+    def test_max_bytes_zero_disables_cache(self):
+        host, port = self.server.server_address
+        for url in ("memory://", f"redis://{host}:{port}/0"):
+            cache = create_cache(url, 0)
+            cache.set("recipe:1", b"{}", "recipe-1-1", cache.generation("recipe:1"))
+
+            self.assertIsInstance(cache, NullCache)
+            self.assertIsNone(cache.get("recipe:1"))
+        self.assertEqual(self.server.data, {})
+
+class IngredientIndexTestCase(unittest.TestCase):
+    """
+    This class tests the ingredient index, in particular that
+    the numpy and the pure python matching rank alike.
+    """
+
+    def setUp(self):
+        self.index = IngredientIndex()
+        names = [f"ingredient {idx}" for idx in range(40)]
+        self.index.load(
+            [
+                (recipe_id, names[(recipe_id * 7 + idx * 3) % len(names)])
+                for recipe_id in range(1, 500)
+                for idx in range(1 + recipe_id % 9)
+            ],
+            0,
+        )
+        self.pantry = names[:6]
+
+    def test_normalize(self):
+        self.assertEqual(pantry.normalize_ingredient(" Olive  Oil "), "olive oil")
+        self.assertEqual(
+            pantry.normalize_ingredient("3 teaspoons of sun flower oil"),
+            "sun flower oil",
+        )
+        self.assertEqual(pantry.normalize_ingredient("a pinch of salt"), "salt")
+        self.assertEqual(
+            pantry.normalize_ingredient("bunches of spring onions"),
+            "spring onions",
+        )
+
+    def test_normalize_keeps_names_containing_of(self):
+        for name in ("cream of tartar", "zest of a lemon", "cream of mushroom soup"):
+            self.assertEqual(pantry.normalize_ingredient(name), name)
+        self.assertEqual(
+            pantry.normalize_ingredient("2 spoons of cream of tartar"),
+            "cream of tartar",
+        )
+
+    def test_match_numpy_and_python_agree(self):
+        if pantry.numpy is None:
+            self.skipTest("numpy is not installed")
+        with self.index._lock:
+            vectorized = self.index._match_numpy(set(self.pantry), 25)
+            python = self.index._match_python(set(self.pantry), 25)
+
+        self.assertEqual(len(vectorized), 25)
+        self.assertEqual(vectorized, python)
+
+    def test_match_after_remove(self):
+        best = self.index.match(self.pantry, 1)[0][0]
+        self.index.remove_recipe(best)
+
+        self.assertNotIn(best, [match[0] for match in self.index.match(self.pantry, 100)])
+
+
+class SeedTestCase(unittest.TestCase):
+    """
+    This class tests the generation of synthetic data
+    and the flask seed command.
+    """
+
+    def setUp(self):
+        self.app = app
+        self.db = db
+        response_cache.clear()
+        ingredient_index.clear()
+        with self.app.app_context():
+            self.db.create_all()
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        with self.app.app_context():
+            self.db.session.close()
+        os.remove(os.path.join(self.app.instance_path, "test-database.db"))
+
+    def test_generator_is_deterministic(self):
+        first = DataGenerator(7)
+        second = DataGenerator(7)
+
+        self.assertEqual(
+            [first.recipe(idx) for idx in range(20)],
+            [second.recipe(idx) for idx in range(20)],
+        )
+        self.assertNotEqual(DataGenerator(8).recipe(0), DataGenerator(7).recipe(0))
+
+    def test_seed_command(self):
+        runner = self.app.test_cli_runner()
+
+        result = runner.invoke(args=["seed", "--recipes", "200", "--menus", "15"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Added 200 recipes and 15 menus", result.output)
+        with self.app.app_context():
+            self.assertEqual(Recipe.query.count(), 200)
+            self.assertEqual(Menu.query.count(), 15)
+            self.assertGreaterEqual(Ingredient.query.count(), 400)
+            recipe = self.db.session.get(Recipe, 200)
+            ingredient = recipe.ingredients[0].name
+            # the counts match the dishes
+            for menu in Menu.query.all():
+                self.assertEqual(menu.dish_count, len(menu.dishes))
+            for recipe in Recipe.query.all():
+                self.assertEqual(recipe.menu_count, len(recipe.menus))
+
+        # the search index covers the ingredients of the seeded recipes
+        res = self.client().get(f"/recipe/search?q={ingredient}&limit=100")
+        self.assertIn(200, [recipe["id"] for recipe in res.get_json()["recipes"]])
+
+        # new recipes get ids after the seeded ones
+        res = self.client().post(
+            "/recipe",
+            json={"name": "Toast", "servings": 1, "ingredients": []},
+            headers=get_headers_recipe_user(),
+        )
+        self.assertEqual(res.get_json()["id"], 201)
+
+        result = runner.invoke(args=["seed", "--recipes", "10", "--clear"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        with self.app.app_context():
+            self.assertEqual(Recipe.query.count(), 10)
+            self.assertEqual(Menu.query.count(), 1)
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """
+    This class tests the routing of public reads to a read replica,
+    using a second sqlite database with different contents.
+    """
+
+    def setUp(self):
+        self.app = app
+        self.db = db
+        response_cache.clear()
+        with self.app.app_context():
+            self.db.create_all()
+            self.db.session.add(create_simple_salad())
+            self.db.session.commit()
+        self.path = tempfile.mktemp(suffix=".db")
+        replicas.configure([f"sqlite:///{self.path}"])
+        self.db.metadata.create_all(replicas.engines[0])
+        with Session(replicas.engines[0]) as session:
+            session.add(create_spaghetti_with_tomato_sauce())
+            session.commit()
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        replicas.configure([])
+        os.remove(self.path)
+        with self.app.app_context():
+            self.db.session.close()
+        os.remove(os.path.join(self.app.instance_path, "test-database.db"))
+
+    def get_recipe_names(self, client, headers=None):
+        res = client.get("/recipe", headers=headers)
+        self.assertEqual(res.status_code, 200)
+        return [recipe["name"] for recipe in res.get_json()["recipes"]]
+
+    def test_lists_read_from_replica(self):
+        self.assertEqual(
+            self.get_recipe_names(self.client()),
+            ["Spaghetti with tomato sauce"],
+        )
+        res = self.client().get("/menu?limit=5")
+        self.assertEqual(res.get_json()["menus"], [])
+
+    def test_writes_go_to_primary(self):
+        res = self.client().patch(
+            "/recipe/1",
+            json={"name": "Green Salad"},
+            headers=get_headers_recipe_user(),
+        )
+        self.assertEqual(res.status_code, 200)
+
+        with self.app.app_context():
+            self.assertEqual(self.db.session.get(Recipe, 1).name, "Green Salad")
+        with Session(replicas.engines[0]) as session:
+            self.assertEqual(
+                session.get(Recipe, 1).name,
+                "Spaghetti with tomato sauce",
+            )
+
+    def test_read_your_writes(self):
+        client = self.client()
+        res = client.post(
+            "/recipe",
+            json={"name": "New Salad", "servings": 1, "ingredients": []},
+            headers=get_headers_recipe_user(),
+        )
+
+        self.assertIn("recent_write=1", res.headers["Set-Cookie"])
+        self.assertEqual(
+            self.get_recipe_names(client),
+            ["New Salad", "Simple Salad"],
+        )
+        # other clients still read from the replica
+        self.assertEqual(
+            self.get_recipe_names(self.client()),
+            ["Spaghetti with tomato sauce"],
+        )
+
+    def test_read_your_writes_without_cookies(self):
+        # like call.py, which sends the token but no cookies
+        client = self.app.test_client(use_cookies=False)
+        res = client.post(
+            "/recipe",
+            json={"name": "New Salad", "servings": 1, "ingredients": []},
+            headers=get_headers_recipe_user(),
+        )
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(
+            self.get_recipe_names(client, get_headers_recipe_user()),
+            ["New Salad", "Simple Salad"],
+        )
+        self.assertEqual(
+            self.get_recipe_names(client, get_headers_menu_user()),
+            ["Spaghetti with tomato sauce"],
+        )
+        self.assertEqual(
+            self.get_recipe_names(client),
+            ["Spaghetti with tomato sauce"],
+        )
+
+    def test_read_your_writes_expires(self):
+        sticky_seconds = replicas.sticky_seconds
+        replicas.sticky_seconds = 0
+        try:
+            self.client(use_cookies=False).post(
+                "/recipe",
+                json={"name": "New Salad", "servings": 1, "ingredients": []},
+                headers=get_headers_recipe_user(),
+            )
+        finally:
+            replicas.sticky_seconds = sticky_seconds
+
+        self.assertEqual(
+            self.get_recipe_names(self.client(), get_headers_recipe_user()),
+            ["Spaghetti with tomato sauce"],
+        )
+
+    def test_public_post_does_not_stick_to_primary(self):
+        res = self.client().post("/recipe/match", json={"ingredients": ["basil"]})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("Set-Cookie", res.headers)
+
+
+class DatabasePoolTestCase(unittest.TestCase):
+    """
+    This class tests the configuration of the connection pool
+    and the checkout metrics.
+    """
+
+    def setUp(self):
+        pool_metrics.reset()
+        self.path = tempfile.mktemp(suffix=".db")
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_engine_options_defaults(self):
+        options = get_engine_options("postgresql://u:p@localhost/recipes", {})
+
+        self.assertEqual(options["poolclass"], TimedQueuePool)
+        self.assertEqual(options["pool_size"], 5)
+        self.assertEqual(options["max_overflow"], 10)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(options["pool_recycle"], 1800)
+
+    def test_engine_options_from_environment(self):
+        options = get_engine_options("postgresql://u:p@localhost/recipes", {
+            "DB_POOL_SIZE": "2",
+            "DB_MAX_OVERFLOW": "0",
+            "DB_POOL_TIMEOUT": "2.5",
+            "DB_POOL_RECYCLE": "300",
+            "DB_POOL_PRE_PING": "false",
+        })
+
+        self.assertEqual(options["pool_size"], 2)
+        self.assertEqual(options["max_overflow"], 0)
+        self.assertEqual(options["pool_timeout"], 2.5)
+        self.assertEqual(options["pool_recycle"], 300)
+        self.assertFalse(options["pool_pre_ping"])
+
+    def test_engine_options_external_pooler(self):
+        options = get_engine_options(
+            "postgresql://u:p@localhost:6432/recipes",
+            {"DB_EXTERNAL_POOLER": "true", "DB_POOL_SIZE": "20"},
+        )
+
+        self.assertEqual(options["poolclass"], TimedNullPool)
+        self.assertNotIn("pool_size", options)
+
+    def test_engine_options_sqlite_keeps_default_pool(self):
+        options = get_engine_options("sqlite:///test.db", {})
+
+        self.assertNotIn("poolclass", options)
+
+    def test_checkout_metrics(self):
+        engine = create_engine(
+            f"sqlite:///{self.path}",
+            poolclass=TimedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=0.1,
+        )
+        with engine.connect():
+            with self.assertRaises(exc.TimeoutError):
+                engine.connect()
+            stats = pool_stats(engine)
+
+        self.assertEqual(stats["checkouts"], 1)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["checked_out"], 1)
+        self.assertGreaterEqual(stats["wait_seconds_max"], 0.1)
+        engine.dispose()
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """
+    This class tests the evaluation of load test results.
+    """
+
+    def test_percentile_ms(self):
+        latencies = [idx / 1000 for idx in range(1, 101)]
+
+        self.assertEqual(percentile_ms(latencies, 50), 50)
+        self.assertEqual(percentile_ms(latencies, 99), 99)
+        self.assertEqual(percentile_ms([0.002], 95), 2)
+        self.assertIsNone(percentile_ms([], 50))
+
+    def test_compare_results(self):
+        baseline = {"routes": {
+            "GET /recipe": {"rps": 100, "p95_ms": 10},
+            "GET /menu": {"rps": 100, "p95_ms": 10},
+        }}
+        results = {"routes": {
+            "GET /recipe": {"rps": 90, "p95_ms": 11},
+            "GET /menu": {"rps": 70, "p95_ms": 15},
+            "GET /recipe/search": {"rps": 10, "p95_ms": 100},
+        }}
+
+        regressions = compare_results(results, baseline, 0.2)
+
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(line.startswith("GET /menu:") for line in regressions))
+
+
+class ServerTimingTestCase(unittest.TestCase):
+    """
+    This class tests the Server-Timing header and the access log
+    on a small app with one authenticated route.
+    """
+
+    def create_app(self, enabled):
+        flask_app = Flask(__name__)
+        engine = create_engine("sqlite://")
+
+        @flask_app.route("/timed")
+        @requires_auth("add:recipe")
+        def timed():
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+                connection.execute(text("SELECT 2"))
+            return jsonify({"success": True})
+
+        @flask_app.route("/failing")
+        def failing():
+            with engine.connect() as connection:
+                try:
+                    connection.execute(text("SELECT * FROM missing"))
+                except exc.OperationalError:
+                    pass
+                connection.execute(text("SELECT 1"))
+            return jsonify({"success": True})
+
+        setup_timing(flask_app, enabled=enabled)
+        return flask_app
+
+    def test_server_timing(self):
+        client = self.create_app(True).test_client()
+
+        with self.assertLogs("access", "INFO") as logs:
+            res = client.get("/timed", headers=get_headers_recipe_user())
+        header = res.headers["Server-Timing"]
+        line = json.loads(logs.records[0].getMessage())
+
+        self.assertEqual(res.status_code, 200)
+        for name in ("auth", "db", "serialize", "total"):
+            self.assertIn(f"{name};dur=", header)
+        self.assertIn('desc="2 queries"', header)
+        self.assertEqual(line["path"], "/timed")
+        self.assertEqual(line["status"], 200)
+        self.assertEqual(line["queries"], 2)
+        self.assertIn(line["slowest_query"], ("SELECT 1", "SELECT 2"))
+        self.assertGreater(line["auth_ms"], 0)
+        self.assertGreaterEqual(line["total_ms"], line["db_ms"])
+
+    def test_server_timing_failed_statement(self):
+        client = self.create_app(True).test_client()
+
+        with self.assertLogs("access", "INFO") as logs:
+            client.get("/failing")
+            client.get("/failing")
+        lines = [json.loads(record.getMessage()) for record in logs.records]
+
+        for line in lines:
+            self.assertEqual(line["status"], 200)
+            self.assertEqual(line["queries"], 2)
+            self.assertGreaterEqual(line["total_ms"], line["db_ms"])
+
+    def test_server_timing_disabled(self):
+        client = self.create_app(False).test_client()
+
+        res = client.get("/timed", headers=get_headers_recipe_user())
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("Server-Timing", res.headers)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """
+    This class tests the Prometheus metrics, including their
+    aggregation across worker processes.
+    """
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def get_sample(self, name, labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_latency(self):
+        labels = {"method": "GET", "route": "/recipe/<int:recipe_id>", "status": "404"}
+        before = self.get_sample("http_request_duration_seconds_count", labels)
+
+        self.client.get("/recipe/1")
+        self.client.get("/recipe/2")
+        res = self.client.get("/metrics")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith("text/plain"))
+        self.assertIn(b"http_request_duration_seconds_bucket", res.data)
+        self.assertIn(b"http_requests_in_progress", res.data)
+        self.assertEqual(
+            self.get_sample("http_request_duration_seconds_count", labels),
+            before + 2,
+        )
+        self.assertNotIn(b'route="/metrics"', res.data)
+
+    def test_auth_failures(self):
+        labels = {"code": "authorization_header_missing", "status": "401"}
+        before = self.get_sample("auth_failures_total", labels)
+
+        res = self.client.post("/recipe", json={})
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(self.get_sample("auth_failures_total", labels), before + 1)
+
+    def test_cache_metrics(self):
+        with app.app_context():
+            db.session.add(create_simple_salad())
+            db.session.commit()
+        response_cache.clear()
+        labels = {"cache": "response"}
+        hits = self.get_sample("cache_hits_total", labels)
+        misses = self.get_sample("cache_misses_total", labels)
+
+        self.client.get("/recipe/1")
+        self.client.get("/recipe/1")
+        res = self.client.get("/metrics")
+
+        self.assertEqual(self.get_sample("cache_hits_total", labels), hits + 1)
+        self.assertEqual(self.get_sample("cache_misses_total", labels), misses + 1)
+        self.assertEqual(self.get_sample("cache_entries", labels), 1)
+        self.assertIn(b'cache_entries{cache="token"}', res.data)
+        self.assertIn(b'cache_size_bytes{cache="response"}', res.data)
+        response_cache.clear()
+
+    def test_multiprocess(self):
+        worker = "\n".join([
+            "from flask import Flask",
+            "from metrics import setup_metrics",
+            "app = Flask('worker')",
+            "app.add_url_rule('/', 'index', lambda: 'ok')",
+            "setup_metrics(app)",
+            "assert app.test_client().get('/').status_code == 200",
+        ])
+        with tempfile.TemporaryDirectory() as path:
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=path)
+            for _ in range(2):
+                subprocess.run(
+                    [sys.executable, "-c", worker],
+                    env=env,
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    check=True,
+                )
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry, path)
+
+            count = registry.get_sample_value(
+                "http_request_duration_seconds_count",
+                {"method": "GET", "route": "/", "status": "200"},
+            )
+
+        self.assertEqual(count, 2)
+
+
+class JSONProviderTestCase(unittest.TestCase):
+    """
+    This class checks that the orjson and the stdlib
+    providers produce equivalent JSON.
+    """
+
+    def test_providers_are_equivalent(self):
+        flask_app = Flask(__name__)
+        stdlib = StdlibJSONProvider(flask_app)
+        fast = OrjsonProvider(flask_app)
+        payload = {
+            "success": True,
+            "recipe": {
+                "id": 1,
+                "name": "Crème brûlée",
+                "ingredients": [{"name": "cream", "amount": 0.5}],
+                "preparation": None,
+            },
+        }
+
+        self.assertIsInstance(fast.dumps_bytes(payload), bytes)
+        self.assertEqual(
+            json.loads(fast.dumps_bytes(payload)),
+            json.loads(stdlib.dumps_bytes(payload)),
+        )
+        self.assertEqual(fast.loads(stdlib.dumps(payload)), payload)
+
+    def test_response(self):
+        flask_app = Flask(__name__)
+        with flask_app.app_context():
+            res = OrjsonProvider(flask_app).response(success=True, id=3)
+
+        self.assertEqual(res.mimetype, "application/json")
+        self.assertEqual(res.get_json(), {"success": True, "id": 3})
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """
+    This class tests the JWKS key cache using a local
+    jwks.json file instead of Auth0.
+    """
+
+    def setUp(self):
+        self.private_key = rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=2048,
+        )
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "jwks.json")
+        self.write_jwks("key-1")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_jwks(self, kid):
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(
+            self.private_key.public_key()
+        ))
+        jwk["kid"] = kid
+        jwk["use"] = "sig"
+        with open(self.path, "w") as outfile:
+            json.dump({"keys": [jwk]}, outfile)
+
+    def create_rs256_token(self, kid):
+        return jwt.encode(
+            {"user-email": "recipe@recipe.dabr.ch"},
+            self.private_key,
+            algorithm="RS256",
+            headers={"kid": kid},
+        )
+
+    def test_keys_are_cached(self):
+        store = JWKSKeyStore("file://" + self.path)
+        token = self.create_rs256_token("key-1")
+        for _ in range(5):
+            key = store.get_signing_key("key-1")
+            payload = jwt.decode(token, key.key, algorithms=["RS256"])
+            self.assertEqual(payload["user-email"], "recipe@recipe.dabr.ch")
+        self.assertEqual(store.fetch_count, 1)
+
+    def test_unknown_kid_forces_one_refetch(self):
+        store = JWKSKeyStore(self.path)
+        self.assertIsNotNone(store.get_signing_key("key-1"))
+        self.write_jwks("key-2")
+        self.assertIsNotNone(store.get_signing_key("key-2"))
+        self.assertEqual(store.fetch_count, 2)
+        self.assertIsNone(store.get_signing_key("key-3"))
+        self.assertEqual(store.fetch_count, 2)
+
+    def test_expired_keys_are_refetched(self):
+        store = JWKSKeyStore(self.path, ttl=0.05)
+        store.get_signing_key("key-1")
+        time.sleep(0.1)
+        store.get_signing_key("key-1")
+        self.assertEqual(store.fetch_count, 2)
+
+    def test_failed_refresh_keeps_stale_keys(self):
+        store = JWKSKeyStore(self.path, ttl=0.05, retry_interval=0.2)
+        store.get_signing_key("key-1")
+        attempts = []
+
+        def failing_load():
+            attempts.append(time.monotonic())
+            raise OSError("JWKS source unreachable")
+
+        store.load = failing_load
+        time.sleep(0.1)
+        with self.assertLogs(level="ERROR"):
+            for _ in range(3):
+                self.assertIsNotNone(store.get_signing_key("key-1"))
+        self.assertEqual(len(attempts), 1)
+
+        time.sleep(0.25)
+        with self.assertLogs(level="ERROR"):
+            self.assertIsNotNone(store.get_signing_key("key-1"))
+        self.assertEqual(len(attempts), 2)
+
+    def test_concurrent_refreshes_fetch_once(self):
+        store = JWKSKeyStore(self.path)
+        load = store.load
+
+        def slow_load():
+            time.sleep(0.1)
+            return load()
+
+        store.load = slow_load
+        threads = [
+            threading.Thread(target=store.get_signing_key, args=("key-1",))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(store.fetch_count, 1)
+        self.assertIsNotNone(store.get_signing_key("key-1"))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import time
+
+from flask import g
+from flask import has_request_context
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import auth
+
+
+# This file provides the per-request timing breakdown.
+#
+# When enabled (SERVER_TIMING=true), every response gets a
+# Server-Timing header with the time spent in authentication, in SQL
+# statements, in JSON encoding and in total, and an access log line
+# in JSON format (logger "access") is written, which also includes
+# the number of statements and the slowest one.
+#
+# When disabled, no hooks or event listeners are registered at all,
+# and auth.load_payload is not wrapped.
+
+access_log = logging.getLogger("access")
+
+SLOWEST_STATEMENT_LENGTH = 200
+
+
+class RequestTiming:
+    """
+    The timings collected for one request.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.auth_seconds = 0.0
+        self.db_seconds = 0.0
+        self.queries = 0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+        self.serialize_seconds = 0.0
+
+    def add_query(self, statement, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        if seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+
+
+def current_timing():
+    if has_request_context():
+        return g.get("timing")
+    return None
+
+
+class TimedJSONProvider:
+    """
+    Wraps the JSON provider of the app and adds the time spent
+    encoding to the timing of the request.
+    """
+
+    def __init__(self, provider):
+        self._provider = provider
+
+    def __getattr__(self, name):
+        return getattr(self._provider, name)
+
+    def _timed(self, method, *args, **kwargs):
+        timing = current_timing()
+        if timing is None:
+            return method(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timing.serialize_seconds += time.perf_counter() - start
+
+    def dumps(self, obj, **kwargs):
+        return self._timed(self._provider.dumps, obj, **kwargs)
+
+    def dumps_bytes(self, obj):
+        return self._timed(self._provider.dumps_bytes, obj)
+
+    def response(self, *args, **kwargs):
+        return self._timed(self._provider.response, *args, **kwargs)
+
+
+def timed_load_payload(load_payload):
+    """
+    Wraps auth.load_payload and adds the time spent verifying
+    the token to the timing of the request.
+    """
+
+    def load_payload_timed():
+        timing = current_timing()
+        if timing is None:
+            return load_payload()
+        start = time.perf_counter()
+        try:
+            return load_payload()
+        finally:
+            timing.auth_seconds += time.perf_counter() - start
+
+    load_payload_timed.timed = True
+    return load_payload_timed
+
+
+# The start time is kept on the execution context of the statement,
+# so that nothing remains on the connection if the statement fails.
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and current_timing() is not None:
+        context.timing_start = time.perf_counter()
+
+
+def finish_statement(context, statement):
+    start = getattr(context, "timing_start", None)
+    if start is None:
+        return
+    context.timing_start = None
+    timing = current_timing()
+    if timing is not None:
+        timing.add_query(statement, time.perf_counter() - start)
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    finish_statement(context, statement)
+
+
+def handle_error(exception_context):
+    # failed statements take database time as well
+    finish_statement(
+        exception_context.execution_context,
+        exception_context.statement,
+    )
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 3)
+
+
+def server_timing_header(timing, total_seconds):
+    return ", ".join([
+        f"auth;dur={milliseconds(timing.auth_seconds)}",
+        f'db;dur={milliseconds(timing.db_seconds)};desc="{timing.queries} queries"',
+        f"serialize;dur={milliseconds(timing.serialize_seconds)}",
+        f"total;dur={milliseconds(total_seconds)}",
+    ])
+
+
+def setup_timing(app, enabled=None):
+    """
+    Installs the timing hooks if enabled, which defaults to
+    the environment variable SERVER_TIMING.
+    """
+    if enabled is None:
+        enabled = os.environ.get("SERVER_TIMING", "") == "true"
+    if not enabled:
+        return
+    if not access_log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        access_log.addHandler(handler)
+        access_log.setLevel(logging.INFO)
+        access_log.propagate = False
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(Engine, "handle_error", handle_error)
+    if not getattr(auth.load_payload, "timed", False):
+        auth.load_payload = timed_load_payload(auth.load_payload)
+    app.json = TimedJSONProvider(app.json)
+
+    @app.before_request
+    def start_timing():
+        g.timing = RequestTiming()
+
+    @app.after_request
+    def finish_timing(response):
+        timing = g.get("timing")
+        if timing is None:
+            return response
+        total_seconds = time.perf_counter() - timing.start
+        response.headers["Server-Timing"] = server_timing_header(
+            timing,
+            total_seconds,
+        )
+        statement = timing.slowest_statement
+        if statement is not None:
+            statement = " ".join(statement.split())[:SLOWEST_STATEMENT_LENGTH]
+        access_log.info(json.dumps({
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "status": response.status_code,
+            "total_ms": milliseconds(total_seconds),
+            "auth_ms": milliseconds(timing.auth_seconds),
+            "db_ms": milliseconds(timing.db_seconds),
+            "serialize_ms": milliseconds(timing.serialize_seconds),
+            "queries": timing.queries,
+            "slowest_query_ms": milliseconds(timing.slowest_seconds),
+            "slowest_query": statement,
+        }))
+        return response